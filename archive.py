@@ -0,0 +1,326 @@
+import argparse
+import glob
+import json
+import os
+import re
+import struct
+import zlib
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, text
+
+from database import init_db, processor_db_session, run_with_retry
+from log_processor import Event
+from query_cache import bump_generation
+
+MAGIC = b"LPARCH1\n"
+HEADER_SIZE = struct.Struct("<I")
+# Events moved per transaction, bounds memory and how long the write lock is held
+BATCH_SIZE = 10000
+# Free pages returned to the file system after every batch
+VACUUM_PAGES = 2000
+COMPRESSION_LEVEL = 6
+ARCHIVE_PATTERN = re.compile(r"^events_(\d{8})_(\d+)\.lpa$")
+# Columns decoded from their JSON representation
+DATETIME_COLUMNS = {"date_time"}
+
+
+def write_archive(file_name, columns, rows):
+    """
+    Write rows column by column, every column compressed separately so readers only
+    decompress the columns they need. The file is replaced atomically.
+    @param file_name: Archive file
+    @type file_name: str
+    @param columns: Column names
+    @type columns: list[str]
+    @param rows: Rows with a value per column
+    @type rows: list[tuple]
+    @return: Archive size in bytes
+    @rtype: int
+    """
+    blocks = list()
+    for i, column in enumerate(columns):
+        values = [row[i] for row in rows]
+        if column in DATETIME_COLUMNS:
+            values = [v.isoformat() if v is not None else None for v in values]
+        blocks.append(
+            zlib.compress(
+                json.dumps(values, separators=(",", ":")).encode("utf-8"),
+                COMPRESSION_LEVEL,
+            )
+        )
+    header = json.dumps(
+        {"columns": columns, "count": len(rows), "sizes": [len(b) for b in blocks]}
+    ).encode("utf-8")
+    temp_file = file_name + ".tmp"
+    with open(temp_file, "wb") as f:
+        f.write(MAGIC)
+        f.write(HEADER_SIZE.pack(len(header)))
+        f.write(header)
+        for block in blocks:
+            f.write(block)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, file_name)
+    return os.path.getsize(file_name)
+
+
+def read_archive(file_name, columns=None):
+    """
+    Read columns of an archive
+    @param file_name: Archive file
+    @type file_name: str
+    @param columns: Columns to decompress, all if None
+    @type columns: list[str] | None
+    @return: Dict with column name as key and list of values as value
+    @rtype: dict
+    """
+    with open(file_name, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("'{}' is not an events archive".format(file_name))
+        (header_size,) = HEADER_SIZE.unpack(f.read(HEADER_SIZE.size))
+        header = json.loads(f.read(header_size))
+        wanted = set(columns or header["columns"])
+        unknown = wanted.difference(header["columns"])
+        if unknown:
+            raise ValueError(
+                "Unknown archive column(s) {} in '{}'".format(
+                    sorted(unknown), file_name
+                )
+            )
+        result = dict()
+        for column, size in zip(header["columns"], header["sizes"]):
+            if column not in wanted:
+                f.seek(size, os.SEEK_CUR)
+                continue
+            values = json.loads(zlib.decompress(f.read(size)))
+            if column in DATETIME_COLUMNS:
+                values = [datetime.fromisoformat(v) if v else None for v in values]
+            result[column] = values
+    return result
+
+
+def list_archives(archive_dir, start=None, end=None):
+    """
+    Archive files holding events of days overlapping [start, end)
+    @param archive_dir: Directory holding archives
+    @type archive_dir: str
+    @param start: Window start
+    @type start: datetime | None
+    @param end: Window end (exclusive)
+    @type end: datetime | None
+    @return: Archive paths, oldest day first
+    @rtype: list[str]
+    """
+    archives = list()
+    for path in glob.glob(os.path.join(archive_dir, "events_*.lpa")):
+        match = ARCHIVE_PATTERN.match(os.path.basename(path))
+        if match is None:
+            continue
+        day = datetime.strptime(match.group(1), "%Y%m%d")
+        if start is not None and day + timedelta(days=1) <= start.replace(tzinfo=None):
+            continue
+        if end is not None and day >= end.replace(tzinfo=None):
+            continue
+        archives.append((match.group(1), int(match.group(2)), path))
+    return [path for _, _, path in sorted(archives)]
+
+
+def read_archived_events(archive_dir, start=None, end=None, columns=None):
+    """
+    Stream archived events of a time window as dicts
+    @param archive_dir: Directory holding archives
+    @type archive_dir: str
+    @param start: Only events at or after this datetime
+    @type start: datetime | None
+    @param end: Only events before this datetime
+    @type end: datetime | None
+    @param columns: Columns to read, all if None
+    @type columns: list[str] | None
+    @rtype: collections.Iterable[dict]
+    """
+    start = start.replace(tzinfo=None) if start is not None else None
+    end = end.replace(tzinfo=None) if end is not None else None
+    for path in list_archives(archive_dir, start, end):
+        wanted = list(columns) if columns else None
+        if wanted and "date_time" not in wanted:
+            wanted.append("date_time")
+        values = read_archive(path, wanted)
+        names = list(values)
+        for row in zip(*(values[name] for name in names)):
+            event = dict(zip(names, row))
+            date_time = event["date_time"]
+            if start is not None and date_time < start:
+                continue
+            if end is not None and date_time >= end:
+                continue
+            if columns and "date_time" not in columns:
+                del event["date_time"]
+            yield event
+
+
+def get_auto_vacuum():
+    """
+    SQLite auto_vacuum mode of the processor DB: 0 none, 1 full, 2 incremental
+    @rtype: int
+    """
+    return processor_db_session.execute(text("PRAGMA auto_vacuum")).scalar()
+
+
+def enable_incremental_vacuum():
+    """
+    Switch an existing processor DB to incremental auto_vacuum, which takes a single
+    full VACUUM. DBs created by init_db() already use it.
+    """
+    processor_db_session.commit()
+    engine = processor_db_session.get_bind()
+    # VACUUM can't run inside a transaction
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+        connection.exec_driver_sql("VACUUM")
+
+
+def incremental_vacuum(pages=VACUUM_PAGES):
+    """
+    Return up to pages free pages to the file system, without rewriting the DB
+    @param pages: Maximum number of pages to free
+    @type pages: int
+    @return: Free pages left in the DB
+    @rtype: int
+    """
+    processor_db_session.commit()
+    # sqlite3 steps a pragma returning no rows only once, which frees a single page
+    dbapi_connection = processor_db_session.connection().connection.dbapi_connection
+    dbapi_connection.executescript("PRAGMA incremental_vacuum({});".format(int(pages)))
+    processor_db_session.commit()
+    return processor_db_session.execute(text("PRAGMA freelist_count")).scalar()
+
+
+def compact_events(
+    before, archive_dir, batch_size=BATCH_SIZE, vacuum_pages=VACUUM_PAGES
+):
+    """
+    Move events older than a cutoff from the processor DB into per-day archives, one
+    batch at a time: a batch is archived, then deleted, then its free pages are vacuumed
+    @param before: Events before this datetime are archived
+    @type before: datetime
+    @param archive_dir: Directory archives are written to
+    @type archive_dir: str
+    @param batch_size: Events per batch
+    @type batch_size: int
+    @param vacuum_pages: Free pages vacuumed after every batch, 0 leaves them for reuse
+    @type vacuum_pages: int
+    @return: Number of archived events and bytes written
+    @rtype: (int, int)
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    before = before.replace(tzinfo=None)
+    table = Event.__table__
+    columns = [c.name for c in table.columns]
+    incremental = get_auto_vacuum() == 2
+    if vacuum_pages and not incremental:
+        print(
+            "auto_vacuum is not incremental, freed pages are only reused; "
+            "run with --enable-incremental-vacuum once to return them"
+        )
+    archived = 0
+    written = 0
+    last_id = 0
+    while True:
+        rows = processor_db_session.execute(
+            select(*table.columns)
+            .where(table.c.date_time < before, table.c.id > last_id)
+            .order_by(table.c.id)
+            .limit(batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        by_day = dict()
+        for row in rows:
+            by_day.setdefault(row.date_time.strftime("%Y%m%d"), list()).append(row)
+        for day, day_rows in by_day.items():
+            # Named after the first id, so re-running an interrupted batch replaces it
+            written += write_archive(
+                os.path.join(
+                    archive_dir, "events_{}_{}.lpa".format(day, day_rows[0].id)
+                ),
+                columns,
+                [tuple(row) for row in day_rows],
+            )
+        first_id, last_id = rows[0].id, rows[-1].id
+
+        def delete():
+            processor_db_session.execute(
+                table.delete().where(
+                    table.c.id >= first_id,
+                    table.c.id <= last_id,
+                    table.c.date_time < before,
+                )
+            )
+            processor_db_session.commit()
+
+        run_with_retry(delete, processor_db_session)
+        archived += len(rows)
+        if vacuum_pages and incremental:
+            incremental_vacuum(vacuum_pages)
+        print("Archived {} events".format(archived))
+    if archived:
+        bump_generation()
+    return archived, written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Archive old events into compressed columnar files, or read them"
+    )
+    parser.add_argument(
+        "--archive-dir", help="Directory holding archives", type=str, required=True
+    )
+    parser.add_argument(
+        "--before",
+        help="Archive events before this datetime (ISO 8601) and delete them from the DB",
+        type=str,
+    )
+    parser.add_argument(
+        "--batch-size", help="Events per batch", type=int, default=BATCH_SIZE
+    )
+    parser.add_argument(
+        "--vacuum-pages",
+        help="Free pages vacuumed after every batch, 0 to leave them for reuse",
+        type=int,
+        default=VACUUM_PAGES,
+    )
+    parser.add_argument(
+        "--enable-incremental-vacuum",
+        help="Switch an existing DB to incremental vacuum first (one full VACUUM)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--start", help="Read archived events at or after this datetime", type=str
+    )
+    parser.add_argument(
+        "--end", help="Read archived events before this datetime", type=str
+    )
+    parser.add_argument(
+        "--columns", help="Comma separated columns to read, all if omitted", type=str
+    )
+    args = parser.parse_args()
+    init_db()
+    if args.before:
+        if args.enable_incremental_vacuum and get_auto_vacuum() != 2:
+            enable_incremental_vacuum()
+        count, size = compact_events(
+            datetime.fromisoformat(args.before),
+            args.archive_dir,
+            args.batch_size,
+            args.vacuum_pages,
+        )
+        print("Archived {} events into {} bytes".format(count, size))
+    else:
+        for archived_event in read_archived_events(
+            args.archive_dir,
+            datetime.fromisoformat(args.start) if args.start else None,
+            datetime.fromisoformat(args.end) if args.end else None,
+            args.columns.split(",") if args.columns else None,
+        ):
+            print(json.dumps(archived_event, default=str))
@@ -0,0 +1,176 @@
+import argparse
+import random
+from bisect import bisect
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate
+
+LOG_LINE = '{ip} - - [{date_time}] "{method} {url} HTTP/1.1" {status} {size} "{referer}" "{user_agent}"\n'
+
+PAGES = [
+    "/",
+    "/index.php",
+    "/blog/",
+    "/blog/{id}/",
+    "/?p={id}",
+    "/wp-content/uploads/2019/{id}/image.jpg",
+    "/wp-includes/js/jquery/jquery.js?ver=1.12.4",
+    "/feed/",
+    "/contact/",
+]
+SCANNED_PAGES = [
+    "/.env",
+    "/phpmyadmin/index.php",
+    "/backup.zip",
+    "/wp-config.php.bak",
+    "/xmlrpc.php",
+    "/admin/{id}",
+]
+USER_AGENTS = [
+    "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:62.0) Gecko/20100101 Firefox/62.0",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/77.0.3865.90 Safari/537.36",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 13_1 like Mac OS X) AppleWebKit/605.1.15 "
+    "(KHTML, like Gecko) Version/13.0 Mobile/15E148 Safari/604.1",
+    "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)",
+    "Googlebot-Image/1.0",
+    "curl/7.58.0",
+    "python-requests/2.22.0",
+    "-",
+]
+REFERERS = ["-", "https://www.google.com/", "https://example.com/blog/"]
+
+
+def generate_lines(
+    count,
+    seed=0,
+    distinct_ips=1000,
+    ip_skew=1.1,
+    login_post_ratio=0.05,
+    error_4xx_ratio=0.1,
+    start=None,
+    requests_per_second=50,
+):
+    """
+    Generate realistic Apache combined format log lines, reproducible for a given seed
+    @param count: Number of lines
+    @type count: int
+    @param seed: Random seed
+    @type seed: int
+    @param distinct_ips: Number of distinct client IPs
+    @type distinct_ips: int
+    @param ip_skew: Zipf exponent of requests per IP, 0 is uniform
+    @type ip_skew: float
+    @param login_post_ratio: Share of POSTs to wp-login.php
+    @type login_post_ratio: float
+    @param error_4xx_ratio: Share of requests answered with 4XX
+    @type error_4xx_ratio: float
+    @param start: Timestamp of the first line
+    @type start: datetime | None
+    @param requests_per_second: Average request rate
+    @type requests_per_second: float
+    @rtype: collections.Iterable[str]
+    """
+    generator = random.Random(seed)
+    if start is None:
+        start = datetime(2019, 10, 1, tzinfo=timezone(timedelta(hours=3)))
+    ips = [
+        "{}.{}.{}.{}".format(
+            generator.randint(1, 223),
+            generator.randint(0, 255),
+            generator.randint(0, 255),
+            generator.randint(1, 254),
+        )
+        for _ in range(distinct_ips)
+    ]
+    cum_weights = list(
+        accumulate(1.0 / (rank**ip_skew) for rank in range(1, distinct_ips + 1))
+    )
+    total_weight = cum_weights[-1]
+    date_time = start
+    for _ in range(count):
+        date_time += timedelta(seconds=generator.expovariate(requests_per_second))
+        ip = ips[bisect(cum_weights, generator.random() * total_weight)]
+        kind = generator.random()
+        if kind < login_post_ratio:
+            method, url, status = "POST", "/wp-login.php", generator.choice([200, 302])
+        elif kind < login_post_ratio * 1.5:
+            method, url, status = "GET", "/wp-login.php", 200
+        elif kind < login_post_ratio * 1.5 + error_4xx_ratio:
+            method = "POST" if generator.random() < 0.2 else "GET"
+            url = generator.choice(SCANNED_PAGES)
+            status = generator.choice([400, 403, 404, 404, 404])
+        else:
+            method = generator.choices(
+                ["GET", "POST", "HEAD", "OPTIONS"], [0.9, 0.05, 0.03, 0.02]
+            )[0]
+            url = generator.choice(PAGES)
+            status = generator.choice([200, 200, 200, 304, 301])
+        yield LOG_LINE.format(
+            ip=ip,
+            date_time=date_time.strftime("%d/%b/%Y:%H:%M:%S %z"),
+            method=method,
+            url=url.format(id=generator.randint(1, 5000)),
+            status=status,
+            size=generator.randint(200, 60000),
+            referer=generator.choice(REFERERS),
+            user_agent=generator.choice(USER_AGENTS),
+        )
+
+
+def write_log(file_name, count, **kwargs):
+    """
+    Write a generated log file
+    @param file_name: Path of the log file
+    @type file_name: str
+    @param count: Number of lines
+    @type count: int
+    @param kwargs: Passed to generate_lines()
+    @return: Number of bytes written
+    @rtype: int
+    """
+    written = 0
+    with open(file_name, "w") as f:
+        for line in generate_lines(count, **kwargs):
+            written += f.write(line)
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic Apache combined format access log"
+    )
+    parser.add_argument("--output", "-o", help="Log file to write", required=True)
+    parser.add_argument(
+        "--lines", "-n", help="Number of lines", type=int, default=100000
+    )
+    parser.add_argument("--seed", help="Random seed", type=int, default=0)
+    parser.add_argument(
+        "--ips", help="Number of distinct client IPs", type=int, default=1000
+    )
+    parser.add_argument(
+        "--ip-skew", help="Zipf exponent of requests per IP", type=float, default=1.1
+    )
+    parser.add_argument(
+        "--login-post-ratio",
+        help="Share of POSTs to wp-login.php",
+        type=float,
+        default=0.05,
+    )
+    parser.add_argument(
+        "--4xx-ratio",
+        dest="error_4xx_ratio",
+        help="Share of 4XX responses",
+        type=float,
+        default=0.1,
+    )
+    args = parser.parse_args()
+    size = write_log(
+        args.output,
+        args.lines,
+        seed=args.seed,
+        distinct_ips=args.ips,
+        ip_skew=args.ip_skew,
+        login_post_ratio=args.login_post_ratio,
+        error_4xx_ratio=args.error_4xx_ratio,
+    )
+    print("Wrote {} lines ({} bytes) to {}".format(args.lines, size, args.output))
@@ -0,0 +1,214 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from benchmarks.generator import generate_lines, write_log
+
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+
+def measure(function, repeat, setup=None):
+    """
+    Run function repeat times and collect timings
+    @param function: Benchmarked code, receives the setup() result
+    @type function: callable
+    @param repeat: Number of runs
+    @type repeat: int
+    @param setup: Untimed preparation run before every measurement
+    @type setup: callable | None
+    @return: Best and median seconds
+    @rtype: dict
+    """
+    timings = list()
+    for _ in range(repeat):
+        prepared = setup() if setup is not None else None
+        started = time.perf_counter()
+        function(prepared)
+        timings.append(time.perf_counter() - started)
+    return {"best_seconds": min(timings), "median_seconds": statistics.median(timings)}
+
+
+def with_rate(result, items):
+    """
+    Add item count and throughput at the best timing
+    @param result: Output of measure()
+    @type result: dict
+    @param items: Items processed per run
+    @type items: int
+    @rtype: dict
+    """
+    result["items"] = items
+    result["items_per_second"] = (
+        items / result["best_seconds"] if result["best_seconds"] else 0.0
+    )
+    return result
+
+
+def run_benchmarks(lines_count, repeat, seed, work_dir):
+    """
+    Benchmark parse_line, parse_file, Event.save_all, generate_reports, the NumPy report
+    engine (if NumPy is installed) and the detector
+    @param lines_count: Size of the generated log
+    @type lines_count: int
+    @param repeat: Runs per benchmark
+    @type repeat: int
+    @param seed: Generator seed
+    @type seed: int
+    @param work_dir: Directory for the generated log and databases
+    @type work_dir: str
+    @return: Benchmark name as key and timings as value
+    @rtype: dict
+    """
+    # Databases must point to work_dir before sqlalchemy engines are created
+    os.environ["PROCESSOR_DB_FILE"] = os.path.join(work_dir, "log_processor.db")
+    os.environ["REPORT_DB_FILE"] = os.path.join(work_dir, "log_report.db")
+    from database import init_db, processor_db_session
+    from detector import benchmark as detector_benchmark
+    from log_processor import Event, parse_file, parse_line
+    from report import Report, finish_reports, generate_reports
+
+    init_db()
+    log_file = os.path.join(work_dir, "access.log")
+    write_log(log_file, lines_count, seed=seed)
+    lines = list(generate_lines(lines_count, seed=seed))
+    results = dict()
+
+    results["parse_line"] = with_rate(
+        measure(lambda _: [parse_line(line) for line in lines], repeat), lines_count
+    )
+    results["parse_file"] = with_rate(
+        measure(lambda _: parse_file(log_file), repeat), lines_count
+    )
+
+    def fresh_events():
+        processor_db_session.query(Event).delete()
+        processor_db_session.commit()
+        return parse_file(log_file)
+
+    results["save_all"] = with_rate(
+        measure(Event.save_all, repeat, fresh_events), lines_count
+    )
+    results["generate_reports"] = with_rate(
+        measure(lambda _: generate_reports(save=True), repeat), lines_count
+    )
+    try:
+        from numpy_reports import EventColumns
+        from numpy_reports import generate_reports as generate_numpy_reports
+    except ImportError:
+        print("NumPy not installed, skipping numpy_reports")
+    else:
+        records = [e.to_record() for e in Event.query.all()]
+
+        def numpy_reports(_):
+            columns = EventColumns()
+            columns.add_records(records)
+            generate_numpy_reports(columns, Report, finish_reports)
+
+        results["numpy_reports"] = with_rate(
+            measure(numpy_reports, repeat), len(records)
+        )
+
+    detector_events = lines_count * 10
+    results["detector"] = with_rate(
+        measure(
+            lambda _: detector_benchmark(detector_events, max(lines_count, 1000)),
+            repeat,
+        ),
+        detector_events,
+    )
+    return results
+
+
+def get_version():
+    """
+    Git revision of the benchmarked tree
+    @rtype: str
+    """
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=str(RESULTS_DIR.parent),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results, baseline):
+    """
+    Print throughput change against a baseline result file
+    @param results: Current results
+    @type results: dict
+    @param baseline: Baseline results
+    @type baseline: dict
+    """
+    print(
+        "Compared to {} ({}):".format(
+            baseline["meta"]["version"], baseline["meta"]["created"]
+        )
+    )
+    for name, current in sorted(results["benchmarks"].items()):
+        previous = baseline["benchmarks"].get(name)
+        if not previous or not previous["items_per_second"]:
+            continue
+        change = current["items_per_second"] / previous["items_per_second"] - 1
+        print("  {:<18} {:>+8.1%}".format(name, change))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run benchmarks on a synthetic access log and store results as JSON"
+    )
+    parser.add_argument("--lines", "-n", help="Log size", type=int, default=20000)
+    parser.add_argument(
+        "--repeat", "-r", help="Runs per benchmark", type=int, default=3
+    )
+    parser.add_argument("--seed", help="Generator seed", type=int, default=0)
+    parser.add_argument(
+        "--output",
+        "-o",
+        help="Result file, defaults to benchmarks/results/<git revision>.json",
+    )
+    parser.add_argument("--compare", "-c", help="Baseline result file to compare with")
+    args = parser.parse_args()
+
+    version = get_version()
+    with tempfile.TemporaryDirectory() as work_dir:
+        benchmark_results = {
+            "meta": {
+                "version": version,
+                "created": datetime.now().isoformat(timespec="seconds"),
+                "python": sys.version.split()[0],
+                "platform": platform.platform(),
+                "lines": args.lines,
+                "repeat": args.repeat,
+                "seed": args.seed,
+            },
+            "benchmarks": run_benchmarks(args.lines, args.repeat, args.seed, work_dir),
+        }
+    for benchmark_name, timing in sorted(benchmark_results["benchmarks"].items()):
+        print(
+            "{:<18} {:>10.3f}s {:>12.0f} items/s".format(
+                benchmark_name, timing["best_seconds"], timing["items_per_second"]
+            )
+        )
+    output = args.output or str(RESULTS_DIR / "{}.json".format(version))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(benchmark_results, f, indent=2, sort_keys=True)
+    print("Saved results to {}".format(output))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(benchmark_results, json.load(f))
@@ -1,5 +1,6 @@
 from pathlib import Path
 import os
+import time
 
 # Set env vars BEFORE importing sqlalchemy to control engine creation
 os.environ.setdefault(
@@ -10,14 +11,39 @@ os.environ.setdefault(
 )
 
 from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.orm import declarative_base
 
 PROCESSOR_DB_FILE = os.environ["PROCESSOR_DB_FILE"]
 REPORT_DB_FILE = os.environ["REPORT_DB_FILE"]
-
-processor_engine = create_engine("sqlite:///{}".format(PROCESSOR_DB_FILE))
-report_engine = create_engine("sqlite:///{}".format(REPORT_DB_FILE))
+# Route events into per-day or per-month shard files in this directory, if set
+SHARD_DIR = os.environ.get("PROCESSOR_SHARD_DIR", "")
+SHARD_PERIOD = os.environ.get("PROCESSOR_SHARD_PERIOD", "day")
+# Maximum number of report query results cached in memory, 0 disables the cache
+REPORT_CACHE_SIZE = int(os.environ.get("REPORT_CACHE_SIZE", "1024"))
+# Seconds SQLite waits for another process to release its write lock
+BUSY_TIMEOUT = float(os.environ.get("PROCESSOR_BUSY_TIMEOUT", "30"))
+# Attempts of a write that still finds the DB locked after BUSY_TIMEOUT
+WRITE_ATTEMPTS = 5
+RETRY_DELAY = 0.5
+
+
+def create_sqlite_engine(path):
+    """
+    Engine of an SQLite file whose connections wait BUSY_TIMEOUT for locks held by
+    other processes instead of failing at once
+    @param path: DB file
+    @type path: str
+    @rtype: sqlalchemy.engine.Engine
+    """
+    return create_engine(
+        "sqlite:///{}".format(path), connect_args={"timeout": BUSY_TIMEOUT}
+    )
+
+
+processor_engine = create_sqlite_engine(PROCESSOR_DB_FILE)
+report_engine = create_sqlite_engine(REPORT_DB_FILE)
 
 _proc_sessionmaker = sessionmaker(
     autocommit=False, autoflush=False, bind=processor_engine
@@ -41,13 +67,77 @@ def _rebind(new_processor_path, new_report_path):
     processor_engine.dispose()
     report_engine.dispose()
 
-    processor_engine = create_engine("sqlite:///{}".format(new_processor_path))
-    report_engine = create_engine("sqlite:///{}".format(new_report_path))
+    processor_engine = create_sqlite_engine(new_processor_path)
+    report_engine = create_sqlite_engine(new_report_path)
 
     _proc_sessionmaker.configure(bind=processor_engine)
     _report_sessionmaker.configure(bind=report_engine)
 
 
+def is_locked_error(error):
+    """
+    Did a statement fail because another connection holds the lock
+    @param error: Error raised by the driver
+    @type error: OperationalError
+    @rtype: bool
+    """
+    message = str(error.orig if error.orig is not None else error).lower()
+    return "locked" in message or "busy" in message
+
+
+def run_with_retry(write, session=None, attempts=WRITE_ATTEMPTS, delay=RETRY_DELAY):
+    """
+    Run a write, retried with exponential backoff while the DB stays locked
+    @param write: Performs and commits the write
+    @type write: callable
+    @param session: Session rolled back before a retry
+    @type session: sqlalchemy.orm.Session | None
+    @param attempts: Maximum number of attempts
+    @type attempts: int
+    @param delay: Seconds to wait before the first retry, doubled for every next one
+    @type delay: float
+    @return: Result of write
+    """
+    for attempt in range(attempts):
+        try:
+            return write()
+        except OperationalError as e:
+            if not is_locked_error(e) or attempt == attempts - 1:
+                raise
+            if session is not None:
+                session.rollback()
+            wait = delay * 2**attempt
+            print("Database is locked, retrying in {:.1f}s".format(wait))
+            time.sleep(wait)
+
+
+def add_missing_columns(engine, tables):
+    """
+    create_all() doesn't alter existing tables, add columns introduced since they were created
+    @param engine: Engine of the DB holding the tables
+    @type engine: sqlalchemy.engine.Engine
+    @param tables: Table definitions
+    @type tables: list[sqlalchemy.Table]
+    """
+    with engine.begin() as connection:
+        for table in tables:
+            existing = {
+                row[1]
+                for row in connection.exec_driver_sql(
+                    'PRAGMA table_info("{}")'.format(table.name)
+                )
+            }
+            if not existing:
+                continue
+            for column in table.columns:
+                if column.name not in existing:
+                    connection.exec_driver_sql(
+                        'ALTER TABLE "{}" ADD COLUMN "{}" {}'.format(
+                            table.name, column.name, column.type.compile(engine.dialect)
+                        )
+                    )
+
+
 def init_db():
     env_p = os.environ.get("PROCESSOR_DB_FILE")
     env_r = os.environ.get("REPORT_DB_FILE")
@@ -58,5 +148,10 @@ def init_db():
     if env_p != default_p or env_r != default_r:
         _rebind(env_p, env_r)
 
-    BaseProcessor.metadata.create_all(bind=processor_engine)
+    with processor_engine.begin() as connection:
+        # Only applies to a new DB, the first table has to be created on this connection
+        connection.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+        BaseProcessor.metadata.create_all(bind=connection)
     BaseReport.metadata.create_all(bind=report_engine)
+    add_missing_columns(processor_engine, BaseProcessor.metadata.sorted_tables)
+    add_missing_columns(report_engine, BaseReport.metadata.sorted_tables)
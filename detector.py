@@ -0,0 +1,264 @@
+import argparse
+import random
+import time
+from collections import OrderedDict, deque, namedtuple
+
+# EventType.post_login.name, not imported to keep log_processor free to import us
+POST_LOGIN = "post_login"
+# Emitted when an IP crosses the threshold
+Alert = namedtuple("Alert", ["source_ip", "count", "first_seen", "last_seen"])
+
+
+def print_alert(alert):
+    """
+    Default alert handler
+    @param alert: Alert to print
+    @type alert: Alert
+    """
+    print(
+        "ALERT: {} sent {} login POSTs in {:.0f}s".format(
+            alert.source_ip, alert.count, alert.last_seen - alert.first_seen
+        )
+    )
+
+
+class BruteForceDetector(object):
+    """
+    Sliding-window detector of login POST bursts per source IP.
+    Every IP gets a ring buffer with the timestamps of its last `threshold` login POSTs,
+    so the window check is O(threshold) per event and memory is bounded by
+    max_ips * threshold. Timestamps may arrive out of order (parser workers, several
+    files, unparsable dates replaced by the current time), so the window spans the
+    oldest to the newest timestamp in the ring rather than its first to last entry.
+    Idle IPs are evicted against a clock, the newest timestamp seen; a single timestamp
+    jumping more than idle_timeout ahead of it (such as the current time replacing an
+    unparsable date) only moves the clock once another IP confirms the jump, so it
+    can't evict every tracked IP.
+    """
+
+    def __init__(
+        self, threshold=20, window=60, max_ips=100000, idle_timeout=None, on_alert=None
+    ):
+        """
+        @param threshold: Number of login POSTs that triggers an alert
+        @type threshold: int
+        @param window: Window length in seconds
+        @type window: float
+        @param max_ips: Maximum number of tracked IPs, least recently seen are evicted
+        @type max_ips: int
+        @param idle_timeout: Evict IPs not seen for this many seconds, defaults to window
+        @type idle_timeout: float | None
+        @param on_alert: Called with an Alert when an IP crosses the threshold
+        @type on_alert: callable | None
+        """
+        if threshold < 1:
+            raise ValueError("Threshold must be positive, got {}".format(threshold))
+        self.threshold = threshold
+        self.window = window
+        self.max_ips = max_ips
+        self.idle_timeout = window if idle_timeout is None else idle_timeout
+        self.on_alert = on_alert if on_alert is not None else print_alert
+        # IP -> [ring buffer of timestamps, alerted flag], ordered by last seen
+        self.tracked = OrderedDict()
+        # Newest timestamp seen, idle IPs are evicted relative to it
+        self.clock = None
+        # (timestamp, source IP) of an unconfirmed jump ahead of the clock
+        self.jump = None
+        self.alerts_count = 0
+        self.evicted_count = 0
+
+    def __repr__(self):
+        """
+        String representation
+        @rtype: str
+        """
+        return "<{} threshold={} window={} tracked={} alerts={}>".format(
+            self.__class__.__name__,
+            self.threshold,
+            self.window,
+            len(self.tracked),
+            self.alerts_count,
+        )
+
+    def observe(self, source_ip, timestamp):
+        """
+        Register a login POST
+        @param source_ip: Source IP address
+        @type source_ip: str
+        @param timestamp: Epoch seconds of the request
+        @type timestamp: float
+        @return: Alert if the IP just crossed the threshold
+        @rtype: Alert | None
+        """
+        tracked = self.tracked
+        state = tracked.get(source_ip)
+        if state is None:
+            state = tracked[source_ip] = [deque(maxlen=self.threshold), False]
+            if len(tracked) > self.max_ips:
+                tracked.popitem(last=False)
+                self.evicted_count += 1
+        else:
+            tracked.move_to_end(source_ip)
+        ring = state[0]
+        ring.append(timestamp)
+
+        alert = None
+        in_window = False
+        if len(ring) == self.threshold:
+            first_seen = min(ring)
+            last_seen = max(ring)
+            in_window = last_seen - first_seen <= self.window
+        if in_window:
+            if not state[1]:
+                state[1] = True
+                alert = Alert(source_ip, self.threshold, first_seen, last_seen)
+                self.alerts_count += 1
+                self.on_alert(alert)
+        else:
+            # Re-arm once the burst has slowed down
+            state[1] = False
+
+        self.advance_clock(source_ip, timestamp)
+        self.evict_idle(self.clock)
+        return alert
+
+    def advance_clock(self, source_ip, timestamp):
+        """
+        Move the clock to a newer timestamp, jumps of more than idle_timeout are only
+        taken once an event of another IP confirms them
+        @param source_ip: Source IP address of the event
+        @type source_ip: str
+        @param timestamp: Epoch seconds of the event
+        @type timestamp: float
+        """
+        if self.clock is None or timestamp <= self.clock + self.idle_timeout:
+            if self.clock is None or timestamp > self.clock:
+                self.clock = timestamp
+            return
+        jump = self.jump
+        if (
+            jump is not None
+            and jump[1] != source_ip
+            and abs(timestamp - jump[0]) <= self.idle_timeout
+        ):
+            self.clock = max(timestamp, jump[0])
+            self.jump = None
+        else:
+            self.jump = (timestamp, source_ip)
+
+    def observe_event(self, event):
+        """
+        Register an Event, everything except login POSTs is ignored
+        @param event: Parsed event
+        @type event: log_processor.Event
+        @rtype: Alert | None
+        """
+        if event.event_type != POST_LOGIN:
+            return None
+        return self.observe(event.source_ip, event.date_time.timestamp())
+
+    def observe_record(self, record):
+        """
+        Register a parsed record, everything except login POSTs is ignored
+        @param record: Record from log_processor.parse_record()
+        @type record: dict
+        @rtype: Alert | None
+        """
+        if record["event_type"] != POST_LOGIN:
+            return None
+        return self.observe(record["source_ip"], record["date_time"].timestamp())
+
+    def evict_idle(self, now):
+        """
+        Drop IPs that were not seen for idle_timeout seconds, or only at times the clock
+        never confirmed
+        @param now: Current epoch seconds
+        @type now: float
+        @return: Number of evicted IPs
+        @rtype: int
+        """
+        tracked = self.tracked
+        cutoff = now - self.idle_timeout
+        horizon = now + self.idle_timeout
+        evicted = 0
+        while tracked:
+            oldest_ip, oldest_state = next(iter(tracked.items()))
+            if cutoff <= max(oldest_state[0]) <= horizon:
+                break
+            del tracked[oldest_ip]
+            evicted += 1
+        self.evicted_count += evicted
+        return evicted
+
+
+def benchmark(num_events=1000000, num_ips=200000, threshold=20, window=60, seed=0):
+    """
+    Measure detector throughput on a synthetic login POST stream
+    @param num_events: Number of login POSTs to feed
+    @type num_events: int
+    @param num_ips: Number of distinct source IPs
+    @type num_ips: int
+    @param threshold: Detector threshold
+    @type threshold: int
+    @param window: Detector window in seconds
+    @type window: float
+    @param seed: Random seed
+    @type seed: int
+    @return: Dict with throughput and memory figures
+    @rtype: dict
+    """
+    generator = random.Random(seed)
+    ips = [
+        "10.{}.{}.{}".format(i >> 16 & 255, i >> 8 & 255, i & 255)
+        for i in range(num_ips)
+    ]
+    # A few attackers hammering among many one-off clients
+    attackers = ips[:10]
+    stream = [
+        (
+            attackers[i % 10] if generator.random() < 0.2 else generator.choice(ips),
+            i * 0.001,
+        )
+        for i in range(num_events)
+    ]
+    detector = BruteForceDetector(
+        threshold, window, max_ips=num_ips, on_alert=lambda alert: None
+    )
+    max_tracked = 0
+    started = time.perf_counter()
+    for source_ip, timestamp in stream:
+        detector.observe(source_ip, timestamp)
+        if len(detector.tracked) > max_tracked:
+            max_tracked = len(detector.tracked)
+    elapsed = time.perf_counter() - started
+    return {
+        "events": num_events,
+        "distinct_ips": num_ips,
+        "seconds": elapsed,
+        "events_per_second": num_events / elapsed if elapsed else 0.0,
+        "max_tracked_ips": max_tracked,
+        "alerts": detector.alerts_count,
+        "evicted": detector.evicted_count,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the sliding-window brute-force detector"
+    )
+    parser.add_argument(
+        "--events", help="Number of login POSTs", type=int, default=1000000
+    )
+    parser.add_argument(
+        "--ips", help="Number of distinct IPs", type=int, default=200000
+    )
+    parser.add_argument(
+        "--threshold", "-n", help="Alert threshold", type=int, default=20
+    )
+    parser.add_argument(
+        "--window", "-t", help="Window in seconds", type=float, default=60
+    )
+    args = parser.parse_args()
+    results = benchmark(args.events, args.ips, args.threshold, args.window)
+    for key, value in results.items():
+        print("{}: {}".format(key, value))
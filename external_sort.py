@@ -0,0 +1,154 @@
+import heapq
+import os
+import pickle
+import shutil
+import tempfile
+from itertools import groupby, islice
+
+# Items sorted in memory before a run is spilled to disk
+BUFFER_SIZE = 100000
+# Items pickled together, fewer and larger pickles are faster to load
+SPILL_BATCH_SIZE = 1000
+# Most runs merged at once, each open run holds a file and a batch in memory
+MERGE_FAN_IN = 64
+
+
+def write_run(items, file_name):
+    """
+    Spill a sorted run to a file
+    @param items: Sorted items, consumed lazily
+    @type items: collections.Iterable
+    @param file_name: Run file
+    @type file_name: str
+    """
+    items = iter(items)
+    with open(file_name, "wb") as f:
+        batch = list(islice(items, SPILL_BATCH_SIZE))
+        while batch:
+            pickle.dump(batch, f, protocol=pickle.HIGHEST_PROTOCOL)
+            batch = list(islice(items, SPILL_BATCH_SIZE))
+
+
+def read_run(file_name):
+    """
+    Stream the items of a spilled run
+    @param file_name: Run file
+    @type file_name: str
+    @rtype: collections.Iterable
+    """
+    with open(file_name, "rb") as f:
+        while True:
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                return
+            yield from batch
+
+
+class ExternalSorter(object):
+    """
+    Sorts more items than fit in memory: sorted runs of buffer_size items are spilled to
+    temporary files and k-way merged. At most fan_in runs are merged at once, so open
+    files and merge buffers stay bounded; more runs are first merged in groups into
+    longer runs. The sort is stable like sorted().
+    """
+
+    def __init__(self, key, buffer_size=BUFFER_SIZE, temp_dir=None, fan_in=None):
+        """
+        @param key: Sort key of an item
+        @type key: callable
+        @param buffer_size: Items sorted in memory before a run is spilled
+        @type buffer_size: int
+        @param temp_dir: Directory for run files, defaults to the system temp directory
+        @type temp_dir: str | None
+        @param fan_in: Most runs merged at once, by default as many as keep the merge
+            buffers within buffer_size items, up to MERGE_FAN_IN
+        @type fan_in: int | None
+        """
+        self.key = key
+        self.buffer_size = buffer_size
+        self.temp_dir = temp_dir
+        if fan_in is None:
+            fan_in = min(MERGE_FAN_IN, buffer_size // SPILL_BATCH_SIZE)
+        self.fan_in = max(2, fan_in)
+        self.runs = 0
+        self.merge_passes = 0
+        self.items = 0
+
+    def __repr__(self):
+        """
+        String representation
+        @rtype: str
+        """
+        return "<{} buffer_size={} runs={} items={}>".format(
+            self.__class__.__name__, self.buffer_size, self.runs, self.items
+        )
+
+    def sort(self, items):
+        """
+        Sort items, run files are removed once the result is consumed or closed
+        @param items: Items to sort, consumed lazily
+        @type items: collections.Iterable
+        @return: Sorted items
+        @rtype: collections.Iterable
+        """
+        items = iter(items)
+        buffer = list(islice(items, self.buffer_size))
+        self.items = len(buffer)
+        if len(buffer) < self.buffer_size:
+            # Fits in memory, nothing to spill
+            buffer.sort(key=self.key)
+            yield from buffer
+            return
+
+        run_dir = tempfile.mkdtemp(prefix="log_processor_sort_", dir=self.temp_dir)
+        try:
+            run_files = list()
+            while buffer:
+                buffer.sort(key=self.key)
+                run_file = os.path.join(run_dir, "run{}".format(len(run_files)))
+                write_run(buffer, run_file)
+                run_files.append(run_file)
+                buffer = list(islice(items, self.buffer_size))
+                self.items += len(buffer)
+            self.runs = len(run_files)
+            merged = 0
+            while len(run_files) > self.fan_in:
+                # Consecutive groups keep equal items in input order
+                merged_files = list()
+                for offset in range(0, len(run_files), self.fan_in):
+                    group = run_files[offset : offset + self.fan_in]
+                    run_file = os.path.join(run_dir, "merged{}".format(merged))
+                    merged += 1
+                    write_run(self.merge(group), run_file)
+                    for file_name in group:
+                        os.remove(file_name)
+                    merged_files.append(run_file)
+                run_files = merged_files
+                self.merge_passes += 1
+            yield from self.merge(run_files)
+        finally:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+    def merge(self, run_files):
+        """
+        k-way merge of sorted runs
+        @param run_files: Run files in input order
+        @type run_files: list[str]
+        @rtype: collections.Iterable
+        """
+        # heapq.merge() yields equal items in run order, which keeps the sort stable
+        return heapq.merge(*map(read_run, run_files), key=self.key)
+
+
+def group_sorted(items, key):
+    """
+    Group consecutive items of a sorted stream without loading a group into memory
+    @param items: Items sorted so that items of a group are consecutive
+    @type items: collections.Iterable
+    @param key: Group key of an item
+    @type key: callable
+    @return: (group key, iterator over the group) pairs
+    @rtype: collections.Iterable
+    """
+    return groupby(items, key=key)
@@ -0,0 +1,138 @@
+import ipaddress
+import socket
+
+
+def parse_ip(ip_address):
+    """
+    Convert an IP address to an integer
+    @param ip_address: IPv4 or IPv6 address
+    @type ip_address: str
+    @return: Address length in bits (32 or 128) and address as integer, None if not an IP address
+    @rtype: (int, int) | None
+    """
+    try:
+        return 32, int.from_bytes(socket.inet_pton(socket.AF_INET, ip_address), "big")
+    except OSError:
+        pass
+    try:
+        return 128, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip_address), "big")
+    except OSError:
+        return None
+
+
+def get_prefix(ip_address, ipv4_length, ipv6_length):
+    """
+    Network an IP address belongs to
+    @param ip_address: IPv4 or IPv6 address
+    @type ip_address: str
+    @param ipv4_length: Prefix length for IPv4 addresses
+    @type ipv4_length: int
+    @param ipv6_length: Prefix length for IPv6 addresses
+    @type ipv6_length: int
+    @return: Network in CIDR notation, None if not an IP address
+    @rtype: str | None
+    """
+    parsed = parse_ip(ip_address)
+    if parsed is None:
+        return None
+    bits, value = parsed
+    length = ipv4_length if bits == 32 else ipv6_length
+    network = value >> (bits - length) << (bits - length)
+    return str(ipaddress.ip_network((network, length)))
+
+
+class PrefixTrie(object):
+    """
+    Binary radix trie of IPv4 and IPv6 networks, lookups take O(prefix length)
+    """
+
+    def __init__(self, networks=None):
+        """
+        @param networks: Networks in CIDR notation to insert
+        @type networks: collections.Iterable[str] | None
+        """
+        # Node: [child for bit 0, child for bit 1, network if a prefix ends here]
+        self.roots = {32: [None, None, None], 128: [None, None, None]}
+        self.size = 0
+        for network in networks or []:
+            self.insert(network)
+
+    def __repr__(self):
+        """
+        String representation
+        @rtype: str
+        """
+        return "<{} networks={}>".format(self.__class__.__name__, self.size)
+
+    def __len__(self):
+        """
+        Number of inserted networks
+        @rtype: int
+        """
+        return self.size
+
+    def __contains__(self, ip_address):
+        """
+        Is the IP address in any inserted network
+        @param ip_address: IP address
+        @type ip_address: str
+        @rtype: bool
+        """
+        return self.lookup(ip_address) is not None
+
+    def insert(self, network):
+        """
+        Insert a network
+        @param network: Network in CIDR notation, a single address is a /32 or /128
+        @type network: str
+        """
+        parsed = ipaddress.ip_network(network.strip(), strict=False)
+        bits = parsed.max_prefixlen
+        value = int(parsed.network_address)
+        node = self.roots[bits]
+        for position in range(bits - 1, bits - 1 - parsed.prefixlen, -1):
+            bit = (value >> position) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[2] is None:
+            self.size += 1
+        node[2] = str(parsed)
+
+    def lookup(self, ip_address):
+        """
+        Longest inserted network containing an IP address
+        @param ip_address: IP address
+        @type ip_address: str
+        @return: Network in CIDR notation or None
+        @rtype: str | None
+        """
+        parsed = parse_ip(ip_address)
+        if parsed is None:
+            return None
+        bits, value = parsed
+        node = self.roots[bits]
+        found = node[2]
+        for position in range(bits - 1, -1, -1):
+            node = node[(value >> position) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                found = node[2]
+        return found
+
+
+def load_prefix_trie(file_name):
+    """
+    Read networks, one per line, "#" starts a comment
+    @param file_name: File with networks in CIDR notation
+    @type file_name: str
+    @rtype: PrefixTrie
+    """
+    trie = PrefixTrie()
+    with open(file_name, "r") as f:
+        for line in f:
+            network = line.split("#", 1)[0].strip()
+            if network:
+                trie.insert(network)
+    return trie
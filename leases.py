@@ -0,0 +1,172 @@
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, DateTime, Integer, String
+from sqlalchemy.exc import IntegrityError
+
+from database import BaseProcessor, processor_db_session, run_with_retry
+
+# Seconds a lease is held without being renewed, and a finished file stays claimed
+LEASE_SECONDS = 3600
+
+
+class FileLease(BaseProcessor):
+    """
+    Claim of a log file by one ingest run, so concurrent runs parse different files
+    """
+
+    __tablename__ = "file_leases"
+    id = Column(Integer, primary_key=True)
+    file_name = Column(String(1000), unique=True)
+    owner = Column(String(200))
+    expires = Column(DateTime)
+    finished = Column(DateTime)
+
+    def __init__(self, file_name, owner, expires):
+        """
+        @param file_name: Absolute path of the claimed file
+        @type file_name: str
+        @param owner: Run holding the lease
+        @type owner: str
+        @param expires: Other runs may take over the file after this datetime
+        @type expires: datetime
+        """
+        self.file_name = file_name
+        self.owner = owner
+        self.expires = expires
+        self.finished = None
+
+    def __repr__(self):
+        """
+        String representation
+        @rtype: str
+        """
+        return "<{} {}>".format(self.__class__.__name__, self.__dict__)
+
+
+def get_owner():
+    """
+    Unique name of this run
+    @rtype: str
+    """
+    return "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+class FileLeases(object):
+    """
+    Leases held by this run. Files are claimed one at a time right before they are
+    parsed, so overlapping runs spread over the files of a glob. Leases of a run that
+    died expire after lease_seconds, finished files stay claimed as long so an
+    overlapping run doesn't parse them again.
+    """
+
+    def __init__(self, lease_seconds=LEASE_SECONDS, owner=None):
+        """
+        @param lease_seconds: Lease duration, longer than parsing a single file takes
+        @type lease_seconds: int
+        @param owner: Name of this run, generated if None
+        @type owner: str | None
+        """
+        self.duration = timedelta(seconds=lease_seconds)
+        self.owner = owner or get_owner()
+        self.claimed = list()
+        self.skipped = list()
+
+    def __repr__(self):
+        """
+        String representation
+        @rtype: str
+        """
+        return "<{} {} claimed={} skipped={}>".format(
+            self.__class__.__name__, self.owner, len(self.claimed), len(self.skipped)
+        )
+
+    def claim(self, file_name):
+        """
+        Lease a file unless another run holds an unexpired lease on it
+        @param file_name: Log file
+        @type file_name: str
+        @return: Was the file claimed
+        @rtype: bool
+        """
+        file_name = os.path.abspath(file_name)
+        now = datetime.now()
+
+        def take():
+            FileLease.query.filter(
+                FileLease.file_name == file_name, FileLease.expires < now
+            ).delete()
+            processor_db_session.add(
+                FileLease(file_name, self.owner, now + self.duration)
+            )
+            processor_db_session.commit()
+
+        try:
+            run_with_retry(take, processor_db_session)
+        except IntegrityError:
+            processor_db_session.rollback()
+            self.skipped.append(file_name)
+            return False
+        self.claimed.append(file_name)
+        return True
+
+    def renew(self):
+        """
+        Extend all leases of this run
+        """
+
+        def extend():
+            FileLease.query.filter(FileLease.owner == self.owner).update(
+                {FileLease.expires: datetime.now() + self.duration}
+            )
+            processor_db_session.commit()
+
+        run_with_retry(extend, processor_db_session)
+
+    def finish(self, file_name):
+        """
+        Mark a file as parsed and saved, it stays claimed for another lease period
+        @param file_name: Claimed log file
+        @type file_name: str
+        """
+        now = datetime.now()
+
+        def mark():
+            FileLease.query.filter(
+                FileLease.file_name == os.path.abspath(file_name),
+                FileLease.owner == self.owner,
+            ).update({FileLease.finished: now, FileLease.expires: now + self.duration})
+            processor_db_session.commit()
+
+        run_with_retry(mark, processor_db_session)
+
+    def release(self):
+        """
+        Drop leases of files this run didn't finish, so another run can take them
+        """
+
+        def drop():
+            FileLease.query.filter(
+                FileLease.owner == self.owner, FileLease.finished.is_(None)
+            ).delete()
+            processor_db_session.commit()
+
+        run_with_retry(drop, processor_db_session)
+
+    def claim_files(self, file_names):
+        """
+        Claim files lazily, renewing held leases before every next file
+        @param file_names: Files to parse
+        @type file_names: collections.Iterable[str]
+        @return: Claimed files
+        @rtype: collections.Iterable[str]
+        """
+        for file_name in file_names:
+            if self.claimed:
+                self.renew()
+            if self.claim(file_name):
+                yield file_name
+            else:
+                print("Skipping {}, leased by another run".format(file_name))
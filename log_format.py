@@ -0,0 +1,201 @@
+import re
+
+# Named formats, as shipped in the default Apache2 and nginx configurations
+FORMATS = {
+    "combined": '%h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-Agent}i"',
+    "common": '%h %l %u %t "%r" %>s %b',
+    "vhost_combined": '%v:%p %h %l %u %t "%r" %>s %O "%{Referer}i" "%{User-Agent}i"',
+    "nginx": '$remote_addr - $remote_user [$time_local] "$request" $status '
+    '$body_bytes_sent "$http_referer" "$http_user_agent"',
+}
+APACHE_DIRECTIVE = re.compile(r"%(?:\{([^}]*)\})?[<>]?([a-zA-Z%])")
+NGINX_VARIABLE = re.compile(r"\$([a-z0-9_]+)")
+# Value between double quotes, Apache and nginx escape quotes inside it
+QUOTED = r'(?:[^"\\]|\\.)*'
+NUMBER_OR_DASH = r"\d+|-"
+# Fields log_processor.parse_record() needs, with the directives providing them
+REQUIRED_FIELDS = {
+    "source_ip": "client address (%h, $remote_addr)",
+    "timestamp": "time (%t, $time_local)",
+    "request": "request line (%r, $request)",
+    "status_code": "status (%>s, $status)",
+}
+# Apache directives whose value is written between square brackets
+BRACKETED = {"t"}
+
+# Apache directive (with its {argument} if it matters) to (field, pattern)
+APACHE_FIELDS = {
+    "h": ("source_ip", r"\S+"),
+    "a": ("source_ip", r"\S+"),
+    "t": ("timestamp", r"[^\]]+"),
+    "r": ("request", QUOTED),
+    "s": ("status_code", r"\d{3}"),
+    "b": ("bytes_sent", NUMBER_OR_DASH),
+    "B": ("bytes_sent", NUMBER_OR_DASH),
+    "O": ("bytes_sent", NUMBER_OR_DASH),
+    "D": ("duration_us", r"\d+"),
+    "T": ("duration_s", r"\d+"),
+    "{ms}T": ("duration_ms", r"\d+"),
+    "{us}T": ("duration_us", r"\d+"),
+    "{Referer}i": (None, QUOTED),
+    "{User-Agent}i": ("user_agent", QUOTED),
+    "v": (None, r"\S+?"),
+    "p": (None, r"\d+"),
+    "%": (None, "%"),
+}
+NGINX_FIELDS = {
+    "remote_addr": ("source_ip", r"\S+"),
+    "time_local": ("timestamp", r"[^\]]+"),
+    "request": ("request", QUOTED),
+    "status": ("status_code", r"\d{3}"),
+    "body_bytes_sent": ("bytes_sent", NUMBER_OR_DASH),
+    "bytes_sent": ("bytes_sent", NUMBER_OR_DASH),
+    "request_time": ("duration_s", r"[\d.]+"),
+    "http_user_agent": ("user_agent", QUOTED),
+}
+
+
+def get_field_pattern(field, pattern, quoted, used):
+    """
+    Regex of a single directive, capturing it if it is a field we keep
+    @param field: Field name or None if the value is skipped
+    @type field: str | None
+    @param pattern: Regex of the value, None for unknown directives
+    @type pattern: str | None
+    @param quoted: Is the value between double quotes
+    @type quoted: bool
+    @param used: Fields captured so far, only the first occurrence is captured
+    @type used: set
+    @rtype: str
+    """
+    if pattern is None:
+        pattern = QUOTED if quoted else r"\S*"
+    if field is None or field in used:
+        return "(?:{})".format(pattern)
+    used.add(field)
+    return "(?P<{}>{})".format(field, pattern)
+
+
+def compile_format(spec):
+    """
+    Compile an Apache LogFormat string or an nginx log_format string into a regex
+    @param spec: Format name from FORMATS or a format string
+    @type spec: str
+    @rtype: re.Pattern
+    """
+    spec = FORMATS.get(spec, spec)
+    nginx = "$" in spec and "%" not in spec
+    directives = NGINX_VARIABLE if nginx else APACHE_DIRECTIVE
+    parts = list()
+    used = set()
+    position = 0
+    for match in directives.finditer(spec):
+        literal = spec[position : match.start()]
+        parts.append(re.escape(literal))
+        quoted = literal.endswith('"')
+        bracketed = False
+        if nginx:
+            field, pattern = NGINX_FIELDS.get(match.group(1), (None, None))
+        else:
+            argument, directive = match.group(1), match.group(2)
+            key = "{{{}}}{}".format(argument, directive) if argument else directive
+            field, pattern = APACHE_FIELDS.get(key, (None, None))
+            bracketed = key in BRACKETED
+        if bracketed:
+            parts.append(r"\[")
+        parts.append(get_field_pattern(field, pattern, quoted, used))
+        if bracketed:
+            parts.append(r"\]")
+        position = match.end()
+    parts.append(re.escape(spec[position:]))
+    missing = [name for field, name in REQUIRED_FIELDS.items() if field not in used]
+    if missing:
+        raise ValueError(
+            "Log format '{}' lacks the {}".format(spec, ", ".join(missing))
+        )
+    return re.compile("".join(parts))
+
+
+def get_ip_field(spec):
+    """
+    Position of the client address among the space separated fields of a line, for
+    sampling by IP before a line is parsed
+    @param spec: Format name from FORMATS or a format string
+    @type spec: str
+    @return: Field index, None if a field before it may contain spaces
+    @rtype: int | None
+    """
+    spec = FORMATS.get(spec, spec)
+    nginx = "$" in spec and "%" not in spec
+    directives = NGINX_VARIABLE if nginx else APACHE_DIRECTIVE
+    for match in directives.finditer(spec):
+        if nginx:
+            field, pattern = NGINX_FIELDS.get(match.group(1), (None, None))
+        else:
+            argument, directive = match.group(1), match.group(2)
+            key = "{{{}}}{}".format(argument, directive) if argument else directive
+            field, pattern = APACHE_FIELDS.get(key, (None, None))
+        if field == "source_ip":
+            prefix = spec[: match.start()]
+            return None if '"' in prefix or "[" in prefix else prefix.count(" ")
+        if field == "timestamp" or pattern == QUOTED:
+            # Values that may contain spaces, unknown directives outside quotes don't
+            return None
+    return None
+
+
+class LogFormat(object):
+    """
+    Parser of access log lines specialised for one log format, compiled once
+    """
+
+    def __init__(self, spec="combined"):
+        """
+        @param spec: Format name from FORMATS, Apache LogFormat or nginx log_format string
+        @type spec: str
+        """
+        self.spec = spec
+        self.pattern = compile_format(spec)
+        self.ip_field = get_ip_field(spec)
+        self._match = self.pattern.match
+
+    def __repr__(self):
+        """
+        String representation
+        @rtype: str
+        """
+        return "<{} {}>".format(self.__class__.__name__, self.spec)
+
+    def parse(self, line):
+        """
+        Extract fields of a log line
+        @param line: Log line
+        @type line: str
+        @return: Dict with source_ip, method, url, status_code, timestamp, user_agent,
+            bytes_sent and duration_us, None if the line doesn't match the format
+        @rtype: dict | None
+        """
+        match = self._match(line)
+        if match is None:
+            return None
+        fields = match.groupdict()
+        method, _, target = fields.pop("request").partition(" ")
+        fields["method"] = method if method.isalpha() and method.isupper() else None
+        url = target.split(" ", 1)[0]
+        fields["url"] = url if url.startswith("/") else None
+        status_code = fields.get("status_code")
+        fields["status_code"] = int(status_code) if status_code else None
+        bytes_sent = fields.get("bytes_sent")
+        fields["bytes_sent"] = (
+            int(bytes_sent) if bytes_sent and bytes_sent != "-" else None
+        )
+        duration_us = fields.get("duration_us")
+        if duration_us is not None:
+            fields["duration_us"] = int(duration_us)
+        elif "duration_ms" in fields:
+            fields["duration_us"] = int(fields.pop("duration_ms")) * 1000
+        elif "duration_s" in fields:
+            fields["duration_us"] = int(float(fields.pop("duration_s")) * 1000000)
+        else:
+            fields["duration_us"] = None
+        return fields
@@ -1,15 +1,44 @@
 import argparse
+import atexit
 import glob
 import re
+import sys
+import time
 from datetime import datetime
 from enum import Enum
-from os.path import isfile
+from contextlib import nullcontext, redirect_stdout
+from functools import lru_cache, partial
+from itertools import chain, islice
+from operator import itemgetter
 from pprint import pprint as pp
+from profiling import Profiler
 
 from sqlalchemy import Column, Integer, String, DateTime
-from database import BaseProcessor, processor_db_session, init_db, PROCESSOR_DB_FILE
+from database import BaseProcessor, processor_db_session, init_db, run_with_retry
+from detector import BruteForceDetector
+from external_sort import BUFFER_SIZE as SORT_BUFFER_SIZE, ExternalSorter, group_sorted
+from ip_trie import load_prefix_trie
+from leases import LEASE_SECONDS, FileLeases
+from log_format import FORMATS, LogFormat
+from memory import MemoryBudget, parse_size
+from pipeline import Pipeline
+from query_cache import bump_generation
+from routes import get_route, intern_routes, load_route_templates, set_route_templates
+from sampling import Sampler
+from shards import ShardRouter, get_router, set_router
+from sinks import SINKS, get_sink
+from sketches import build_sketches, save_sketches
+from stats import Stats
+from tail import LogFollower
+from user_agents import classify_user_agent
 
 LOGIN_PAGE = "wp-login.php"
+DATETIME_FORMAT = "%d/%b/%Y:%H:%M:%S %z"
+SOURCE_IP_PATTERN = re.compile(r"^(\d+.\d+.\d+.\d+|[0-9a-fA-F]{0,4}:[0-9a-fA-F:.]+)")
+# Lines read from a file at once
+READ_CHUNK_LINES = 1000
+# Stages profiled with --profile, parse_line() wraps parse_record() for API callers
+PROFILED_FUNCTIONS = ["parse_line", "parse_record", "get_datetime", "to_datetime"]
 
 
 class EventType(Enum):
@@ -31,6 +60,27 @@ class EventType(Enum):
     options = 7
 
 
+# Keys of records returned by parse_record(), in Event column order, route is
+# stored as route_id
+RECORD_FIELDS = [
+    "source_ip",
+    "event_type",
+    "status_code",
+    "user_agent",
+    "url",
+    "date_time",
+    "log_line",
+    "bytes_sent",
+    "duration_us",
+    "ua_class",
+    "sample_rate",
+    "ip_sample_rate",
+    "route",
+]
+# Bytes a raw line must contain to possibly match an EventType, checked before decoding
+REQUIRED_BYTES = {EventType.post_login: (b'"POST', LOGIN_PAGE.encode("ascii"))}
+
+
 class Event(BaseProcessor):
     """
     Event extracted from (access) log file
@@ -45,15 +95,39 @@ class Event(BaseProcessor):
     url = Column(String(1000))
     date_time = Column(DateTime)
     log_line = Column(String(1000))
+    bytes_sent = Column(Integer)
+    duration_us = Column(Integer)
+    ua_class = Column(Integer)
+    route_id = Column(Integer, index=True)
+    # Number of events of its IP this one stands for when lines were sampled, None if not
+    sample_rate = Column(Integer)
+    # Its IP was kept as 1 in ip_sample_rate IPs with all its events, None if IPs weren't
+    # sampled; only totals over IPs are scaled by it
+    ip_sample_rate = Column(Integer)
+    # Normalised URL of parsed events, interned into route_id when saved
+    route = None
 
     def __init__(
-        self, source_ip, event_type, status_code, user_agent, url, date_time, log_line
+        self,
+        source_ip,
+        event_type,
+        status_code,
+        user_agent,
+        url,
+        date_time,
+        log_line,
+        bytes_sent=None,
+        duration_us=None,
+        ua_class=None,
+        sample_rate=None,
+        ip_sample_rate=None,
+        route=None,
     ):
         """
         @param source_ip: Source IPv4 address
         @type source_ip: str
         @param event_type: Type of event
-        @type event_type: EventType
+        @type event_type: EventType | str | None
         @param status_code: Status code
         @type status_code: int
         @param user_agent: User agent string
@@ -64,14 +138,38 @@ class Event(BaseProcessor):
         @type date_time: datetime
         @param log_line: Parsed log line
         @type log_line: str
+        @param bytes_sent: Response size, if the log format has it
+        @type bytes_sent: int | None
+        @param duration_us: Time taken to serve the request in microseconds, if the log format has it
+        @type duration_us: int | None
+        @param ua_class: UserAgentClass value of user_agent, classified if None
+        @type ua_class: int | None
+        @param sample_rate: Line sampling rate the event was kept with, None if lines
+            weren't sampled
+        @type sample_rate: int | None
+        @param ip_sample_rate: IP sampling rate the event's IP was kept with, None if IPs
+            weren't sampled
+        @type ip_sample_rate: int | None
+        @param route: Normalised URL, derived from url if None
+        @type route: str | None
         """
         self.source_ip = source_ip
-        self.event_type = event_type.name if event_type is not None else None
+        self.event_type = (
+            event_type.name if isinstance(event_type, EventType) else event_type
+        )
         self.status_code = status_code
         self.user_agent = user_agent
         self.url = url
         self.date_time = date_time
         self.log_line = log_line
+        self.bytes_sent = bytes_sent
+        self.duration_us = duration_us
+        self.ua_class = (
+            classify_user_agent(user_agent) if ua_class is None else ua_class
+        )
+        self.sample_rate = sample_rate
+        self.ip_sample_rate = ip_sample_rate
+        self.route = get_route(url) if route is None else route
 
     def __repr__(self):
         """
@@ -80,28 +178,47 @@ class Event(BaseProcessor):
         """
         return "<{} {}>".format(self.__class__.__name__, self.__dict__)
 
+    def to_record(self):
+        """
+        Plain record with the same keys parse_record() returns
+        @rtype: dict
+        """
+        return {field: getattr(self, field) for field in RECORD_FIELDS}
+
     def save(self):
         """
         Persist in DB
         @rtype: Event
         """
         print(".", end="")
+        intern_routes([self])
         processor_db_session.add(self)
         processor_db_session.commit()
+        bump_generation()
         return self
 
     @staticmethod
     def save_all(events_to_save):
         """
-        Persist all passed Event objects
+        Persist all passed Event objects, into shard files if sharding is configured
         @param events_to_save: List of Event objects to save
         @type events_to_save: list[Event]
         @rtype: bool
         """
         if events_to_save:
             print("Saving {} Events".format(len(events_to_save)))
-            processor_db_session.add_all(events_to_save)
-            processor_db_session.commit()
+            intern_routes(events_to_save)
+            router = get_router()
+            if router is not None:
+                router.save(events_to_save)
+            else:
+
+                def write():
+                    processor_db_session.add_all(events_to_save)
+                    processor_db_session.commit()
+
+                run_with_retry(write, processor_db_session)
+            bump_generation()
             return True
         else:
             return False
@@ -114,41 +231,63 @@ class Event(BaseProcessor):
         try:
             processor_db_session.delete(self)
             processor_db_session.commit()
+            bump_generation()
         except Exception as e:
             print("Error '{}' when deleting {}".format(e, self))
             return False
         return True
 
 
-def get_datetime(line):
+@lru_cache(maxsize=4096)
+def parse_timestamp(value):
+    """
+    Parse Apache timestamp, cached since consecutive lines share the same second
+    @param value: Timestamp between square brackets
+    @type value: str
+    @rtype: datetime
+    """
+    return datetime.strptime(value, DATETIME_FORMAT)
+
+
+def get_datetime(line, stats=None):
     """
     Extracts datetime value from string
     @param line:
+    @param stats: Instrumentation to count parse errors in
+    @type stats: Stats | None
     @rtype: datetime | None
     """
     date_time = datetime.now()
-    form = "%d/%b/%Y:%H:%M:%S %z"
     split_line = line.split("[")
     if len(split_line) > 1:
         split_line = split_line[1].split("]")
-        try:
-            date_time = datetime.strptime(split_line[0], form)
-        except ValueError as e:
-            print(
-                "Error '{}' parsing string '{}' to datetime using format '{}'".format(
-                    e, split_line[0], form
-                )
-            )
-        except Exception as e:
-            print(
-                "Error '{}' parsing string '{}' to datetime using format '{}'".format(
-                    e, split_line[0], form
-                )
-            )
+        date_time = to_datetime(split_line[0], stats) or date_time
 
     return date_time
 
 
+def to_datetime(value, stats=None):
+    """
+    Parse a timestamp, errors are printed and counted
+    @param value: Timestamp in DATETIME_FORMAT
+    @type value: str
+    @param stats: Instrumentation to count parse errors in
+    @type stats: Stats | None
+    @rtype: datetime | None
+    """
+    try:
+        return parse_timestamp(value)
+    except Exception as e:
+        print(
+            "Error '{}' parsing string '{}' to datetime using format '{}'".format(
+                e, value, DATETIME_FORMAT
+            )
+        )
+        if stats is not None:
+            stats.incr("datetime_errors")
+    return None
+
+
 def get_method(line):
     """
     Extracts HTTP method
@@ -166,12 +305,12 @@ def get_method(line):
 
 def get_source_ip(line):
     """
-    Extracts source IPv4 address from line
+    Extracts source IPv4 or IPv6 address from line
     @param line: Log line to extract from
     @type line: str
     @rtype: str
     """
-    search_result = re.search(r"^\d+.\d+.\d+.\d+", line)
+    search_result = SOURCE_IP_PATTERN.search(line)
     return search_result.group(0) if search_result else ""
 
 
@@ -275,78 +414,325 @@ def is_login_page(line):
     return LOGIN_PAGE in get_url(line)
 
 
-def parse_line(line, event_type=None):
+def classify(post, get, head, options, login_page, status_code):
+    """
+    Determine EventType of a request
+    @param post: Was it a POST request
+    @type post: bool
+    @param get: Was it a GET request
+    @type get: bool
+    @param head: Was it a HEAD request
+    @type head: bool
+    @param options: Was it an OPTIONS request
+    @type options: bool
+    @param login_page: Was it a login page
+    @type login_page: bool
+    @param status_code: Status code
+    @type status_code: int
+    @rtype: EventType | None
+    """
+    # TODO: add all event types smarter
+    for e in EventType:
+        if e == EventType.post_login:
+            if post and login_page:
+                return e
+        elif e == EventType.get_login:
+            if get and login_page:
+                return e
+        elif e == EventType.post_4xx:
+            if post and (400 <= status_code < 500):
+                return e
+        elif e == EventType.get_4xx:
+            if get and (400 <= status_code < 500):
+                return e
+        elif e == EventType.post:
+            if post:
+                return e
+        elif e == EventType.get:
+            if get:
+                return e
+        elif e == EventType.head:
+            if head:
+                return e
+        elif e == EventType.options:
+            if options:
+                return e
+    return None
+
+
+def parse_record(line, event_type=None, stats=None, allowlist=None, log_format=None):
+    """
+    Parse a single line into a plain record, without creating an Event
+    @param line: A single line to parse
+    @type line: str
+    @param event_type: EventType we look for
+    @type event_type: EventType | None
+    @param stats: Instrumentation to record stage timings in
+    @type stats: Stats | None
+    @param allowlist: Networks whose requests are dropped before further parsing
+    @type allowlist: PrefixTrie | None
+    @param log_format: Compiled log format, lines are parsed as combined format if None
+    @type log_format: LogFormat | None
+    @return: Dict with RECORD_FIELDS as keys, event_type is an EventType name
+    @rtype: dict | None
+    """
+    if stats is not None:
+        started = time.perf_counter()
+    record = None
+    fields = None
+    if log_format is not None:
+        fields = log_format.parse(line)
+        if fields is None:
+            if stats is not None:
+                stats.incr("format_mismatches")
+            return None
+        source_ip = fields["source_ip"]
+    else:
+        source_ip = get_source_ip(line)
+    if allowlist is not None and source_ip in allowlist:
+        if stats is not None:
+            stats.incr("allowlisted")
+        return None
+    if fields is not None:
+        method = fields["method"]
+        post = method == "POST"
+        get = method == "GET"
+        head = method == "HEAD"
+        options = method == "OPTIONS"
+        status_code = fields["status_code"]
+        user_agent = fields.get("user_agent") or "NO USER AGENT"
+        url = fields["url"] or "NO URL FOUND"
+        login_page = LOGIN_PAGE in url
+        bytes_sent = fields["bytes_sent"]
+        duration_us = fields["duration_us"]
+    else:
+        post = is_post(line)
+        get = is_get(line)
+        head = is_head(line)
+        options = is_options(line)
+        status_code = get_status_code(line)
+        user_agent = get_user_agent(line)
+        url = get_url(line)
+        login_page = is_login_page(line)
+        bytes_sent = duration_us = None
+    if stats is not None:
+        extracted = time.perf_counter()
+        stats.add_time("parse", extracted - started)
+    if fields is not None:
+        date_time = to_datetime(fields["timestamp"], stats) or datetime.now()
+    else:
+        date_time = get_datetime(line, stats)
+    if stats is not None:
+        parsed = time.perf_counter()
+        stats.add_time("datetime", parsed - extracted)
+
+    if event_type is not None:
+        if event_type == EventType.post_login and post and login_page:
+            classified = event_type
+        else:
+            classified = False
+    else:
+        classified = classify(post, get, head, options, login_page, status_code)
+        if stats is not None and classified is None:
+            stats.incr("unclassified")
+    if classified is not False:
+        record = {
+            "source_ip": source_ip,
+            "event_type": classified.name if classified is not None else None,
+            "status_code": status_code,
+            "user_agent": user_agent,
+            "url": url,
+            "date_time": date_time,
+            "log_line": line,
+            "bytes_sent": bytes_sent,
+            "duration_us": duration_us,
+            "ua_class": classify_user_agent(user_agent),
+            "sample_rate": None,
+            "ip_sample_rate": None,
+            "route": get_route(url),
+        }
+
+    if stats is not None:
+        stats.add_time("classify", time.perf_counter() - parsed)
+    return record
+
+
+def parse_line(line, event_type=None, stats=None, allowlist=None, log_format=None):
     """
     Parse a single line to extract a possible match on event_type
     @param line: A single line to parse
     @type line: str
     @param event_type: EventType we look for
     @type event_type: EventType | None
+    @param stats: Instrumentation to record stage timings in
+    @type stats: Stats | None
+    @param allowlist: Networks whose requests are dropped before further parsing
+    @type allowlist: PrefixTrie | None
+    @param log_format: Compiled log format, lines are parsed as combined format if None
+    @type log_format: LogFormat | None
     @rtype: Event | None
     """
-    event = None
-    source_ip = get_source_ip(line)
-    post = is_post(line)
-    get = is_get(line)
-    head = is_head(line)
-    options = is_options(line)
-    status_code = get_status_code(line)
-    user_agent = get_user_agent(line)
-    url = get_url(line)
-    date_time = get_datetime(line)
-    login_page = is_login_page(line)
-
-    if event_type:
-        if event_type == EventType.post_login:
-            post = is_post(line)
-            login_page = is_login_page(line)
-            if post and login_page:
-                event = Event(
-                    source_ip, event_type, status_code, user_agent, url, date_time, line
-                )
-    else:
-        # TODO: add all event types smarter
-        for e in EventType:
-            if e == EventType.post_login:
-                if post and login_page:
-                    event_type = e
-                    break
-            elif e == EventType.get_login:
-                if get and login_page:
-                    event_type = e
-                    break
-            elif e == EventType.post_4xx:
-                if post and (400 <= status_code < 500):
-                    event_type = e
-                    break
-            elif e == EventType.get_4xx:
-                if get and (400 <= status_code < 500):
-                    event_type = e
-                    break
-            elif e == EventType.post:
-                if post:
-                    event_type = e
-                    break
-            elif e == EventType.get:
-                if get:
-                    event_type = e
-                    break
-            elif e == EventType.head:
-                if head:
-                    event_type = e
-                    break
-            elif e == EventType.options:
-                if options:
-                    event_type = e
-                    break
-        event = Event(
-            source_ip, event_type, status_code, user_agent, url, date_time, line
+    record = parse_record(line, event_type, stats, allowlist, log_format)
+    return Event(**record) if record is not None else None
+
+
+def decode_line(raw_line, stats=None):
+    """
+    Decode a line read in binary mode as UTF-8, invalid bytes are replaced instead of
+    aborting the run
+    @param raw_line: Line including its line break
+    @type raw_line: bytes
+    @param stats: Instrumentation to count invalid lines in
+    @type stats: Stats | None
+    @rtype: str
+    """
+    if raw_line.endswith(b"\r\n"):
+        raw_line = raw_line[:-2] + b"\n"
+    try:
+        return raw_line.decode("utf-8")
+    except UnicodeDecodeError:
+        if stats is not None:
+            stats.incr("invalid_utf8")
+        return raw_line.decode("utf-8", errors="replace")
+
+
+def parse_raw_record(
+    raw_line, event_type=None, stats=None, allowlist=None, log_format=None, sampler=None
+):
+    """
+    Parse a line read in binary mode into a plain record, lines that cannot match
+    event_type or are not sampled are skipped without decoding
+    @param raw_line: A single line to parse
+    @type raw_line: bytes
+    @param event_type: EventType we look for
+    @type event_type: EventType | None
+    @param stats: Instrumentation to record stage timings and invalid lines in
+    @type stats: Stats | None
+    @param allowlist: Networks whose requests are dropped before further parsing
+    @type allowlist: PrefixTrie | None
+    @param log_format: Compiled log format, lines are parsed as combined format if None
+    @type log_format: LogFormat | None
+    @param sampler: Sampling of lines, all lines are parsed if None
+    @type sampler: Sampler | None
+    @return: Dict with RECORD_FIELDS as keys
+    @rtype: dict | None
+    """
+    for required in REQUIRED_BYTES.get(event_type, ()):
+        if required not in raw_line:
+            return None
+    if sampler is not None:
+        if not sampler.keep(raw_line):
+            if stats is not None:
+                stats.incr("sampled_out")
+            return None
+        record = parse_record(
+            decode_line(raw_line, stats), event_type, stats, allowlist, log_format
         )
+        if record is not None:
+            # A kept IP has all its events, so only its share of all IPs is scaled
+            record["ip_sample_rate" if sampler.by_ip else "sample_rate"] = sampler.rate
+        return record
+    return parse_record(
+        decode_line(raw_line, stats), event_type, stats, allowlist, log_format
+    )
+
+
+def parse_raw_line(
+    raw_line, event_type=None, stats=None, allowlist=None, log_format=None, sampler=None
+):
+    """
+    Parse a line read in binary mode, lines that cannot match event_type are skipped
+    without decoding
+    @param raw_line: A single line to parse
+    @type raw_line: bytes
+    @param event_type: EventType we look for
+    @type event_type: EventType | None
+    @param stats: Instrumentation to record stage timings and invalid lines in
+    @type stats: Stats | None
+    @param allowlist: Networks whose requests are dropped before further parsing
+    @type allowlist: PrefixTrie | None
+    @param log_format: Compiled log format, lines are parsed as combined format if None
+    @type log_format: LogFormat | None
+    @param sampler: Sampling of lines, all lines are parsed if None
+    @type sampler: Sampler | None
+    @rtype: Event | None
+    """
+    record = parse_raw_record(
+        raw_line, event_type, stats, allowlist, log_format, sampler
+    )
+    return Event(**record) if record is not None else None
+
 
-    return event
+def persist_events(events, stats=None):
+    """
+    Save events and merge them into distinct-count sketches.
+    Sketches are built before the commit, which expires the events' attributes.
+    @param events: Events to persist
+    @type events: list[Event]
+    @param stats: Instrumentation to record commit latency in
+    @type stats: Stats | None
+    """
+    if stats is None:
+        sketches = build_sketches(events)
+        if Event.save_all(events):
+            run_with_retry(partial(save_sketches, sketches), processor_db_session)
+        return
+    started = time.perf_counter()
+    sketches = build_sketches(events)
+    sketched = time.perf_counter()
+    saved = Event.save_all(events)
+    committed = time.perf_counter()
+    if saved:
+        stats.add_commit(committed - sketched)
+        run_with_retry(partial(save_sketches, sketches), processor_db_session)
+    stats.add_time("persist", committed - sketched)
+    stats.add_time("sketch", sketched - started + time.perf_counter() - committed)
 
 
-def parse_file(file_name, event_type=None, save_to_db=False):
+def watch_caches(stats):
+    """
+    Report hit rates of the parsing caches in stats
+    @param stats: Instrumentation to report the caches in
+    @type stats: Stats | None
+    """
+    if stats is not None:
+        stats.watch_cache("timestamp", parse_timestamp)
+        stats.watch_cache("user_agent", classify_user_agent)
+        stats.watch_cache("route", get_route)
+
+
+def add_pipeline_metrics(stats, staged, stages=("read",)):
+    """
+    Add throughput, stage timings and queue metrics of a finished pipeline to stats
+    @param stats: Instrumentation to record the metrics in
+    @type stats: Stats | None
+    @param staged: Pipeline that has run
+    @type staged: Pipeline
+    @param stages: Pipeline stages whose time is added to the stats stages of the same name
+    @type stages: tuple[str]
+    """
+    if stats is None:
+        return
+    metrics = staged.metrics()
+    stats.incr("lines", staged.lines_count)
+    stats.incr("bytes", staged.bytes_count)
+    for stage in stages:
+        stats.add_time(stage, metrics["stage_seconds"][stage])
+    stats.sections["pipeline"] = metrics
+
+
+def parse_file(
+    file_name,
+    event_type=None,
+    save_to_db=False,
+    detector=None,
+    workers=0,
+    queue_size=8,
+    stats=None,
+    allowlist=None,
+    log_format=None,
+    sampler=None,
+):
     """
     Parse a given file and return list of dicts representing rows that matched a given EventType
     @param file_name: File or file mask to parse
@@ -355,30 +741,477 @@ def parse_file(file_name, event_type=None, save_to_db=False):
     @type event_type: EventType | None
     @param save_to_db: Save to DB?
     @type save_to_db: bool
+    @param detector: Brute-force detector to feed parsed events to
+    @type detector: BruteForceDetector | None
+    @param workers: Number of parser threads, 0 parses sequentially in the calling thread
+    @type workers: int
+    @param queue_size: Capacity of the pipeline queues in chunks of lines
+    @type queue_size: int
+    @param stats: Instrumentation to record throughput, stage timings and pipeline metrics in
+    @type stats: Stats | None
+    @param allowlist: Networks whose requests are dropped before persistence
+    @type allowlist: PrefixTrie | None
+    @param log_format: Compiled log format, lines are parsed as combined format if None
+    @type log_format: LogFormat | None
+    @param sampler: Sampling of lines, rejected lines are not parsed; all lines are
+        parsed if None
+    @type sampler: Sampler | None
     @rtype: list[Event]
     """
     matched_files = glob.glob(file_name)
     if not matched_files:
         raise ValueError("Cannot find file(s) '{}'".format(file_name))
 
-    result = list()
+    watch_caches(stats)
 
-    for file_name in matched_files:
-        with open(file_name, "r") as f:
-            for line in f:
-                parsed_event = parse_line(line, event_type)
-                if parsed_event:
-                    result.append(parsed_event)
+    if workers:
+        staged = Pipeline(
+            partial(
+                parse_raw_line,
+                event_type=event_type,
+                stats=stats,
+                allowlist=allowlist,
+                log_format=log_format,
+                sampler=sampler,
+            ),
+            partial(persist_events, stats=stats) if save_to_db else None,
+            workers=workers,
+            queue_size=queue_size,
+            on_events=(
+                partial(map_events, detector.observe_event)
+                if detector is not None
+                else None
+            ),
+        )
+        result, _ = staged.run(matched_files)
+        add_pipeline_metrics(stats, staged)
+        if stats is not None:
+            stats.incr("events", len(result))
+        return result
+
+    parse = partial(
+        parse_raw_line,
+        event_type=event_type,
+        stats=stats,
+        allowlist=allowlist,
+        log_format=log_format,
+        sampler=sampler,
+    )
+    result = list(
+        chain.from_iterable(
+            read_records(
+                matched_files,
+                parse,
+                detector.observe_event if detector is not None else None,
+                stats,
+            )
+        )
+    )
 
+    if stats is not None:
+        stats.incr("events", len(result))
     if save_to_db:
-        Event.save_all(result)
+        persist_events(result, stats)
 
     return result
 
 
+def ingest_file(
+    file_name,
+    max_memory,
+    event_type=None,
+    detector=None,
+    workers=0,
+    queue_size=8,
+    stats=None,
+    allowlist=None,
+    log_format=None,
+    sampler=None,
+):
+    """
+    Parse a given file and save events in batches sized to keep memory under a budget,
+    without keeping them
+    @param file_name: File or file mask to parse
+    @type file_name: str
+    @param max_memory: Memory budget in bytes
+    @type max_memory: int
+    @param event_type: EventType to look for
+    @type event_type: EventType | None
+    @param detector: Brute-force detector to feed parsed events to
+    @type detector: BruteForceDetector | None
+    @param workers: Number of parser threads, 0 parses sequentially in the calling thread
+    @type workers: int
+    @param queue_size: Capacity of the pipeline queues in chunks of lines
+    @type queue_size: int
+    @param stats: Instrumentation to record throughput, stage timings and memory use in
+    @type stats: Stats | None
+    @param allowlist: Networks whose requests are dropped before persistence
+    @type allowlist: PrefixTrie | None
+    @param log_format: Compiled log format, lines are parsed as combined format if None
+    @type log_format: LogFormat | None
+    @param sampler: Sampling of lines, all lines are parsed if None
+    @type sampler: Sampler | None
+    @return: Number of saved events and the budget with peak memory and batch sizes
+    @rtype: (int, MemoryBudget)
+    """
+    matched_files = glob.glob(file_name)
+    if not matched_files:
+        raise ValueError("Cannot find file(s) '{}'".format(file_name))
+
+    watch_caches(stats)
+    parse = partial(
+        parse_raw_line,
+        event_type=event_type,
+        stats=stats,
+        allowlist=allowlist,
+        log_format=log_format,
+        sampler=sampler,
+    )
+    budget = MemoryBudget(max_memory)
+
+    if workers:
+        staged = Pipeline(
+            parse,
+            partial(persist_events, stats=stats),
+            workers=workers,
+            queue_size=queue_size,
+            on_events=(
+                partial(map_events, detector.observe_event)
+                if detector is not None
+                else None
+            ),
+            budget=budget,
+        )
+        _, count = staged.run(matched_files, keep_results=False)
+        add_pipeline_metrics(stats, staged)
+    else:
+        count = 0
+        batch = list()
+        for events in read_records(
+            matched_files,
+            parse,
+            detector.observe_event if detector is not None else None,
+            stats,
+        ):
+            batch.extend(events)
+            if budget.should_flush(len(batch)):
+                persist_events(batch, stats)
+                budget.flushed(len(batch))
+                count += len(batch)
+                batch = list()
+        if batch:
+            persist_events(batch, stats)
+            budget.flushed(len(batch))
+            count += len(batch)
+
+    if stats is not None:
+        stats.incr("events", count)
+        stats.sections["memory"] = budget.metrics()
+    return count, budget
+
+
+def stream_file(
+    file_name,
+    sink,
+    event_type=None,
+    detector=None,
+    workers=0,
+    queue_size=8,
+    stats=None,
+    allowlist=None,
+    log_format=None,
+    sampler=None,
+):
+    """
+    Parse a given file and write records to a sink as they are parsed, in constant memory
+    and without creating Events
+    @param file_name: File or file mask to parse
+    @type file_name: str
+    @param sink: Output the records are written to
+    @type sink: sinks.Sink
+    @param event_type: EventType to look for
+    @type event_type: EventType | None
+    @param detector: Brute-force detector to feed parsed records to
+    @type detector: BruteForceDetector | None
+    @param workers: Number of parser threads, 0 parses sequentially in the calling thread
+    @type workers: int
+    @param queue_size: Capacity of the pipeline queues in chunks of lines
+    @type queue_size: int
+    @param stats: Instrumentation to record throughput, stage timings and pipeline metrics in
+    @type stats: Stats | None
+    @param allowlist: Networks whose requests are dropped
+    @type allowlist: PrefixTrie | None
+    @param log_format: Compiled log format, lines are parsed as combined format if None
+    @type log_format: LogFormat | None
+    @param sampler: Sampling of lines, all lines are parsed if None
+    @type sampler: Sampler | None
+    @return: Number of written records
+    @rtype: int
+    """
+    matched_files = glob.glob(file_name)
+    if not matched_files:
+        raise ValueError("Cannot find file(s) '{}'".format(file_name))
+
+    watch_caches(stats)
+    parse = partial(
+        parse_raw_record,
+        event_type=event_type,
+        stats=stats,
+        allowlist=allowlist,
+        log_format=log_format,
+        sampler=sampler,
+    )
+
+    if workers:
+        staged = Pipeline(
+            parse,
+            sink.write_all,
+            workers=workers,
+            chunk_size=READ_CHUNK_LINES,
+            write_batch_size=READ_CHUNK_LINES,
+            queue_size=queue_size,
+            on_events=(
+                partial(map_events, detector.observe_record)
+                if detector is not None
+                else None
+            ),
+        )
+        _, count = staged.run(matched_files, keep_results=False)
+        add_pipeline_metrics(stats, staged, ("read", "write"))
+        if stats is not None:
+            stats.incr("events", count)
+        return count
+
+    count = 0
+    for records in read_records(
+        matched_files,
+        parse,
+        detector.observe_record if detector is not None else None,
+        stats,
+    ):
+        if stats is not None:
+            with stats.timer("write"):
+                sink.write_all(records)
+        else:
+            sink.write_all(records)
+        count += len(records)
+
+    if stats is not None:
+        stats.incr("events", count)
+    return count
+
+
+def read_lines(read, stats=None):
+    """
+    Read raw lines, recording read time, lines and bytes
+    @param read: Returns a list of lines read in binary mode
+    @type read: callable
+    @param stats: Instrumentation to record throughput in
+    @type stats: Stats | None
+    @rtype: list[bytes]
+    """
+    if stats is None:
+        return read()
+    started = time.perf_counter()
+    lines = read()
+    stats.add_time("read", time.perf_counter() - started)
+    stats.incr("lines", len(lines))
+    stats.incr("bytes", sum(map(len, lines)))
+    return lines
+
+
+def read_records(file_names, parse, observe=None, stats=None):
+    """
+    Parse files sequentially, one chunk of lines at a time
+    @param file_names: Files to parse
+    @type file_names: list[str]
+    @param parse: Parses a line read in binary mode into a record, see parse_raw_record()
+    @type parse: callable
+    @param observe: Called with every parsed record, e.g. a detector's observe_record()
+    @type observe: callable | None
+    @param stats: Instrumentation to record throughput in
+    @type stats: Stats | None
+    @return: Lists of records
+    @rtype: collections.Iterable[list[dict]]
+    """
+    for file_name in file_names:
+        with open(file_name, "rb") as f:
+            while True:
+                chunk = read_lines(lambda: list(islice(f, READ_CHUNK_LINES)), stats)
+                if not chunk:
+                    break
+                records = [r for r in map(parse, chunk) if r is not None]
+                if observe is not None:
+                    map_events(observe, records)
+                yield records
+
+
+def get_ip_sort_key(record):
+    """
+    Print order of records: shorter IPs first, then by IP
+    @param record: Record from parse_record()
+    @type record: dict
+    @rtype: (int, str)
+    """
+    return len(record["source_ip"]), record["source_ip"]
+
+
+def print_sorted(records, group_by_ip=False, buffer_size=SORT_BUFFER_SIZE):
+    """
+    Print records ordered by IP with an external merge sort, in bounded memory
+    @param records: Records from parse_record()
+    @type records: collections.Iterable[dict]
+    @param group_by_ip: Print one block per IP with its number of events
+    @type group_by_ip: bool
+    @param buffer_size: Records sorted in memory before a run is spilled to disk
+    @type buffer_size: int
+    @return: Number of printed records
+    @rtype: int
+    """
+    sorted_records = ExternalSorter(get_ip_sort_key, buffer_size).sort(records)
+    count = 0
+    if not group_by_ip:
+        for record in sorted_records:
+            pp(record)
+            count += 1
+        return count
+    for ip, group in group_sorted(sorted_records, itemgetter("source_ip")):
+        print("{}:".format(ip))
+        group_count = 0
+        for record in group:
+            pp(record)
+            group_count += 1
+        print("{} events from {}".format(group_count, ip))
+        count += group_count
+    return count
+
+
+def map_events(function, events):
+    """
+    Call function for every event
+    @param function: Function to call
+    @type function: callable
+    @param events: Events
+    @type events: list[Event]
+    """
+    for event in events:
+        function(event)
+
+
+def follow_file(
+    file_name,
+    event_type=None,
+    save_to_db=True,
+    detector=None,
+    batch_size=1000,
+    batch_interval=0.5,
+    poll_interval=0.1,
+    from_start=False,
+    stop=None,
+    on_batch=None,
+    allowlist=None,
+    log_format=None,
+    sampler=None,
+    stats=None,
+):
+    """
+    Follow a live log file and process appended lines in micro-batches.
+    A batch is flushed when it has batch_size events or its oldest event waited batch_interval seconds,
+    so ingest lag stays bounded without a commit per row.
+    @param file_name: Live log file
+    @type file_name: str
+    @param event_type: EventType to look for
+    @type event_type: EventType | None
+    @param save_to_db: Save to DB?
+    @type save_to_db: bool
+    @param detector: Brute-force detector to feed parsed events to
+    @type detector: BruteForceDetector | None
+    @param batch_size: Maximum number of events per commit
+    @type batch_size: int
+    @param batch_interval: Maximum seconds an event waits before commit
+    @type batch_interval: float
+    @param poll_interval: Seconds to sleep when no new lines are available
+    @type poll_interval: float
+    @param from_start: Process existing content of the file first
+    @type from_start: bool
+    @param stop: Following ends when this is set, runs until interrupted if None
+    @type stop: threading.Event | None
+    @param on_batch: Called with records of every flushed batch, taken before the commit
+        expires the saved events
+    @type on_batch: callable | None
+    @param allowlist: Networks whose requests are dropped before persistence
+    @type allowlist: PrefixTrie | None
+    @param log_format: Compiled log format, lines are parsed as combined format if None
+    @type log_format: LogFormat | None
+    @param sampler: Sampling of lines, all lines are parsed if None
+    @type sampler: Sampler | None
+    @param stats: Instrumentation to record throughput, stage timings and commit
+        latency in
+    @type stats: Stats | None
+    @return: Number of processed events
+    @rtype: int
+    """
+    watch_caches(stats)
+    follower = LogFollower(file_name, from_start)
+    batch = list()
+    batch_started = None
+    processed = 0
+
+    def flush():
+        # Read before saving, the commit expires the events' attributes
+        records = [e.to_record() for e in batch] if on_batch is not None else None
+        if stats is not None:
+            stats.incr("events", len(batch))
+        if save_to_db:
+            persist_events(batch, stats)
+        if on_batch is not None:
+            on_batch(records)
+
+    try:
+        while True:
+            stopping = stop is not None and stop.is_set()
+            lines = read_lines(follower.read_lines, stats)
+            for line in lines:
+                parsed_event = parse_raw_line(
+                    line,
+                    event_type,
+                    stats,
+                    allowlist=allowlist,
+                    log_format=log_format,
+                    sampler=sampler,
+                )
+                if parsed_event:
+                    if not batch:
+                        batch_started = time.monotonic()
+                    batch.append(parsed_event)
+                    if detector is not None:
+                        detector.observe_event(parsed_event)
+                    if len(batch) >= batch_size:
+                        flush()
+                        processed += len(batch)
+                        batch = list()
+            if batch and (
+                stopping or time.monotonic() - batch_started >= batch_interval
+            ):
+                flush()
+                processed += len(batch)
+                batch = list()
+            if stopping:
+                break
+            if not lines:
+                time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        if batch:
+            flush()
+            processed += len(batch)
+    finally:
+        follower.close()
+    return processed
+
+
 if __name__ == "__main__":
-    if not isfile(PROCESSOR_DB_FILE):
-        init_db()
+    # Always run: creates tables added since the DB file was created
+    init_db()
     parser = argparse.ArgumentParser(description="Parse a log file and output results")
     parser.add_argument(
         "--file",
@@ -392,12 +1225,349 @@ if __name__ == "__main__":
     )
     parser.add_argument("--persist", "-s", help="Save to DB", type=bool, required=False)
     parser.add_argument("--print", "-p", help="Print output", type=bool, required=False)
+    parser.add_argument(
+        "--detect",
+        help="Alert when an IP sends this many login POSTs within --window seconds",
+        type=int,
+        required=False,
+    )
+    parser.add_argument(
+        "--window",
+        help="Brute-force detection window in seconds",
+        type=float,
+        default=60,
+    )
+    parser.add_argument(
+        "--follow",
+        help="Follow the live log file and save new events in micro-batches",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--batch-size",
+        help="Maximum events per commit in --follow mode",
+        type=int,
+        default=1000,
+    )
+    parser.add_argument(
+        "--batch-interval",
+        help="Maximum seconds before committing in --follow mode",
+        type=float,
+        default=0.5,
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        help="Parse with a staged pipeline using this many parser threads",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--queue-size",
+        help="Capacity of the pipeline queues in chunks of lines",
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        "--stats",
+        help="Print throughput and per-stage timings after the run",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stats-json",
+        help="Write throughput and per-stage timings as JSON to this file ('-' for stdout)",
+        type=str,
+        required=False,
+    )
+    parser.add_argument(
+        "--shard-dir",
+        help="Save events into per-day or per-month shard files in this directory",
+        type=str,
+        required=False,
+    )
+    parser.add_argument(
+        "--shard-period",
+        help="Period covered by one shard file",
+        choices=["day", "month"],
+        default="day",
+    )
+    parser.add_argument(
+        "--allowlist",
+        help="File with networks (CIDR, one per line) whose requests are not saved",
+        type=str,
+        required=False,
+    )
+    parser.add_argument(
+        "--max-memory",
+        help="With -s, save events in batches sized to keep memory under this budget "
+        "(e.g. 256M, 1G) and print the peak",
+        type=parse_size,
+        required=False,
+    )
+    parser.add_argument(
+        "--lease",
+        help="With -s, lease files in the DB so overlapping runs parse different files",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--lease-seconds",
+        help="Seconds a file stays leased without renewal, and after it is parsed",
+        type=int,
+        default=LEASE_SECONDS,
+    )
+    parser.add_argument(
+        "--sample",
+        help="Only parse 1 in N lines, reports scale counts back up by N",
+        type=int,
+        required=False,
+    )
+    parser.add_argument(
+        "--sample-by-ip",
+        help="With --sample, keep 1 in N client IPs with all their lines",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--route-templates",
+        help="File with route templates (one per line, * matches a path segment, "
+        "a trailing ** the rest) URLs are grouped into",
+        type=str,
+        required=False,
+    )
+    parser.add_argument(
+        "--log-format",
+        help="Log format: {} or an Apache LogFormat / nginx log_format string".format(
+            ", ".join(sorted(FORMATS))
+        ),
+        type=str,
+        required=False,
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        help="Stream parsed records in this format instead of printing or saving Events",
+        choices=sorted(SINKS),
+        required=False,
+    )
+    parser.add_argument(
+        "--output-file",
+        help="File --output writes to ('-' for stdout)",
+        type=str,
+        default="-",
+    )
+    parser.add_argument(
+        "--group-by-ip",
+        help="With -p, print events grouped per IP with their count",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--sort-buffer",
+        help="With -p, events sorted in memory before a sorted run is spilled to disk",
+        type=int,
+        default=SORT_BUFFER_SIZE,
+    )
+    parser.add_argument(
+        "--profile",
+        help="Write CPU profiles and allocation summaries of parse and save stages here",
+        type=str,
+        required=False,
+    )
     args = parser.parse_args()
-    print(args.__dict__)
-    parsed_event_type = EventType(args.event) if args.event else None
+    if args.output and (args.persist or args.print or args.follow):
+        parser.error("--output cannot be combined with -s, -p or --follow")
+    if args.output and args.output_file == "-" and args.stats_json == "-":
+        parser.error("--stats-json - cannot be combined with --output to stdout")
+    if args.lease and (not args.persist or args.print or args.follow):
+        parser.error("--lease needs -s and cannot be combined with -p or --follow")
+    if args.max_memory and (not args.persist or args.print or args.follow):
+        parser.error("--max-memory needs -s and cannot be combined with -p or --follow")
+    # Keep stdout clean when records are streamed to it
+    log_file = sys.stderr if args.output and args.output_file == "-" else sys.stdout
+    print(args.__dict__, file=log_file)
+    if args.profile:
+        # Functions are only wrapped when profiling, written on exit so --follow works too
+        run_profiler = Profiler(args.profile)
+        run_profiler.install(sys.modules[__name__], PROFILED_FUNCTIONS)
+        run_profiler.install(Event, ["save_all"])
+        atexit.register(run_profiler.finish, log_file)
+    parsed_event_type = EventType(args.event) if args.event is not None else None
+    if args.shard_dir:
+        set_router(ShardRouter(args.shard_dir, args.shard_period))
+    allowed_networks = load_prefix_trie(args.allowlist) if args.allowlist else None
+    compiled_format = LogFormat(args.log_format) if args.log_format else None
+    if args.route_templates:
+        set_route_templates(load_route_templates(args.route_templates))
+    ip_field = compiled_format.ip_field if compiled_format is not None else 0
+    if args.sample and args.sample_by_ip and ip_field is None:
+        parser.error(
+            "--sample-by-ip needs the client address before any field with spaces "
+            "in --log-format"
+        )
+    line_sampler = (
+        Sampler(args.sample, args.sample_by_ip, ip_field) if args.sample else None
+    )
     save_to_dp = True if args.persist else False
     print_results = True if args.print else False
-    events = parse_file(args.file, parsed_event_type, save_to_dp)
-    if args.print:
-        pp(sorted(events, key=lambda e: (len(e.source_ip), e.source_ip)))
-    print("Number of events", len(events))
+    brute_force_detector = (
+        BruteForceDetector(args.detect, args.window) if args.detect else None
+    )
+    run_stats = Stats() if args.stats or args.stats_json else None
+    if args.follow:
+        events_count = follow_file(
+            args.file,
+            parsed_event_type,
+            save_to_dp,
+            brute_force_detector,
+            args.batch_size,
+            args.batch_interval,
+            on_batch=pp if print_results else None,
+            allowlist=allowed_networks,
+            log_format=compiled_format,
+            sampler=line_sampler,
+            stats=run_stats,
+        )
+    else:
+        if args.output:
+            # The sink holds on to stdout, alerts and parse errors are printed to stderr
+            diagnostics = (
+                redirect_stdout(sys.stderr)
+                if args.output_file == "-"
+                else nullcontext()
+            )
+            with get_sink(args.output, args.output_file) as output_sink, diagnostics:
+                events_count = stream_file(
+                    args.file,
+                    output_sink,
+                    parsed_event_type,
+                    brute_force_detector,
+                    args.workers,
+                    args.queue_size,
+                    run_stats,
+                    allowed_networks,
+                    compiled_format,
+                    line_sampler,
+                )
+        elif print_results and not save_to_dp:
+            # Nothing is saved, so parsed records are sorted without keeping Events
+            parse = partial(
+                parse_raw_record,
+                event_type=parsed_event_type,
+                stats=run_stats,
+                allowlist=allowed_networks,
+                log_format=compiled_format,
+                sampler=line_sampler,
+            )
+            matched = glob.glob(args.file)
+            if not matched:
+                raise ValueError("Cannot find file(s) '{}'".format(args.file))
+            watch_caches(run_stats)
+            events_count = print_sorted(
+                chain.from_iterable(
+                    read_records(
+                        matched,
+                        parse,
+                        (
+                            brute_force_detector.observe_record
+                            if brute_force_detector is not None
+                            else None
+                        ),
+                        run_stats,
+                    )
+                ),
+                args.group_by_ip,
+                args.sort_buffer,
+            )
+        elif save_to_dp and not print_results:
+
+            def save_files(file_pattern):
+                """
+                Parse and save files
+                @param file_pattern: File or file mask to parse
+                @type file_pattern: str
+                @return: Number of saved events
+                @rtype: int
+                """
+                if not args.max_memory:
+                    return len(
+                        parse_file(
+                            file_pattern,
+                            parsed_event_type,
+                            True,
+                            brute_force_detector,
+                            args.workers,
+                            args.queue_size,
+                            run_stats,
+                            allowed_networks,
+                            compiled_format,
+                            line_sampler,
+                        )
+                    )
+                saved_count, memory_budget = ingest_file(
+                    file_pattern,
+                    args.max_memory,
+                    parsed_event_type,
+                    brute_force_detector,
+                    args.workers,
+                    args.queue_size,
+                    run_stats,
+                    allowed_networks,
+                    compiled_format,
+                    line_sampler,
+                )
+                print(
+                    "Peak memory {:.1f} MiB of {:.1f} MiB budget, {} batches".format(
+                        memory_budget.peak_rss / (1 << 20),
+                        args.max_memory / (1 << 20),
+                        len(memory_budget.batch_sizes),
+                    ),
+                    file=log_file,
+                )
+                return saved_count
+
+            if args.lease:
+                # Overlapping runs claim different files of the mask
+                file_leases = FileLeases(args.lease_seconds)
+                events_count = 0
+                try:
+                    for claimed in file_leases.claim_files(
+                        sorted(glob.glob(args.file))
+                    ):
+                        events_count += save_files(glob.escape(claimed))
+                        file_leases.finish(claimed)
+                finally:
+                    file_leases.release()
+                print(
+                    "Parsed {} files, skipped {} leased by other runs".format(
+                        len(file_leases.claimed), len(file_leases.skipped)
+                    ),
+                    file=log_file,
+                )
+            else:
+                events_count = save_files(args.file)
+        else:
+            events = parse_file(
+                args.file,
+                parsed_event_type,
+                save_to_dp and not print_results,
+                brute_force_detector,
+                args.workers,
+                args.queue_size,
+                run_stats,
+                allowed_networks,
+                compiled_format,
+                line_sampler,
+            )
+            if print_results:
+                # Read before saving, the commit expires the events' attributes
+                records = [e.to_record() for e in events]
+                persist_events(events, run_stats)
+                print_sorted(records, args.group_by_ip, args.sort_buffer)
+            events_count = len(events)
+    print("Number of events", events_count, file=log_file)
+    if run_stats is not None:
+        run_stats.finish()
+        if args.stats:
+            print(run_stats.to_text(), file=log_file)
+        if args.stats_json == "-":
+            print(run_stats.to_json())
+        elif args.stats_json:
+            with open(args.stats_json, "w") as f:
+                f.write(run_stats.to_json())
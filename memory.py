@@ -0,0 +1,182 @@
+import os
+import re
+import sys
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# Bytes an in-flight parsed Event is assumed to take until one has been measured
+RECORD_SIZE = 4096
+MIN_BATCH_SIZE = 100
+MAX_BATCH_SIZE = 50000
+# Share of the budget in-flight events may grow RSS to, the rest absorbs measuring lag
+HEADROOM = 0.8
+SIZE_PATTERN = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$", re.IGNORECASE)
+SIZE_UNITS = {"": 1, "k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40}
+
+
+def parse_size(value):
+    """
+    Parse a memory size such as 512M, 1.5G or 1048576
+    @param value: Size with optional K, M, G or T suffix (powers of 1024)
+    @type value: str
+    @return: Size in bytes
+    @rtype: int
+    """
+    match = SIZE_PATTERN.match(value)
+    if match is None:
+        raise ValueError("Invalid memory size '{}'".format(value))
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()])
+
+
+def get_rss():
+    """
+    Current resident set size of this process
+    @return: Bytes, None if it can't be measured on this platform
+    @rtype: int | None
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def get_max_rss():
+    """
+    Highest resident set size this process reached, as tracked by the OS
+    @return: Bytes, None if it can't be measured on this platform
+    @rtype: int | None
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+class MemoryBudget(object):
+    """
+    Sizes ingest batches so in-flight events keep RSS under a limit: the batch size is
+    the memory left under the limit divided by the measured bytes per event, and a
+    batch is flushed early whenever RSS reaches the limit anyway
+    """
+
+    def __init__(
+        self,
+        limit,
+        min_batch_size=MIN_BATCH_SIZE,
+        max_batch_size=MAX_BATCH_SIZE,
+        record_size=RECORD_SIZE,
+    ):
+        """
+        @param limit: Memory budget in bytes
+        @type limit: int
+        @param min_batch_size: Smallest batch, bounds the number of commits
+        @type min_batch_size: int
+        @param max_batch_size: Largest batch, bounds the size of a transaction
+        @type max_batch_size: int
+        @param record_size: Initial estimate of bytes per in-flight event
+        @type record_size: int
+        """
+        self.limit = limit
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.record_size = record_size
+        rss = get_rss()
+        self.measured = rss is not None
+        self.baseline_rss = rss or 0
+        self.rss = self.peak_rss = self._batch_start_rss = self.baseline_rss
+        self.batch_sizes = list()
+        self.pressure_flushes = 0
+        self.batch_size = self.get_batch_size()
+        if self.baseline_rss >= limit:
+            print(
+                "RSS is already {:.1f} MiB, over the {:.1f} MiB budget".format(
+                    self.baseline_rss / (1 << 20), limit / (1 << 20)
+                )
+            )
+
+    def __repr__(self):
+        """
+        String representation
+        @rtype: str
+        """
+        return "<{} limit={} batch_size={} record_size={}>".format(
+            self.__class__.__name__, self.limit, self.batch_size, self.record_size
+        )
+
+    def check(self, pending=0):
+        """
+        Measure RSS, estimated from pending events where RSS can't be measured
+        @param pending: Events parsed but not flushed yet
+        @type pending: int
+        @return: Bytes
+        @rtype: int
+        """
+        rss = get_rss() if self.measured else None
+        if rss is None:
+            rss = self._batch_start_rss + pending * self.record_size
+        self.rss = rss
+        if rss > self.peak_rss:
+            self.peak_rss = rss
+        return rss
+
+    def get_batch_size(self):
+        """
+        Events that fit in the memory left under the budget
+        @rtype: int
+        """
+        free = self.limit * HEADROOM - self.rss
+        size = int(free // self.record_size) if free > 0 else 0
+        return max(self.min_batch_size, min(self.max_batch_size, size))
+
+    def should_flush(self, pending):
+        """
+        Should pending events be written now
+        @param pending: Events parsed but not flushed yet
+        @type pending: int
+        @rtype: bool
+        """
+        if pending >= self.batch_size:
+            self.check(pending)
+            return True
+        if pending and self.check(pending) >= self.limit * HEADROOM:
+            self.pressure_flushes += 1
+            return True
+        return False
+
+    def flushed(self, count):
+        """
+        Learn from a written batch and size the next one
+        @param count: Number of events written
+        @type count: int
+        """
+        grown = self.rss - self._batch_start_rss
+        if count and grown > 0:
+            # Moving average, RSS only grows by whole pages and arenas
+            self.record_size = max(1, (self.record_size + grown // count) // 2)
+        self.batch_sizes.append(count)
+        self._batch_start_rss = self.check()
+        self.batch_size = self.get_batch_size()
+
+    def metrics(self):
+        """
+        Budget, peak memory and batch sizes of the run
+        @rtype: dict
+        """
+        return {
+            "limit_bytes": self.limit,
+            "baseline_rss_bytes": self.baseline_rss,
+            "peak_rss_bytes": self.peak_rss,
+            "max_rss_bytes": get_max_rss(),
+            "rss_measured": self.measured,
+            "record_size_bytes": self.record_size,
+            "batches": len(self.batch_sizes),
+            "min_batch_size": min(self.batch_sizes) if self.batch_sizes else 0,
+            "max_batch_size": max(self.batch_sizes) if self.batch_sizes else 0,
+            "pressure_flushes": self.pressure_flushes,
+        }
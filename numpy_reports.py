@@ -0,0 +1,287 @@
+import glob
+from datetime import datetime, timedelta
+from functools import lru_cache, partial
+
+import numpy as np
+
+from log_processor import EventType, parse_raw_record, read_records
+from user_agents import UserAgentClass
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+EVENT_TYPE_CODES = {e.name: e.value for e in EventType}
+# Code of events without an EventType, counted in total_count only
+UNCLASSIFIED = len(EVENT_TYPE_CODES)
+# Code of events stored without a UserAgentClass, not counted per class
+UNKNOWN_UA_CLASS = len(UserAgentClass)
+
+
+@lru_cache(maxsize=4096)
+def to_microseconds(date_time):
+    """
+    Wall-clock time as microseconds since the epoch, ignoring the UTC offset like the
+    SQLite DATETIME column the SQL report path compares
+    @param date_time: Event datetime
+    @type date_time: datetime
+    @rtype: int
+    """
+    return (date_time.replace(tzinfo=None) - EPOCH) // MICROSECOND
+
+
+class EventColumns(object):
+    """
+    Parsed events as columnar batches: IP ids, event type codes, user agent class codes,
+    wall-clock times and line and IP sampling rates
+    """
+
+    def __init__(self):
+        # IP as key and id as value, ids are assigned in order of first appearance
+        self.ip_ids = dict()
+        self.ip_batches = list()
+        self.type_batches = list()
+        self.ua_batches = list()
+        self.time_batches = list()
+        self.rate_batches = list()
+        self.ip_rate_batches = list()
+        self.count = 0
+
+    def __repr__(self):
+        """
+        String representation
+        @rtype: str
+        """
+        return "<{} events={} ips={}>".format(
+            self.__class__.__name__, self.count, len(self.ip_ids)
+        )
+
+    def __len__(self):
+        """
+        Number of events
+        @rtype: int
+        """
+        return self.count
+
+    def add_batch(
+        self,
+        source_ips,
+        event_types,
+        date_times,
+        ua_classes,
+        sample_rates,
+        ip_sample_rates=None,
+    ):
+        """
+        Append a batch of events given column by column
+        @param source_ips: Source IP of every event
+        @type source_ips: list[str]
+        @param event_types: EventType name of every event, None if unclassified
+        @type event_types: list[str | None]
+        @param date_times: Datetime of every event
+        @type date_times: list[datetime]
+        @param ua_classes: UserAgentClass value of every event, None if unknown
+        @type ua_classes: list[int | None]
+        @param sample_rates: Line sampling rate of every event, None if not sampled
+        @type sample_rates: list[int | None]
+        @param ip_sample_rates: IP sampling rate of every event, None if IPs weren't
+            sampled
+        @type ip_sample_rates: list[int | None] | None
+        """
+        ip_ids = self.ip_ids
+        size = len(source_ips)
+        self.ip_batches.append(
+            np.fromiter(
+                (ip_ids.setdefault(ip, len(ip_ids)) for ip in source_ips),
+                dtype=np.int64,
+                count=size,
+            )
+        )
+        self.type_batches.append(
+            np.fromiter(
+                (EVENT_TYPE_CODES.get(t, UNCLASSIFIED) for t in event_types),
+                dtype=np.int64,
+                count=size,
+            )
+        )
+        self.ua_batches.append(
+            np.fromiter(
+                (UNKNOWN_UA_CLASS if c is None else c for c in ua_classes),
+                dtype=np.int64,
+                count=size,
+            )
+        )
+        self.time_batches.append(
+            np.fromiter(map(to_microseconds, date_times), dtype=np.int64, count=size)
+        )
+        self.rate_batches.append(
+            np.fromiter((r or 1 for r in sample_rates), dtype=np.int64, count=size)
+        )
+        self.ip_rate_batches.append(
+            np.fromiter((r or 1 for r in ip_sample_rates), dtype=np.int64, count=size)
+            if ip_sample_rates is not None
+            else np.ones(size, dtype=np.int64)
+        )
+        self.count += size
+
+    def add_records(self, records):
+        """
+        Append a batch of records
+        @param records: Records from log_processor.parse_record()
+        @type records: list[dict]
+        """
+        self.add_batch(
+            [r["source_ip"] for r in records],
+            [r["event_type"] for r in records],
+            [r["date_time"] for r in records],
+            [r["ua_class"] for r in records],
+            [r["sample_rate"] for r in records],
+            [r["ip_sample_rate"] for r in records],
+        )
+
+    def add_events(self, events):
+        """
+        Append a batch of Events
+        @param events: Parsed or loaded events
+        @type events: list[log_processor.Event]
+        """
+        self.add_batch(
+            [e.source_ip for e in events],
+            [e.event_type for e in events],
+            [e.date_time for e in events],
+            [e.ua_class for e in events],
+            [e.sample_rate for e in events],
+            [e.ip_sample_rate for e in events],
+        )
+
+
+def count_by(keys, size, weights=None):
+    """
+    Number of (weighted) occurrences of every key
+    @param keys: Non-negative integer keys
+    @type keys: np.ndarray
+    @param size: Number of distinct keys
+    @type size: int
+    @param weights: Weight of every key occurrence, 1 if None
+    @type weights: np.ndarray | None
+    @rtype: np.ndarray
+    """
+    if weights is None:
+        return np.bincount(keys, minlength=size)
+    return np.bincount(keys, weights=weights, minlength=size).astype(np.int64)
+
+
+def get_base_reports(columns, report_class):
+    """
+    Per-IP total count, latest request and counts per EventType and UserAgentClass,
+    computed with bincount and max-reduce instead of SQL GROUP BY. Events kept by line
+    sampling are weighted by their sampling rate, IPs kept by IP sampling have exact
+    counts.
+    @param columns: Events
+    @type columns: EventColumns
+    @param report_class: Report model, passed in as report.py imports this module lazily
+    @type report_class: type
+    @return: Dict with IP as key and Report with all counts set as value
+    @rtype: dict
+    """
+    reports = dict()
+    if not columns.count:
+        return reports
+    ips = np.concatenate(columns.ip_batches)
+    codes = np.concatenate(columns.type_batches)
+    ua_codes = np.concatenate(columns.ua_batches)
+    times = np.concatenate(columns.time_batches)
+    rates = np.concatenate(columns.rate_batches)
+    # Unweighted bincount is faster, and exact, when nothing was sampled
+    weights = rates if (rates > 1).any() else None
+    ip_count = len(columns.ip_ids)
+    width = UNCLASSIFIED + 1
+
+    totals = count_by(ips, ip_count, weights).tolist()
+    per_type = (
+        count_by(ips * width + codes, ip_count * width, weights)
+        .reshape(ip_count, width)
+        .tolist()
+    )
+    ua_width = UNKNOWN_UA_CLASS + 1
+    per_ua_class = (
+        count_by(ips * ua_width + ua_codes, ip_count * ua_width, weights)
+        .reshape(ip_count, ua_width)
+        .tolist()
+    )
+    max_rates = np.ones(ip_count, dtype=np.int64)
+    if weights is not None:
+        np.maximum.at(max_rates, ips, rates)
+    max_rates = max_rates.tolist()
+    ip_rates = np.concatenate(columns.ip_rate_batches)
+    max_ip_rates = np.ones(ip_count, dtype=np.int64)
+    if (ip_rates > 1).any():
+        np.maximum.at(max_ip_rates, ips, ip_rates)
+    max_ip_rates = max_ip_rates.tolist()
+    latest = np.full(ip_count, np.iinfo(np.int64).min, dtype=np.int64)
+    np.maximum.at(latest, ips, times)
+    latest = latest.tolist()
+
+    for ip, ip_id in columns.ip_ids.items():
+        report = report_class(
+            ip,
+            EPOCH + timedelta(microseconds=latest[ip_id]),
+            totals[ip_id],
+            sampled=max_rates[ip_id] > 1 or max_ip_rates[ip_id] > 1,
+            ip_sample_rate=max_ip_rates[ip_id] if max_ip_rates[ip_id] > 1 else None,
+        )
+        counts = per_type[ip_id]
+        for event_type in EventType:
+            setattr(
+                report, "{}_count".format(event_type.name), counts[event_type.value]
+            )
+        counts = per_ua_class[ip_id]
+        for ua_class in UserAgentClass:
+            setattr(report, "{}_ua_count".format(ua_class.name), counts[ua_class.value])
+        reports[ip] = report
+    return reports
+
+
+def generate_reports(columns, report_class, finish_reports, save=False):
+    """
+    Generate full reports from in-memory events, equal to report.generate_reports()
+    over the same events
+    @param columns: Events
+    @type columns: EventColumns
+    @param report_class: report.Report
+    @type report_class: type
+    @param finish_reports: report.finish_reports()
+    @type finish_reports: callable
+    @param save: Persist to DB
+    @type save: bool
+    @return: Dict with IP as key and Report as value
+    @rtype: dict
+    """
+    return finish_reports(get_base_reports(columns, report_class), save)
+
+
+def report_log_files(
+    file_name, report_class, finish_reports, save=False, event_type=None
+):
+    """
+    Parse log files straight into columns and generate reports, without the events DB
+    @param file_name: File or file mask to parse
+    @type file_name: str
+    @param report_class: report.Report
+    @type report_class: type
+    @param finish_reports: report.finish_reports()
+    @type finish_reports: callable
+    @param save: Persist to DB
+    @type save: bool
+    @param event_type: EventType to look for
+    @type event_type: EventType | None
+    @return: Dict with IP as key and Report as value
+    @rtype: dict
+    """
+    matched_files = glob.glob(file_name)
+    if not matched_files:
+        raise ValueError("Cannot find file(s) '{}'".format(file_name))
+    columns = EventColumns()
+    parse = partial(parse_raw_record, event_type=event_type)
+    for records in read_records(matched_files, parse):
+        if records:
+            columns.add_records(records)
+    return generate_reports(columns, report_class, finish_reports, save)
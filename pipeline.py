@@ -0,0 +1,244 @@
+import itertools
+import queue
+import threading
+import time
+
+# Marks the end of a stage's output
+_DONE = object()
+
+
+class MeteredQueue(queue.Queue):
+    """
+    Bounded queue recording depth and time producers spent blocked on it
+    """
+
+    def __init__(self, name, maxsize):
+        """
+        @param name: Queue name used in metrics
+        @type name: str
+        @param maxsize: Maximum number of items, producers block when full
+        @type maxsize: int
+        """
+        super().__init__(maxsize)
+        self.name = name
+        self.puts = 0
+        self.depth_sum = 0
+        self.max_depth = 0
+        self.blocked_seconds = 0.0
+
+    def put(self, item, block=True, timeout=None):
+        """
+        Put an item, recording depth and backpressure
+        """
+        started = time.perf_counter()
+        super().put(item, block, timeout)
+        self.blocked_seconds += time.perf_counter() - started
+        depth = self.qsize()
+        self.puts += 1
+        self.depth_sum += depth
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def metrics(self):
+        """
+        Queue depth metrics
+        @rtype: dict
+        """
+        return {
+            "capacity": self.maxsize,
+            "puts": self.puts,
+            "max_depth": self.max_depth,
+            "mean_depth": self.depth_sum / self.puts if self.puts else 0.0,
+            "producer_blocked_seconds": self.blocked_seconds,
+        }
+
+
+class Pipeline(object):
+    """
+    Staged ingest: one reader thread, a pool of parser threads and a single writer,
+    connected by bounded queues. Disk reads and SQLite commits release the GIL,
+    so they overlap with parsing instead of running strictly one after the other.
+    """
+
+    def __init__(
+        self,
+        parse,
+        write=None,
+        workers=2,
+        chunk_size=1000,
+        write_batch_size=10000,
+        queue_size=8,
+        on_events=None,
+        budget=None,
+    ):
+        """
+        @param parse: Parses a line read in binary mode, returns an object or None
+        @type parse: callable
+        @param write: Persists a list of parsed objects, nothing is written if None
+        @type write: callable | None
+        @param workers: Number of parser threads
+        @type workers: int
+        @param chunk_size: Lines handed to a parser at once
+        @type chunk_size: int
+        @param write_batch_size: Parsed objects per write call
+        @type write_batch_size: int
+        @param queue_size: Capacity of each queue in chunks
+        @type queue_size: int
+        @param on_events: Called by the writer with every parsed chunk
+        @type on_events: callable | None
+        @param budget: Sizes write batches to a memory limit instead of write_batch_size
+        @type budget: memory.MemoryBudget | None
+        """
+        self.parse = parse
+        self.write = write
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.write_batch_size = write_batch_size
+        self.on_events = on_events
+        self.budget = budget
+        self.lines_queue = MeteredQueue("lines", queue_size)
+        self.events_queue = MeteredQueue("events", queue_size)
+        self.stage_seconds = {"read": 0.0, "parse": 0.0, "write": 0.0}
+        self.lines_count = 0
+        self.bytes_count = 0
+        self.errors = list()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        """
+        String representation
+        @rtype: str
+        """
+        return "<{} workers={} lines={}>".format(
+            self.__class__.__name__, self.workers, self.lines_count
+        )
+
+    def _read(self, file_names):
+        """
+        Reader stage: split files into chunks of undecoded lines
+        @param file_names: Files to read
+        @type file_names: list[str]
+        """
+        try:
+            for file_name in file_names:
+                with open(file_name, "rb") as f:
+                    while True:
+                        started = time.perf_counter()
+                        chunk = list(itertools.islice(f, self.chunk_size))
+                        self.stage_seconds["read"] += time.perf_counter() - started
+                        if not chunk or self.errors:
+                            break
+                        self.lines_count += len(chunk)
+                        self.bytes_count += sum(map(len, chunk))
+                        self.lines_queue.put(chunk)
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            for _ in range(self.workers):
+                self.lines_queue.put(_DONE)
+
+    def _parse(self):
+        """
+        Parser stage: turn chunks of lines into chunks of parsed objects
+        """
+        try:
+            while True:
+                chunk = self.lines_queue.get()
+                if chunk is _DONE:
+                    break
+                started = time.perf_counter()
+                parsed = [p for p in map(self.parse, chunk) if p]
+                elapsed = time.perf_counter() - started
+                with self._lock:
+                    self.stage_seconds["parse"] += elapsed
+                if parsed and not self.errors:
+                    self.events_queue.put(parsed)
+        except Exception as e:
+            self.errors.append(e)
+            # Keep draining so the reader never blocks forever
+            while self.lines_queue.get() is not _DONE:
+                pass
+        finally:
+            self.events_queue.put(_DONE)
+
+    def _flush(self, batch):
+        """
+        Writer stage: persist a batch
+        @param batch: Parsed objects
+        @type batch: list
+        """
+        if self.write is not None and batch:
+            started = time.perf_counter()
+            self.write(batch)
+            self.stage_seconds["write"] += time.perf_counter() - started
+            if self.budget is not None:
+                self.budget.flushed(len(batch))
+
+    def run(self, file_names, keep_results=True):
+        """
+        Process files, the writer stage runs in the calling thread
+        @param file_names: Files to process
+        @type file_names: list[str]
+        @param keep_results: Return parsed objects, otherwise only count them
+        @type keep_results: bool
+        @return: Parsed objects (in no particular order) and their number
+        @rtype: (list, int)
+        """
+        threads = [threading.Thread(target=self._read, args=(file_names,), daemon=True)]
+        for _ in range(self.workers):
+            threads.append(threading.Thread(target=self._parse, daemon=True))
+        for thread in threads:
+            thread.start()
+
+        results = list()
+        batch = list()
+        count = 0
+        finished_workers = 0
+        try:
+            while finished_workers < self.workers:
+                parsed = self.events_queue.get()
+                if parsed is _DONE:
+                    finished_workers += 1
+                    continue
+                if self.errors:
+                    # Drain so parsers can finish
+                    continue
+                try:
+                    count += len(parsed)
+                    if self.on_events is not None:
+                        self.on_events(parsed)
+                    if keep_results:
+                        results.extend(parsed)
+                    batch.extend(parsed)
+                    if (
+                        self.budget.should_flush(len(batch))
+                        if self.budget is not None
+                        else len(batch) >= self.write_batch_size
+                    ):
+                        self._flush(batch)
+                        batch = list()
+                except Exception as e:
+                    self.errors.append(e)
+            if not self.errors:
+                self._flush(batch)
+        finally:
+            for thread in threads:
+                thread.join()
+        if self.errors:
+            raise self.errors[0]
+        return results, count
+
+    def metrics(self):
+        """
+        Per-stage busy time and queue depth metrics, for tuning workers and queue sizes
+        @rtype: dict
+        """
+        return {
+            "workers": self.workers,
+            "lines": self.lines_count,
+            "bytes": self.bytes_count,
+            "stage_seconds": dict(self.stage_seconds),
+            "queues": {
+                q.name: q.metrics() for q in (self.lines_queue, self.events_queue)
+            },
+        }
@@ -0,0 +1,267 @@
+import cProfile
+import io
+import itertools
+import os
+import pstats
+import threading
+import tracemalloc
+
+# Frames kept per allocation, the allocating line is enough to group by
+TRACEMALLOC_FRAMES = 1
+# Calls of a stage whose allocations are diffed, snapshots grow with the heap
+SAMPLED_CALLS = 8
+# Functions and allocation sites listed per stage
+TOP_LINES = 25
+# Leave out allocations of the profiler itself
+SNAPSHOT_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+]
+
+
+class Profiler(object):
+    """
+    Opt-in CPU and allocation profiles per stage. Functions are only wrapped when a
+    profiler is installed, so runs without one pay nothing. Stages are exclusive: while
+    a nested stage runs, the stage that called it is paused, so its time and allocations
+    are only counted once. Allocations are diffed around the first SAMPLED_CALLS calls
+    1, 2, 4, 8... of a stage: snapshots cost time in the size of the heap, far too much to
+    take around every line. tracemalloc is process wide, so allocations of concurrent
+    threads show up in the diffs of workers.
+    """
+
+    def __init__(self, directory, memory=True):
+        """
+        @param directory: Directory profiles are written to
+        @type directory: str
+        @param memory: Also trace allocations with tracemalloc
+        @type memory: bool
+        """
+        self.directory = directory
+        self.memory = memory
+        self.profiles = dict()
+        self.calls = dict()
+        self.allocations = dict()
+        self.peaks = dict()
+        self.sampled_calls = dict()
+        self._patched = list()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # Leave tracing on if something else started it
+        self._tracing = memory and not tracemalloc.is_tracing()
+        if self._tracing:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+
+    def __repr__(self):
+        """
+        String representation
+        @rtype: str
+        """
+        return "<{} {} stages={}>".format(
+            self.__class__.__name__, self.directory, sorted(self.calls)
+        )
+
+    def install(self, owner, names):
+        """
+        Profile functions of a module or class, each as a stage named after it
+        @param owner: Module or class the functions are looked up on by their callers
+        @type owner: module | type
+        @param names: Function names
+        @type names: list[str]
+        """
+        for name in names:
+            original = owner.__dict__[name]
+            if isinstance(owner, type):
+                stage = "{}.{}".format(owner.__name__, name)
+            else:
+                stage = name
+            if isinstance(original, (staticmethod, classmethod)):
+                wrapped = type(original)(self.wrap(stage, original.__func__))
+            else:
+                wrapped = self.wrap(stage, original)
+            setattr(owner, name, wrapped)
+            self._patched.append((owner, name, original))
+
+    def uninstall(self):
+        """
+        Restore all functions wrapped by install()
+        """
+        for owner, name, original in reversed(self._patched):
+            setattr(owner, name, original)
+        self._patched = list()
+
+    def wrap(self, stage, function):
+        """
+        Profile calls of a function as a stage
+        @param stage: Stage name, also the name of its profile files
+        @type stage: str
+        @param function: Function to profile
+        @type function: callable
+        @rtype: callable
+        """
+        self.calls[stage] = itertools.count(1)
+        self.profiles[stage] = dict()
+
+        def profiled(*args, **kwargs):
+            # next() on a count is atomic, worker threads may call the same stage
+            call = next(self.calls[stage])
+            stack = self._get_stack()
+            profile = self._get_profile(stage)
+            if stack:
+                stack[-1].disable()
+            stack.append(profile)
+            before = None
+            if self.memory and call & (call - 1) == 0 and call < 1 << SAMPLED_CALLS:
+                before = self._snapshot()
+            profile.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.disable()
+                if before is not None:
+                    self._add_allocations(stage, before)
+                stack.pop()
+                if stack:
+                    stack[-1].enable()
+
+        profiled.__name__ = getattr(function, "__name__", stage)
+        profiled.__doc__ = getattr(function, "__doc__", None)
+        profiled.__wrapped__ = function
+        return profiled
+
+    def _get_stack(self):
+        """
+        Profiles of the stages running in this thread, innermost last
+        @rtype: list[cProfile.Profile]
+        """
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = list()
+        return stack
+
+    def _get_profile(self, stage):
+        """
+        Profile of a stage for this thread, a profile can only be enabled in one thread
+        @param stage: Stage name
+        @type stage: str
+        @rtype: cProfile.Profile
+        """
+        thread = threading.get_ident()
+        profile = self.profiles[stage].get(thread)
+        if profile is None:
+            with self._lock:
+                profile = self.profiles[stage][thread] = cProfile.Profile()
+        return profile
+
+    def _snapshot(self):
+        """
+        Snapshot of traced allocations, peak tracking restarted
+        @rtype: (tracemalloc.Snapshot, int)
+        """
+        tracemalloc.reset_peak()
+        snapshot = tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+        return snapshot, tracemalloc.get_traced_memory()[0]
+
+    def _add_allocations(self, stage, before):
+        """
+        Add the allocations a stage call made to the stage totals
+        @param stage: Stage name
+        @type stage: str
+        @param before: Snapshot and traced bytes taken before the call
+        @type before: (tracemalloc.Snapshot, int)
+        """
+        snapshot, traced = before
+        peak = tracemalloc.get_traced_memory()[1] - traced
+        after = tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+        with self._lock:
+            self.peaks[stage] = max(self.peaks.get(stage, 0), peak)
+            self.sampled_calls[stage] = self.sampled_calls.get(stage, 0) + 1
+            totals = self.allocations.setdefault(stage, dict())
+            for diff in after.compare_to(snapshot, "lineno"):
+                if diff.size_diff == 0 and diff.count_diff == 0:
+                    continue
+                frame = diff.traceback[0]
+                key = (frame.filename, frame.lineno)
+                size, count = totals.get(key, (0, 0))
+                totals[key] = (size + diff.size_diff, count + diff.count_diff)
+
+    def get_stats(self, stage):
+        """
+        CPU profile of a stage merged over threads
+        @param stage: Stage name
+        @type stage: str
+        @return: Stats, None if the stage wasn't called
+        @rtype: pstats.Stats | None
+        """
+        stats = None
+        for profile in self.profiles.get(stage, dict()).values():
+            profile.create_stats()
+            if not profile.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        return stats
+
+    def write(self):
+        """
+        Write per stage <stage>.prof (for pstats or snakeviz) and a <stage>.txt summary of
+        the slowest functions and largest allocation sites
+        @return: Written files
+        @rtype: list[str]
+        """
+        written = list()
+        for stage in sorted(self.profiles):
+            stats = self.get_stats(stage)
+            if stats is None:
+                continue
+            prof_file = os.path.join(self.directory, "{}.prof".format(stage))
+            stats.dump_stats(prof_file)
+            written.append(prof_file)
+            text = io.StringIO()
+            print("Stage {}".format(stage), file=text)
+            stats.stream = text
+            stats.sort_stats("cumulative").print_stats(TOP_LINES)
+            if stage in self.sampled_calls:
+                print(
+                    "Allocations in {} sampled calls, peak {} bytes".format(
+                        self.sampled_calls[stage], self.peaks[stage]
+                    ),
+                    file=text,
+                )
+                top = sorted(
+                    self.allocations[stage].items(), key=lambda i: -abs(i[1][0])
+                )[:TOP_LINES]
+                for (filename, lineno), (size, count) in top:
+                    print(
+                        "{:>12} B {:>8} blocks  {}:{}".format(
+                            size, count, filename, lineno
+                        ),
+                        file=text,
+                    )
+            txt_file = os.path.join(self.directory, "{}.txt".format(stage))
+            with open(txt_file, "w") as f:
+                f.write(text.getvalue())
+            written.append(txt_file)
+        return written
+
+    def finish(self, log_file=None):
+        """
+        Restore profiled functions, stop tracing allocations and write the profiles
+        @param log_file: Where to report the written files, stdout if None
+        @type log_file: io.TextIOBase | None
+        @return: Written files
+        @rtype: list[str]
+        """
+        self.uninstall()
+        written = self.write()
+        print(
+            "Wrote {} profile files to {}".format(len(written), self.directory),
+            file=log_file,
+        )
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+        return written
@@ -0,0 +1,154 @@
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+# Same fields as functools.lru_cache().cache_info(), so Stats.watch_cache() can report it
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+_generation = 0
+_generation_lock = threading.Lock()
+
+
+def bump_generation():
+    """
+    Invalidate cached query results after this process wrote events or reports
+    @return: New generation
+    @rtype: int
+    """
+    global _generation
+    with _generation_lock:
+        _generation += 1
+        return _generation
+
+
+def get_generation():
+    """
+    Number of writes of this process that invalidated cached query results
+    @rtype: int
+    """
+    return _generation
+
+
+def get_db_files():
+    """
+    Processor and report DB files, as currently configured
+    @rtype: list[str]
+    """
+    return [os.environ["PROCESSOR_DB_FILE"], os.environ["REPORT_DB_FILE"]]
+
+
+def get_file_versions(paths):
+    """
+    Modification time and size of files, these change when another process commits
+    @param paths: Files
+    @type paths: collections.Iterable[str]
+    @return: (path, mtime in ns, size) per file, None values if it doesn't exist
+    @rtype: tuple
+    """
+    versions = list()
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            versions.append((path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            versions.append((path, None, None))
+    return tuple(versions)
+
+
+class QueryCache(object):
+    """
+    Bounded LRU cache of query results.
+    An entry is only served while the write generation of this process and the
+    versions of the DB files it was read from are unchanged.
+    """
+
+    def __init__(self, maxsize=1024):
+        """
+        @param maxsize: Maximum number of cached results, 0 disables caching
+        @type maxsize: int
+        """
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        """
+        String representation
+        @rtype: str
+        """
+        return "<{} {}>".format(self.__class__.__name__, self.stats())
+
+    def __len__(self):
+        """
+        Number of cached results
+        @rtype: int
+        """
+        return len(self.entries)
+
+    def get(self, key, compute, paths=None):
+        """
+        Cached result of a query, computed on a miss
+        @param key: Hashable key identifying the query and its parameters
+        @type key: tuple
+        @param compute: Runs the query
+        @type compute: callable
+        @param paths: Files the query reads, defaults to get_db_files()
+        @type paths: collections.Iterable[str] | None
+        """
+        # Taken before running the query, so a concurrent write makes the next read a miss
+        token = (
+            get_generation(),
+            get_file_versions(get_db_files() if paths is None else paths),
+        )
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == token:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            if entry is not None:
+                self.stale += 1
+        value = compute()
+        if self.maxsize:
+            with self._lock:
+                self.entries[key] = (token, value)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def clear(self):
+        """
+        Drop all cached results
+        """
+        with self._lock:
+            self.entries.clear()
+
+    def cache_info(self):
+        """
+        Hit and miss counters in functools.lru_cache format
+        @rtype: CacheInfo
+        """
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.entries))
+
+    def stats(self):
+        """
+        Hit and miss statistics
+        @rtype: dict
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "stale": self.stale,
+            "evictions": self.evictions,
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+        }
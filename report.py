@@ -1,7 +1,48 @@
-from database import report_db_session, processor_db_session, BaseReport, init_db
-from log_processor import Event, EventType
+import argparse
+import atexit
+import base64
+import gzip
+import json
+import socket
+import sys
+from datetime import datetime
 
-from sqlalchemy import Column, Integer, String, DateTime, func, Text, text
+from database import (
+    report_db_session,
+    processor_db_session,
+    BaseReport,
+    init_db,
+    REPORT_CACHE_SIZE,
+    SHARD_DIR,
+)
+from ip_trie import get_prefix
+from log_processor import PROFILED_FUNCTIONS, Event, EventType
+from profiling import Profiler
+from query_cache import QueryCache, bump_generation, get_db_files
+from routes import get_route_names
+from report_index import get_index_file, write_report_index
+from shards import delete_shards_older_than, list_shards, query_shards, to_datetime
+from sketches import SKETCH_DIMENSIONS, HyperLogLog, distinct_count, merge_sketches
+from user_agents import UserAgentClass
+
+from sqlalchemy import Boolean, Column, Integer, String, DateTime, func, Text, text
+
+EVENT_COUNT_FIELDS = ["{}_count".format(e.name) for e in EventType]
+UA_COUNT_FIELDS = ["{}_ua_count".format(c.name) for c in UserAgentClass]
+# Additive Report counters, in the order partial reports store them
+COUNT_FIELDS = ["total_count"] + EVENT_COUNT_FIELDS + UA_COUNT_FIELDS
+PARTIAL_VERSION = 1
+# Number of events of its IP an event row stands for, line sampling keeps 1 in
+# sample_rate; IP sampling keeps all events of an IP, so per-IP counts stay exact
+EVENT_WEIGHT = func.coalesce(Event.sample_rate, 1)
+EVENT_WEIGHT_SQL = "coalesce(sample_rate, 1)"
+# Number of events an event row stands for in totals over all IPs
+TOTAL_WEIGHT = EVENT_WEIGHT * func.coalesce(Event.ip_sample_rate, 1)
+TOTAL_WEIGHT_SQL = "coalesce(sample_rate, 1) * coalesce(ip_sample_rate, 1)"
+# Rolled up network sizes as (IPv4 prefix length, IPv6 prefix length)
+PREFIX_LENGTHS = [(24, 64), (16, 48)]
+# Results of Report.get_by_ip() and generate_reports() between ingests
+report_cache = QueryCache(REPORT_CACHE_SIZE)
 
 
 class Report(BaseReport):
@@ -22,6 +63,18 @@ class Report(BaseReport):
     get_count = Column(Integer)
     head_count = Column(Integer)
     options_count = Column(Integer)
+    browser_ua_count = Column(Integer)
+    bot_ua_count = Column(Integer)
+    headless_ua_count = Column(Integer)
+    script_ua_count = Column(Integer)
+    empty_ua_count = Column(Integer)
+    other_ua_count = Column(Integer)
+    # Events were sampled: counts are scaled up estimates if lines were sampled, exact if
+    # only IPs were
+    sampled = Column(Boolean)
+    # The IP was kept as 1 in ip_sample_rate IPs, its counts are exact and rollups over
+    # IPs are scaled by it
+    ip_sample_rate = Column(Integer)
     comment = Column(Text)
 
     def __init__(
@@ -37,10 +90,18 @@ class Report(BaseReport):
         get_count=0,
         head_count=0,
         options_count=0,
+        browser_ua_count=0,
+        bot_ua_count=0,
+        headless_ua_count=0,
+        script_ua_count=0,
+        empty_ua_count=0,
+        other_ua_count=0,
+        sampled=False,
         comment="",
+        ip_sample_rate=None,
     ):
         """
-        @param source_ip: Source IPv4 address
+        @param source_ip: Source IPv4 or IPv6 address
         @type source_ip: str
         @param latest: Datetime of latest request
         @type latest: datetime
@@ -62,8 +123,25 @@ class Report(BaseReport):
         @type head_count: int
         @param options_count: Total number of OPTIONS requests
         @type options_count: int
+        @param browser_ua_count: Total number of requests from browsers
+        @type browser_ua_count: int
+        @param bot_ua_count: Total number of requests from crawlers and other bots
+        @type bot_ua_count: int
+        @param headless_ua_count: Total number of requests from headless browsers
+        @type headless_ua_count: int
+        @param script_ua_count: Total number of requests from HTTP libraries and command line clients
+        @type script_ua_count: int
+        @param empty_ua_count: Total number of requests without user agent
+        @type empty_ua_count: int
+        @param other_ua_count: Total number of requests with an unrecognised user agent
+        @type other_ua_count: int
+        @param sampled: Events were sampled, counts are estimates unless only IPs were
+        @type sampled: bool
         @param comment: Comment about IP address
         @type comment: str
+        @param ip_sample_rate: Sampling rate the IP was kept with, None if IPs weren't
+            sampled
+        @type ip_sample_rate: int | None
         """
         self.source_ip = source_ip
         self.latest = latest
@@ -76,6 +154,14 @@ class Report(BaseReport):
         self.get_count = get_count
         self.head_count = head_count
         self.options_count = options_count
+        self.browser_ua_count = browser_ua_count
+        self.bot_ua_count = bot_ua_count
+        self.headless_ua_count = headless_ua_count
+        self.script_ua_count = script_ua_count
+        self.empty_ua_count = empty_ua_count
+        self.other_ua_count = other_ua_count
+        self.sampled = sampled
+        self.ip_sample_rate = ip_sample_rate
         self.comment = comment
 
     def __repr__(self):
@@ -92,6 +178,7 @@ class Report(BaseReport):
         """
         report_db_session.add(self)
         report_db_session.commit()
+        bump_generation()
         return self
 
     @staticmethod
@@ -105,6 +192,7 @@ class Report(BaseReport):
         if reports_to_save:
             report_db_session.add_all(reports_to_save)
             report_db_session.commit()
+            bump_generation()
             return True
         else:
             return False
@@ -117,6 +205,7 @@ class Report(BaseReport):
         try:
             report_db_session.delete(self)
             report_db_session.commit()
+            bump_generation()
         except Exception as e:
             print("Error '{}' when deleting {}".format(e, self))
             return False
@@ -125,44 +214,428 @@ class Report(BaseReport):
     @staticmethod
     def get_by_ip(ip_address):
         """
-        Find Report by IP address
+        Find Report by IP address, served from report_cache until the next write
         @param ip_address: IP address
         @type ip_address: str
         @rtype: Report
         """
-        return Report.query.filter(Report.source_ip == ip_address).first()
+        return report_cache.get(
+            ("get_by_ip", ip_address),
+            lambda: Report.query.filter(Report.source_ip == ip_address).first(),
+        )
+
+
+class PrefixReport(BaseReport):
+    """
+    Report counts rolled up over all IPs of a network
+    """
+
+    __tablename__ = "prefix_reports"
+    id = Column(Integer, primary_key=True)
+    prefix = Column(String(100))
+    prefix_length = Column(Integer)
+    ip_count = Column(Integer)
+    latest = Column(DateTime)
+    total_count = Column(Integer)
+    post_login_count = Column(Integer)
+    get_login_count = Column(Integer)
+    get_4xx_count = Column(Integer)
+    post_4xx_count = Column(Integer)
+    post_count = Column(Integer)
+    get_count = Column(Integer)
+    head_count = Column(Integer)
+    options_count = Column(Integer)
+    browser_ua_count = Column(Integer)
+    bot_ua_count = Column(Integer)
+    headless_ua_count = Column(Integer)
+    script_ua_count = Column(Integer)
+    empty_ua_count = Column(Integer)
+    other_ua_count = Column(Integer)
+    sampled = Column(Boolean)
+
+    def __init__(self, prefix, prefix_length):
+        """
+        @param prefix: Network in CIDR notation
+        @type prefix: str
+        @param prefix_length: Network prefix length
+        @type prefix_length: int
+        """
+        self.prefix = prefix
+        self.prefix_length = prefix_length
+        self.ip_count = 0
+        self.latest = None
+        self.sampled = False
+        for field in COUNT_FIELDS:
+            setattr(self, field, 0)
+
+    def __repr__(self):
+        """
+        String representation
+        @rtype: str
+        """
+        return "<{} {}>".format(self.__class__.__name__, self.__dict__)
+
+    def add(self, report):
+        """
+        Add counts of a single IP, scaled up if it was kept by IP sampling
+        @param report: Report of an IP in this network
+        @type report: Report
+        """
+        self.ip_count += 1
+        if report.latest is not None and (
+            self.latest is None or report.latest > self.latest
+        ):
+            self.latest = report.latest
+        self.sampled = self.sampled or bool(report.sampled)
+        scale = report.ip_sample_rate or 1
+        for field in COUNT_FIELDS:
+            setattr(
+                self,
+                field,
+                getattr(self, field) + (getattr(report, field) or 0) * scale,
+            )
+
+    @staticmethod
+    def save_all(reports_to_save):
+        """
+        Replace all prefix reports
+        @param reports_to_save: List of PrefixReport objects to save
+        @type reports_to_save: list[PrefixReport]
+        """
+        PrefixReport.query.delete()
+        report_db_session.add_all(reports_to_save)
+        report_db_session.commit()
+        bump_generation()
+
+    @staticmethod
+    def get_by_prefix(prefix):
+        """
+        Find PrefixReport by network
+        @param prefix: Network in CIDR notation
+        @type prefix: str
+        @rtype: PrefixReport
+        """
+        return PrefixReport.query.filter(PrefixReport.prefix == prefix).first()
+
+
+class RouteReport(BaseReport):
+    """
+    Report counts rolled up over all requests to a route
+    """
+
+    __tablename__ = "route_reports"
+    id = Column(Integer, primary_key=True)
+    route = Column(String(1000), index=True)
+    ip_count = Column(Integer)
+    latest = Column(DateTime)
+    # GET and POST requests with 4XX result code, indexed to find scanned endpoints
+    error_count = Column(Integer, index=True)
+    total_count = Column(Integer)
+    post_login_count = Column(Integer)
+    get_login_count = Column(Integer)
+    get_4xx_count = Column(Integer)
+    post_4xx_count = Column(Integer)
+    post_count = Column(Integer)
+    get_count = Column(Integer)
+    head_count = Column(Integer)
+    options_count = Column(Integer)
+
+    def __init__(self, route):
+        """
+        @param route: Normalised URL path
+        @type route: str
+        """
+        self.route = route
+        self.ip_count = 0
+        self.latest = None
+        self.error_count = 0
+        self.total_count = 0
+        for field in EVENT_COUNT_FIELDS:
+            setattr(self, field, 0)
+
+    def __repr__(self):
+        """
+        String representation
+        @rtype: str
+        """
+        return "<{} {}>".format(self.__class__.__name__, self.__dict__)
+
+    @staticmethod
+    def save_all(reports_to_save):
+        """
+        Replace all route reports
+        @param reports_to_save: List of RouteReport objects to save
+        @type reports_to_save: list[RouteReport]
+        """
+        RouteReport.query.delete()
+        report_db_session.add_all(reports_to_save)
+        report_db_session.commit()
+        bump_generation()
+
+    @staticmethod
+    def get_by_route(route):
+        """
+        Find RouteReport by route
+        @param route: Normalised URL path
+        @type route: str
+        @rtype: RouteReport
+        """
+        return RouteReport.query.filter(RouteReport.route == route).first()
+
+    @staticmethod
+    def get_most_errors(limit=20):
+        """
+        Routes with most 4XX responses, e.g. endpoints being scanned
+        @param limit: Maximum number of routes
+        @type limit: int
+        @rtype: list[RouteReport]
+        """
+        return (
+            RouteReport.query.filter(RouteReport.error_count > 0)
+            .order_by(RouteReport.error_count.desc())
+            .limit(limit)
+            .all()
+        )
+
+
+def get_prefix_reports(reports):
+    """
+    Roll per-IP counts up into networks of PREFIX_LENGTHS
+    @param reports: Reports with all counts set
+    @type reports: collections.Iterable[Report]
+    @return: Dict with network as key and PrefixReport as value,
+        only networks with classified events
+    @rtype: dict
+    """
+    prefix_reports = dict()
+    for report in reports:
+        for ipv4_length, ipv6_length in PREFIX_LENGTHS:
+            prefix = get_prefix(report.source_ip, ipv4_length, ipv6_length)
+            if prefix is None:
+                break
+            prefix_report = prefix_reports.get(prefix)
+            if prefix_report is None:
+                prefix_report = prefix_reports[prefix] = PrefixReport(
+                    prefix, int(prefix.rsplit("/", 1)[1])
+                )
+            prefix_report.add(report)
+    return {
+        prefix: r
+        for prefix, r in prefix_reports.items()
+        if any(getattr(r, field) for field in EVENT_COUNT_FIELDS)
+    }
+
+
+def get_route_reports(shard_dir=SHARD_DIR, start=None, end=None):
+    """
+    Roll events up per route, events saved before routes existed are left out
+    @param shard_dir: Read events from shard files in this directory instead of the processor DB
+    @type shard_dir: str
+    @param start: Only shard events at or after this datetime
+    @type start: datetime | None
+    @param end: Only shard events before this datetime
+    @type end: datetime | None
+    @return: Dict with route as key and RouteReport as value
+    @rtype: dict
+    """
+    if shard_dir:
+        where, params = get_shard_filter(start, end)
+        where += " AND " if where else " WHERE "
+        shard_paths = list_shards(shard_dir, start, end)
+        grouped_events = [
+            (route_id, event_type, count, to_datetime(latest))
+            for route_id, event_type, count, latest in query_shards(
+                shard_paths,
+                "SELECT route_id, event_type, sum({}), max(date_time) "
+                "FROM events{}route_id IS NOT NULL "
+                "GROUP BY route_id, event_type".format(TOTAL_WEIGHT_SQL, where),
+                params,
+            )
+        ]
+        # Distinct IPs of a route can't be summed over groups of attached shards
+        ips = dict()
+        for route_id, ip in query_shards(
+            shard_paths,
+            "SELECT DISTINCT route_id, source_ip FROM events{}"
+            "route_id IS NOT NULL".format(where),
+            params,
+        ):
+            ips.setdefault(route_id, set()).add(ip)
+        ip_counts = {route_id: len(route_ips) for route_id, route_ips in ips.items()}
+    else:
+        grouped_events = (
+            processor_db_session.query(
+                Event.route_id,
+                Event.event_type,
+                func.sum(TOTAL_WEIGHT),
+                func.max(Event.date_time),
+            )
+            .filter(Event.route_id.isnot(None))
+            .group_by(Event.route_id, Event.event_type)
+            .all()
+        )
+        ip_counts = dict(
+            processor_db_session.query(
+                Event.route_id, func.count(Event.source_ip.distinct())
+            )
+            .filter(Event.route_id.isnot(None))
+            .group_by(Event.route_id)
+            .all()
+        )
+
+    names = get_route_names(ip_counts)
+    reports = dict()
+    for route_id, event_type, count, latest in grouped_events:
+        route = names.get(route_id)
+        if route is None:
+            continue
+        report = reports.get(route)
+        if report is None:
+            report = reports[route] = RouteReport(route)
+            report.ip_count = ip_counts[route_id]
+        if report.latest is None or latest > report.latest:
+            report.latest = latest
+        report.total_count += count
+        if event_type is not None:
+            field = "{}_count".format(event_type)
+            setattr(report, field, getattr(report, field) + count)
+    for report in reports.values():
+        report.error_count = report.get_4xx_count + report.post_4xx_count
+    return reports
+
+
+def get_shard_filter(start=None, end=None):
+    """
+    WHERE clause and parameters restricting shard queries to a time window
+    @param start: Window start
+    @type start: datetime | None
+    @param end: Window end (exclusive)
+    @type end: datetime | None
+    @rtype: (str, dict)
+    """
+    conditions = list()
+    params = dict()
+    if start is not None:
+        conditions.append("date_time >= :start")
+        params["start"] = str(start.replace(tzinfo=None))
+    if end is not None:
+        conditions.append("date_time < :end")
+        params["end"] = str(end.replace(tzinfo=None))
+    return (" WHERE " + " AND ".join(conditions) if conditions else ""), params
 
 
-def get_base_reports():
+def get_base_reports(shard_dir=SHARD_DIR, start=None, end=None):
     """
-    Generate reports with IP, total count and latest request date
+    Generate reports with IP, total count and latest request date, counts of events
+    kept by line sampling are scaled by their sampling rate
+    @param shard_dir: Read events from shard files in this directory instead of the processor DB
+    @type shard_dir: str
+    @param start: Only shard events at or after this datetime
+    @type start: datetime | None
+    @param end: Only shard events before this datetime
+    @type end: datetime | None
     @return: Dict with IP as key and Report as value
     @rtype: dict
     """
     reports = dict()
+    if shard_dir:
+        where, params = get_shard_filter(start, end)
+        grouped_events = query_shards(
+            list_shards(shard_dir, start, end),
+            "SELECT source_ip, max(date_time), sum({}), max(sample_rate), "
+            "max(ip_sample_rate) FROM events{} GROUP BY source_ip".format(
+                EVENT_WEIGHT_SQL, where
+            ),
+            params,
+        )
+        # Every group of attached shards yields its own partial row per IP
+        for ip, latest, count, sample_rate, ip_sample_rate in grouped_events:
+            latest = to_datetime(latest)
+            sampled = is_sampled(sample_rate, ip_sample_rate)
+            report = reports.get(ip)
+            if report is None:
+                reports[ip] = Report(
+                    ip,
+                    latest,
+                    count,
+                    sampled=sampled,
+                    ip_sample_rate=ip_sample_rate,
+                )
+            else:
+                report.total_count += count
+                report.latest = max(report.latest, latest)
+                report.sampled = report.sampled or sampled
+                if ip_sample_rate:
+                    report.ip_sample_rate = max(
+                        report.ip_sample_rate or 1, ip_sample_rate
+                    )
+        return reports
+
     grouped_events = (
         processor_db_session.query(
-            Event.source_ip, func.max(Event.date_time), func.count(Event.source_ip)
+            Event.source_ip,
+            func.max(Event.date_time),
+            func.sum(EVENT_WEIGHT),
+            func.max(Event.sample_rate),
+            func.max(Event.ip_sample_rate),
         )
         .group_by(Event.source_ip)
         .all()
     )
-    for g in grouped_events:
-        reports[g[0]] = Report(g[0], g[1], g[2])
+    for ip, latest, count, sample_rate, ip_sample_rate in grouped_events:
+        reports[ip] = Report(
+            ip,
+            latest,
+            count,
+            sampled=is_sampled(sample_rate, ip_sample_rate),
+            ip_sample_rate=ip_sample_rate,
+        )
     return reports
 
 
-def get_counts_by_event_type(event_type):
+def is_sampled(sample_rate, ip_sample_rate):
+    """
+    Were events kept by line or IP sampling
+    @param sample_rate: Highest line sampling rate of the events
+    @type sample_rate: int | None
+    @param ip_sample_rate: Highest IP sampling rate of the events
+    @type ip_sample_rate: int | None
+    @rtype: bool
+    """
+    return max(sample_rate or 1, ip_sample_rate or 1) > 1
+
+
+def get_counts_by_event_type(event_type, shard_dir=SHARD_DIR, start=None, end=None):
     """
     Generate updates for all IPs for a given EventType
     @param event_type: EventType to generate report for
     @type event_type: EventType
+    @param shard_dir: Read events from shard files in this directory instead of the processor DB
+    @type shard_dir: str
+    @param start: Only shard events at or after this datetime
+    @type start: datetime | None
+    @param end: Only shard events before this datetime
+    @type end: datetime | None
     @return: Dict with IP as key and count as value
     @rtype: dict
     """
     counts = dict()
+    if shard_dir:
+        where, params = get_shard_filter(start, end)
+        where += " AND " if where else " WHERE "
+        params["event_type"] = event_type.name
+        grouped_events = query_shards(
+            list_shards(shard_dir, start, end),
+            "SELECT source_ip, sum({}) FROM events{}event_type = :event_type "
+            "GROUP BY source_ip".format(EVENT_WEIGHT_SQL, where),
+            params,
+        )
+        for ip, count in grouped_events:
+            counts[ip] = counts.get(ip, 0) + count
+        return counts
+
     grouped_events = (
-        processor_db_session.query(Event.source_ip, func.count(Event.source_ip))
+        processor_db_session.query(Event.source_ip, func.sum(EVENT_WEIGHT))
         .group_by(Event.source_ip)
         .filter(Event.event_type == event_type.name)
         .all()
@@ -172,6 +645,91 @@ def get_counts_by_event_type(event_type):
     return counts
 
 
+def get_counts_by_ua_class(shard_dir=SHARD_DIR, start=None, end=None):
+    """
+    Generate updates for all IPs for every UserAgentClass in a single GROUP BY
+    @param shard_dir: Read events from shard files in this directory instead of the processor DB
+    @type shard_dir: str
+    @param start: Only shard events at or after this datetime
+    @type start: datetime | None
+    @param end: Only shard events before this datetime
+    @type end: datetime | None
+    @return: Dict with IP as key and dict with UserAgentClass value as key and count as value
+    @rtype: dict
+    """
+    if shard_dir:
+        where, params = get_shard_filter(start, end)
+        where += " AND " if where else " WHERE "
+        grouped_events = query_shards(
+            list_shards(shard_dir, start, end),
+            "SELECT source_ip, ua_class, sum({}) FROM events{}"
+            "ua_class IS NOT NULL GROUP BY source_ip, ua_class".format(
+                EVENT_WEIGHT_SQL, where
+            ),
+            params,
+        )
+    else:
+        grouped_events = (
+            processor_db_session.query(
+                Event.source_ip, Event.ua_class, func.sum(EVENT_WEIGHT)
+            )
+            .filter(Event.ua_class.isnot(None))
+            .group_by(Event.source_ip, Event.ua_class)
+            .all()
+        )
+    counts = dict()
+    for ip, ua_class, count in grouped_events:
+        class_counts = counts.setdefault(ip, dict())
+        class_counts[ua_class] = class_counts.get(ua_class, 0) + count
+    return counts
+
+
+def get_ua_class_counts(event_types=None, shard_dir=SHARD_DIR, start=None, end=None):
+    """
+    Number of events per UserAgentClass over all IPs
+    @param event_types: Only count events of these types, all events if None
+    @type event_types: list[EventType] | None
+    @param shard_dir: Read events from shard files in this directory instead of the processor DB
+    @type shard_dir: str
+    @param start: Only shard events at or after this datetime
+    @type start: datetime | None
+    @param end: Only shard events before this datetime
+    @type end: datetime | None
+    @return: Dict with UserAgentClass as key and count as value, unclassified events
+        stored before ua_class existed are left out
+    @rtype: dict
+    """
+    type_names = [e.name for e in event_types] if event_types else None
+    if shard_dir:
+        where, params = get_shard_filter(start, end)
+        where += " AND " if where else " WHERE "
+        if type_names:
+            where += "event_type IN ({}) AND ".format(
+                ", ".join(":type{}".format(i) for i in range(len(type_names)))
+            )
+            params.update(
+                {"type{}".format(i): name for i, name in enumerate(type_names)}
+            )
+        grouped_events = query_shards(
+            list_shards(shard_dir, start, end),
+            "SELECT ua_class, sum({}) FROM events{}"
+            "ua_class IS NOT NULL GROUP BY ua_class".format(TOTAL_WEIGHT_SQL, where),
+            params,
+        )
+    else:
+        query = processor_db_session.query(
+            Event.ua_class, func.sum(TOTAL_WEIGHT)
+        ).filter(Event.ua_class.isnot(None))
+        if type_names:
+            query = query.filter(Event.event_type.in_(type_names))
+        grouped_events = query.group_by(Event.ua_class).all()
+    counts = dict()
+    for ua_class, count in grouped_events:
+        ua_class = UserAgentClass(ua_class)
+        counts[ua_class] = counts.get(ua_class, 0) + count
+    return counts
+
+
 def get_comments_by_ip():
     """
     Get comment for a given IP address, if exists
@@ -192,33 +750,390 @@ def delete_all_reports():
     report_db_session.execute(text("""DROP TABLE `{}`;""".format(Report.__tablename__)))
     report_db_session.commit()
     report_db_session.close()
+    bump_generation()
     init_db()
 
 
-def generate_reports(save=False):
+def generate_reports(
+    save=False,
+    shard_dir=SHARD_DIR,
+    start=None,
+    end=None,
+    export_partial=None,
+    with_sketches=False,
+):
     """
-    Generate full reports
+    Generate full reports, served from report_cache until the next write when not saved
+    or exported
     @param save: Persist to DB
     @type save: bool
+    @param shard_dir: Read events from shard files in this directory instead of the processor DB
+    @type shard_dir: str
+    @param start: Only shard events at or after this datetime
+    @type start: datetime | None
+    @param end: Only shard events before this datetime
+    @type end: datetime | None
+    @param export_partial: Also write a mergeable partial aggregate to this file
+    @type export_partial: str | None
+    @param with_sketches: Include distinct-count sketches in the partial aggregate
+    @type with_sketches: bool
     @return: Dict with IP as key and Report as value
     @rtype: dict
     """
-    full_reports = dict()
-    base_reports = get_base_reports()
-    all_comments = get_comments_by_ip()
+    if not save and not export_partial:
+        paths = get_db_files()
+        if shard_dir:
+            paths += list_shards(shard_dir, start, end)
+        return dict(
+            report_cache.get(
+                ("generate_reports", shard_dir, start, end),
+                lambda: compute_reports(shard_dir=shard_dir, start=start, end=end),
+                paths,
+            )
+        )
+    return compute_reports(save, shard_dir, start, end, export_partial, with_sketches)
+
+
+def compute_reports(
+    save=False,
+    shard_dir=SHARD_DIR,
+    start=None,
+    end=None,
+    export_partial=None,
+    with_sketches=False,
+):
+    """
+    Generate full reports from the events, bypassing report_cache
+    @param save: Persist to DB
+    @type save: bool
+    @param shard_dir: Read events from shard files in this directory instead of the processor DB
+    @type shard_dir: str
+    @param start: Only shard events at or after this datetime
+    @type start: datetime | None
+    @param end: Only shard events before this datetime
+    @type end: datetime | None
+    @param export_partial: Also write a mergeable partial aggregate to this file
+    @type export_partial: str | None
+    @param with_sketches: Include distinct-count sketches in the partial aggregate
+    @type with_sketches: bool
+    @return: Dict with IP as key and Report as value
+    @rtype: dict
+    """
+    base_reports = get_base_reports(shard_dir, start, end)
     for event_type in EventType:
-        counts = get_counts_by_event_type(event_type)
+        counts = get_counts_by_event_type(event_type, shard_dir, start, end)
         for ip, count in counts.items():
-            base_report = base_reports[ip]
-            setattr(base_report, "{}_count".format(event_type.name), count)
-            base_report.comment = all_comments.get(ip, "")
-            full_reports[ip] = base_report
+            setattr(base_reports[ip], "{}_count".format(event_type.name), count)
+    for ip, class_counts in get_counts_by_ua_class(shard_dir, start, end).items():
+        for ua_class, count in class_counts.items():
+            setattr(
+                base_reports[ip],
+                "{}_ua_count".format(UserAgentClass(ua_class).name),
+                count,
+            )
+    if save:
+        RouteReport.save_all(list(get_route_reports(shard_dir, start, end).values()))
+    if export_partial:
+        sketches = get_partial_sketches(start, end) if with_sketches else None
+        export_partial_reports(base_reports.values(), export_partial, sketches)
+    return finish_reports(base_reports, save)
+
+
+def finish_reports(base_reports, save=False):
+    """
+    Keep reports of IPs with classified events, attach comments and optionally persist
+    them with network rollups and publish them as a binary index
+    @param base_reports: Dict with IP as key and Report with all counts as value
+    @type base_reports: dict
+    @param save: Persist to DB
+    @type save: bool
+    @return: Dict with IP as key and Report as value
+    @rtype: dict
+    """
+    full_reports = dict()
+    all_comments = get_comments_by_ip()
+    for ip, report in base_reports.items():
+        if any(getattr(report, field) for field in EVENT_COUNT_FIELDS):
+            report.comment = all_comments.get(ip, "")
+            full_reports[ip] = report
     if save and full_reports:
         delete_all_reports()
         Report.save_all(list(full_reports.values()))
+        PrefixReport.save_all(list(get_prefix_reports(base_reports.values()).values()))
+        write_report_index(full_reports.values(), get_index_file(), COUNT_FIELDS)
     return full_reports
 
 
+def get_partial_sketches(start=None, end=None):
+    """
+    Distinct-count sketches of this node per dimension and EventType
+    @param start: Window start
+    @type start: datetime | None
+    @param end: Window end (exclusive)
+    @type end: datetime | None
+    @return: Dict with "dimension/event_type" as key and HyperLogLog as value
+    @rtype: dict
+    """
+    sketches = dict()
+    for dimension in SKETCH_DIMENSIONS:
+        for event_type in EventType:
+            sketch = merge_sketches(dimension, start, end, [event_type])
+            if sketch is not None:
+                sketches["{}/{}".format(dimension, event_type.name)] = sketch
+    return sketches
+
+
+def export_partial_reports(reports, file_name, sketches=None, node=None):
+    """
+    Write per-IP counters as a compact gzipped JSON partial aggregate,
+    its size grows with distinct IPs rather than with requests
+    @param reports: Reports with all counts set, including IPs without classified events
+    @type reports: collections.Iterable[Report]
+    @param file_name: Partial file to write
+    @type file_name: str
+    @param sketches: Dict with "dimension/event_type" as key and HyperLogLog as value
+    @type sketches: dict | None
+    @param node: Node name, defaults to host name
+    @type node: str | None
+    @return: Number of exported IPs
+    @rtype: int
+    """
+    rows = [
+        [r.source_ip, r.latest.isoformat() if r.latest else None]
+        + [getattr(r, field) or 0 for field in COUNT_FIELDS]
+        + [bool(r.sampled), r.ip_sample_rate]
+        for r in reports
+    ]
+    partial = {
+        "version": PARTIAL_VERSION,
+        "node": node or socket.gethostname(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "fields": ["source_ip", "latest"]
+        + COUNT_FIELDS
+        + ["sampled", "ip_sample_rate"],
+        "reports": rows,
+        "sketches": {
+            key: base64.b64encode(sketch.to_bytes()).decode("ascii")
+            for key, sketch in (sketches or dict()).items()
+        },
+    }
+    with gzip.open(file_name, "wt", encoding="utf-8") as f:
+        json.dump(partial, f, separators=(",", ":"))
+    return len(rows)
+
+
+def load_partial_reports(file_name):
+    """
+    Read a partial aggregate written by export_partial_reports()
+    @param file_name: Partial file
+    @type file_name: str
+    @rtype: dict
+    """
+    with gzip.open(file_name, "rt", encoding="utf-8") as f:
+        partial = json.load(f)
+    if partial.get("version") != PARTIAL_VERSION:
+        raise ValueError(
+            "Unsupported partial report version {} in '{}'".format(
+                partial.get("version"), file_name
+            )
+        )
+    return partial
+
+
+def merge_partial_reports(file_names, save=False):
+    """
+    Combine partial aggregates of many nodes, result equals reports over all their events
+    @param file_names: Partial files
+    @type file_names: list[str]
+    @param save: Persist merged reports to DB
+    @type save: bool
+    @return: Dict with IP as key and Report as value, dict with merged sketches
+    @rtype: (dict, dict)
+    """
+    base_reports = dict()
+    sketches = dict()
+    for file_name in file_names:
+        partial = load_partial_reports(file_name)
+        fields = partial["fields"]
+        for row in partial["reports"]:
+            values = dict(zip(fields, row))
+            ip = values["source_ip"]
+            latest = to_datetime(values["latest"])
+            report = base_reports.get(ip)
+            if report is None:
+                report = base_reports[ip] = Report(ip, latest, 0)
+            elif latest is not None and (
+                report.latest is None or latest > report.latest
+            ):
+                report.latest = latest
+            for field in COUNT_FIELDS:
+                setattr(report, field, getattr(report, field) + values.get(field, 0))
+            report.sampled = report.sampled or values.get("sampled", False)
+            if values.get("ip_sample_rate"):
+                report.ip_sample_rate = max(
+                    report.ip_sample_rate or 1, values["ip_sample_rate"]
+                )
+        for key, encoded in partial["sketches"].items():
+            sketch = HyperLogLog.from_bytes(base64.b64decode(encoded))
+            if key in sketches:
+                sketches[key].merge(sketch)
+            else:
+                sketches[key] = sketch
+    return finish_reports(base_reports, save), sketches
+
+
 if __name__ == "__main__":
-    saved_reports = generate_reports(save=True)
-    print("Saved {} reports".format(len(saved_reports)))
+    parser = argparse.ArgumentParser(description="Generate reports from parsed events")
+    parser.add_argument(
+        "--distinct",
+        "-d",
+        help="Only estimate number of distinct values of an attribute",
+        choices=SKETCH_DIMENSIONS,
+        required=False,
+    )
+    parser.add_argument(
+        "--user-agents",
+        help="Only count events per user agent class",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--scanned-routes",
+        help="Only print this many routes with most 4XX responses, from the last saved reports",
+        type=int,
+        required=False,
+    )
+    parser.add_argument(
+        "--event",
+        "-e",
+        help="Event type(s) to include in distinct count or user agent class counts",
+        type=int,
+        action="append",
+        required=False,
+    )
+    parser.add_argument(
+        "--start",
+        help="Window start (ISO 8601) for distinct counts and sharded reports",
+        type=str,
+    )
+    parser.add_argument(
+        "--end",
+        help="Window end, exclusive (ISO 8601) for distinct counts and sharded reports",
+        type=str,
+    )
+    parser.add_argument(
+        "--shard-dir",
+        help="Report on shard files in this directory",
+        type=str,
+        default=SHARD_DIR,
+    )
+    parser.add_argument(
+        "--retention-days",
+        help="Delete shard files older than this many days before reporting",
+        type=int,
+        required=False,
+    )
+    parser.add_argument(
+        "--export-partial",
+        help="Also write a mergeable partial aggregate of this node to this file",
+        type=str,
+        required=False,
+    )
+    parser.add_argument(
+        "--with-sketches",
+        help="Include distinct-count sketches in the partial aggregate",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--merge",
+        help="Merge partial aggregates of many nodes into the reports table",
+        nargs="+",
+        required=False,
+    )
+    parser.add_argument(
+        "--from-log",
+        help="Compute reports in memory from log file(s) with NumPy instead of the events DB",
+        type=str,
+        required=False,
+    )
+    parser.add_argument(
+        "--profile",
+        help="Write CPU profiles and allocation summaries of counting stages here",
+        type=str,
+        required=False,
+    )
+    args = parser.parse_args()
+    init_db()
+    if args.profile:
+        run_profiler = Profiler(args.profile)
+        run_profiler.install(sys.modules[__name__], ["get_counts_by_event_type"])
+        # Parsing stages of --from-log
+        run_profiler.install(sys.modules[Event.__module__], PROFILED_FUNCTIONS)
+        atexit.register(run_profiler.finish)
+    window_start = datetime.fromisoformat(args.start) if args.start else None
+    window_end = datetime.fromisoformat(args.end) if args.end else None
+    if args.shard_dir and args.retention_days is not None:
+        for deleted in delete_shards_older_than(args.shard_dir, args.retention_days):
+            print("Deleted shard {}".format(deleted))
+    if args.distinct:
+        count, error = distinct_count(
+            args.distinct,
+            window_start,
+            window_end,
+            [EventType(e) for e in args.event] if args.event else None,
+        )
+        print("Distinct {}: ~{} (+/- {:.1%})".format(args.distinct, count, error))
+    elif args.scanned_routes:
+        for route_report in RouteReport.get_most_errors(args.scanned_routes):
+            print(
+                "{}: {} 4XX of {} requests from {} IPs, latest {}".format(
+                    route_report.route,
+                    route_report.error_count,
+                    route_report.total_count,
+                    route_report.ip_count,
+                    route_report.latest,
+                )
+            )
+    elif args.user_agents:
+        ua_counts = get_ua_class_counts(
+            [EventType(e) for e in args.event] if args.event else None,
+            args.shard_dir,
+            window_start,
+            window_end,
+        )
+        total = sum(ua_counts.values())
+        for ua_class in UserAgentClass:
+            count = ua_counts.get(ua_class, 0)
+            print(
+                "{}: {} ({:.1%})".format(
+                    ua_class.name, count, count / total if total else 0
+                )
+            )
+    elif args.from_log:
+        # Optional dependency, only needed for in-memory reports
+        from numpy_reports import report_log_files
+
+        # Passed in, numpy_reports importing report would load a second copy of the
+        # models when this file runs as __main__
+        saved_reports = report_log_files(
+            args.from_log, Report, finish_reports, save=True
+        )
+        print("Saved {} reports".format(len(saved_reports)))
+    elif args.merge:
+        saved_reports, merged_sketches = merge_partial_reports(args.merge, save=True)
+        print("Saved {} reports".format(len(saved_reports)))
+        for key, sketch in sorted(merged_sketches.items()):
+            print(
+                "Distinct {}: ~{} (+/- {:.1%})".format(
+                    key, sketch.count(), sketch.std_error
+                )
+            )
+    else:
+        saved_reports = generate_reports(
+            True,
+            args.shard_dir,
+            window_start,
+            window_end,
+            args.export_partial,
+            args.with_sketches,
+        )
+        print("Saved {} reports".format(len(saved_reports)))
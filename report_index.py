@@ -0,0 +1,213 @@
+import argparse
+import calendar
+import mmap
+import os
+import socket
+import struct
+from datetime import datetime, timedelta
+
+MAGIC = b"LPRIDX01"
+# Magic, record count, record size, number of counters
+HEADER = struct.Struct("<8sIII")
+FIELD_NAME_SIZE = 32
+KEY_SIZE = 16
+IPV4_MAPPED_PREFIX = b"\x00" * 10 + b"\xff\xff"
+EPOCH = datetime(1970, 1, 1)
+
+
+def get_index_file():
+    """
+    Path of the published report index: REPORT_INDEX_FILE or the report DB path with .idx
+    @rtype: str
+    """
+    index_file = os.environ.get("REPORT_INDEX_FILE")
+    if index_file:
+        return index_file
+    return os.path.splitext(os.environ["REPORT_DB_FILE"])[0] + ".idx"
+
+
+def get_key(ip_address):
+    """
+    Fixed-width sortable key: IPv6 address, IPv4 as IPv4-mapped IPv6
+    @param ip_address: IP address
+    @type ip_address: str
+    @return: 16 bytes or None if ip_address is not an IP address
+    @rtype: bytes | None
+    """
+    try:
+        return IPV4_MAPPED_PREFIX + socket.inet_pton(socket.AF_INET, ip_address)
+    except OSError:
+        pass
+    try:
+        return socket.inet_pton(socket.AF_INET6, ip_address)
+    except OSError:
+        return None
+
+
+def get_record_struct(counters):
+    """
+    Record layout: key, latest as epoch seconds, counters
+    @param counters: Number of counters
+    @type counters: int
+    @rtype: struct.Struct
+    """
+    return struct.Struct("<{}sq{}I".format(KEY_SIZE, counters))
+
+
+def write_report_index(reports, file_name, fields):
+    """
+    Publish reports as a sorted fixed-width binary snapshot.
+    Written to a temporary file and renamed over the old one, so readers
+    see either the previous or the new snapshot, never a partial one.
+    @param reports: Reports to publish
+    @type reports: collections.Iterable[report.Report]
+    @param file_name: Index file
+    @type file_name: str
+    @param fields: Report counter attributes to store
+    @type fields: list[str]
+    @return: Number of published records
+    @rtype: int
+    """
+    record = get_record_struct(len(fields))
+    records = list()
+    for report in reports:
+        key = get_key(report.source_ip)
+        if key is None:
+            continue
+        latest = calendar.timegm(report.latest.timetuple()) if report.latest else 0
+        records.append(
+            record.pack(key, latest, *[getattr(report, f) or 0 for f in fields])
+        )
+    records.sort()
+
+    temp_file = "{}.{}.tmp".format(file_name, os.getpid())
+    with open(temp_file, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(records), record.size, len(fields)))
+        for field in fields:
+            f.write(field.encode("ascii").ljust(FIELD_NAME_SIZE, b"\0"))
+        f.writelines(records)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, file_name)
+    return len(records)
+
+
+class ReportIndex(object):
+    """
+    Read-only memory-mapped view of a published report index with binary search lookups
+    """
+
+    def __init__(self, file_name=None):
+        """
+        @param file_name: Index file, defaults to get_index_file()
+        @type file_name: str | None
+        """
+        self.file_name = file_name or get_index_file()
+        self.map = None
+        self.inode = None
+        self._open()
+
+    def __repr__(self):
+        """
+        String representation
+        @rtype: str
+        """
+        return "<{} {} records={}>".format(
+            self.__class__.__name__, self.file_name, self.count
+        )
+
+    def __len__(self):
+        """
+        Number of records
+        @rtype: int
+        """
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _open(self):
+        """
+        Map the current snapshot
+        """
+        with open(self.file_name, "rb") as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            new_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, record_size, counters = HEADER.unpack_from(new_map, 0)
+        if magic != MAGIC:
+            new_map.close()
+            raise ValueError("'{}' is not a report index".format(self.file_name))
+        self.close()
+        self.map = new_map
+        self.count = count
+        self.record_size = record_size
+        self.record = get_record_struct(counters)
+        self.fields = [
+            new_map[offset : offset + FIELD_NAME_SIZE].rstrip(b"\0").decode("ascii")
+            for offset in range(
+                HEADER.size, HEADER.size + counters * FIELD_NAME_SIZE, FIELD_NAME_SIZE
+            )
+        ]
+        self.offset = HEADER.size + counters * FIELD_NAME_SIZE
+
+    def reload_if_changed(self):
+        """
+        Switch to a newly published snapshot
+        @return: True if a new snapshot was mapped
+        @rtype: bool
+        """
+        if os.stat(self.file_name).st_ino == self.inode:
+            return False
+        self._open()
+        return True
+
+    def lookup(self, ip_address):
+        """
+        Find counters of an IP address
+        @param ip_address: IP address
+        @type ip_address: str
+        @return: Dict with "latest" and counters, None if not found
+        @rtype: dict | None
+        """
+        key = get_key(ip_address)
+        if key is None:
+            return None
+        data = self.map
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            position = self.offset + middle * self.record_size
+            current = data[position : position + KEY_SIZE]
+            if current < key:
+                low = middle + 1
+            elif current > key:
+                high = middle
+            else:
+                values = self.record.unpack_from(data, position)
+                result = dict(zip(self.fields, values[2:]))
+                result["latest"] = EPOCH + timedelta(seconds=values[1])
+                return result
+        return None
+
+    def close(self):
+        """
+        Unmap the snapshot
+        """
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Look up IP addresses in the published report index"
+    )
+    parser.add_argument("ips", help="IP addresses to look up", nargs="+")
+    parser.add_argument("--index", "-i", help="Index file", type=str, required=False)
+    args = parser.parse_args()
+    with ReportIndex(args.index) as index:
+        for ip in args.ips:
+            print(ip, index.lookup(ip))
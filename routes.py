@@ -0,0 +1,229 @@
+import re
+from functools import lru_cache
+
+from sqlalchemy import Column, Integer, String
+from sqlalchemy.exc import IntegrityError
+
+from database import BaseProcessor, processor_db_session, run_with_retry
+
+# Raw URLs seen while parsing, mostly repeated static assets and login pages
+CACHE_SIZE = 65536
+# Routes looked up or inserted with a single IN query
+LOOKUP_BATCH_SIZE = 500
+NUMERIC_SEGMENT = re.compile(r"^\d+$")
+UUID_SEGMENT = re.compile(
+    r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$"
+)
+# Hashes, object ids and cache busters, at least one digit so words like "deadbeef" stay
+HEX_SEGMENT = re.compile(r"^(?=[a-fA-F]*\d)[0-9a-fA-F]{8,}$")
+
+_templates = list()
+
+
+class Route(BaseProcessor):
+    """
+    Normalised URL path, interned so events store a small integer id
+    """
+
+    __tablename__ = "routes"
+    id = Column(Integer, primary_key=True)
+    route = Column(String(1000), unique=True, index=True)
+
+    def __init__(self, route):
+        """
+        @param route: Normalised URL path
+        @type route: str
+        """
+        self.route = route
+
+    def __repr__(self):
+        """
+        String representation
+        @rtype: str
+        """
+        return "<{} {}>".format(self.__class__.__name__, self.__dict__)
+
+
+def compile_template(template):
+    """
+    Compile a route template: "*" matches one path segment, a trailing "**" the rest
+    of the path
+    @param template: Route template, e.g. /wp-content/plugins/*/**
+    @type template: str
+    @rtype: re.Pattern
+    """
+    parts = list()
+    for segment in template.split("/"):
+        if segment == "**":
+            parts.append(".*")
+        elif segment == "*":
+            parts.append("[^/]+")
+        else:
+            parts.append(re.escape(segment))
+    return re.compile("/".join(parts) + "$")
+
+
+def load_route_templates(file_name):
+    """
+    Load route templates, one per line, "#" starts a comment
+    @param file_name: Templates file
+    @type file_name: str
+    @return: Templates in file order, the first matching template wins
+    @rtype: list[str]
+    """
+    templates = list()
+    with open(file_name) as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                templates.append(line)
+    return templates
+
+
+def set_route_templates(templates):
+    """
+    Map URLs matching one of templates to the template instead of normalising them
+    @param templates: Route templates, the first matching template wins
+    @type templates: list[str] | None
+    """
+    global _templates
+    _templates = [(compile_template(t), t) for t in templates or []]
+    get_route.cache_clear()
+
+
+def normalize_path(path):
+    """
+    Collapse numeric, UUID and hex id segments of a path
+    @param path: URL path without query string
+    @type path: str
+    @rtype: str
+    """
+    segments = path.split("/")
+    for i, segment in enumerate(segments):
+        if NUMERIC_SEGMENT.match(segment):
+            segments[i] = "{id}"
+        elif UUID_SEGMENT.match(segment):
+            segments[i] = "{uuid}"
+        elif HEX_SEGMENT.match(segment):
+            segments[i] = "{hex}"
+    return "/".join(segments)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def get_route(url):
+    """
+    Route of a URL: query string and fragment stripped, then the first configured
+    template matching the path, or the path with id segments collapsed
+    @param url: URL as logged
+    @type url: str | None
+    @return: Route, None if the line had no URL
+    @rtype: str | None
+    """
+    if not url or not url.startswith("/"):
+        return None
+    path = url.split("?", 1)[0].split("#", 1)[0]
+    for pattern, template in _templates:
+        if pattern.match(path):
+            return template
+    return normalize_path(path)[:1000]
+
+
+class RouteTable(object):
+    """
+    Route to id mapping of the processor DB, cached in memory for this process
+    """
+
+    def __init__(self):
+        self.ids = dict()
+        self.bind = None
+
+    def __repr__(self):
+        """
+        String representation
+        @rtype: str
+        """
+        return "<{} routes={}>".format(self.__class__.__name__, len(self.ids))
+
+    def load(self, routes):
+        """
+        Read ids of routes already in the DB into the cache
+        @param routes: Routes not cached yet
+        @type routes: list[str]
+        """
+        for offset in range(0, len(routes), LOOKUP_BATCH_SIZE):
+            batch = routes[offset : offset + LOOKUP_BATCH_SIZE]
+            for route_id, route in processor_db_session.query(
+                Route.id, Route.route
+            ).filter(Route.route.in_(batch)):
+                self.ids[route] = route_id
+
+    def get_ids(self, routes):
+        """
+        Ids of routes, routes seen for the first time are inserted
+        @param routes: Routes, None entries are skipped
+        @type routes: collections.Iterable[str | None]
+        @return: Dict with route as key and id as value
+        @rtype: dict
+        """
+        bind = processor_db_session.get_bind()
+        if bind is not self.bind:
+            # init_db() pointed the session at another DB
+            self.ids.clear()
+            self.bind = bind
+        missing = sorted({r for r in routes if r is not None and r not in self.ids})
+        if missing:
+            self.load(missing)
+        new = [Route(r) for r in missing if r not in self.ids]
+        while new:
+
+            def insert():
+                processor_db_session.add_all(new)
+                processor_db_session.flush()
+                # Read before the commit expires them
+                ids = {route.route: route.id for route in new}
+                processor_db_session.commit()
+                return ids
+
+            try:
+                self.ids.update(run_with_retry(insert, processor_db_session))
+                new = list()
+            except IntegrityError:
+                # Another process inserted some of them first
+                processor_db_session.rollback()
+                self.load(missing)
+                new = [Route(r) for r in missing if r not in self.ids]
+        return self.ids
+
+
+route_table = RouteTable()
+
+
+def intern_routes(events):
+    """
+    Set route_id of events from their route
+    @param events: Events about to be saved
+    @type events: list[log_processor.Event]
+    """
+    ids = route_table.get_ids(e.route for e in events)
+    for event in events:
+        if event.route is not None:
+            event.route_id = ids.get(event.route)
+
+
+def get_route_names(route_ids):
+    """
+    Routes of route ids
+    @param route_ids: Route ids
+    @type route_ids: collections.Iterable[int]
+    @return: Dict with id as key and route as value
+    @rtype: dict
+    """
+    route_ids = sorted(set(route_ids))
+    names = dict()
+    for offset in range(0, len(route_ids), LOOKUP_BATCH_SIZE):
+        batch = route_ids[offset : offset + LOOKUP_BATCH_SIZE]
+        for route_id, route in processor_db_session.query(Route.id, Route.route).filter(
+            Route.id.in_(batch)
+        ):
+            names[route_id] = route
+    return names
@@ -0,0 +1,54 @@
+from zlib import crc32
+
+
+class Sampler(object):
+    """
+    Deterministic 1-in-rate sampling of raw log lines, decided before a line is decoded
+    or parsed. Lines are selected by a hash of the whole line, or of the client address
+    so every event of a sampled IP is kept and its counts stay complete.
+    """
+
+    def __init__(self, rate, by_ip=False, ip_field=0):
+        """
+        @param rate: Keep 1 in rate lines (or IPs)
+        @type rate: int
+        @param by_ip: Sample by client address
+        @type by_ip: bool
+        @param ip_field: Position of the client address among the space separated fields
+            of a line, see LogFormat.ip_field; the first field in the combined, common
+            and nginx formats
+        @type ip_field: int
+        """
+        if rate < 1:
+            raise ValueError("Sampling rate must be at least 1, got {}".format(rate))
+        self.rate = rate
+        self.by_ip = by_ip
+        self.ip_field = ip_field
+
+    def __repr__(self):
+        """
+        String representation
+        @rtype: str
+        """
+        return "<{} 1/{} by {}>".format(
+            self.__class__.__name__, self.rate, "ip" if self.by_ip else "line"
+        )
+
+    def keep(self, raw_line):
+        """
+        Is the line sampled, the same line (or IP) always gets the same answer
+        @param raw_line: A single line read in binary mode
+        @type raw_line: bytes
+        @rtype: bool
+        """
+        if self.rate == 1:
+            return True
+        if self.by_ip and self.ip_field:
+            fields = raw_line.split(b" ", self.ip_field + 1)
+            key = fields[self.ip_field] if len(fields) > self.ip_field else raw_line
+        elif self.by_ip:
+            end = raw_line.find(b" ")
+            key = raw_line[:end] if end >= 0 else raw_line
+        else:
+            key = raw_line.rstrip(b"\r\n")
+        return crc32(key) % self.rate == 0
@@ -0,0 +1,280 @@
+import os
+import re
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, text
+from database import (
+    BaseProcessor,
+    SHARD_DIR,
+    SHARD_PERIOD,
+    add_missing_columns,
+    create_sqlite_engine,
+    run_with_retry,
+)
+
+# SQLITE_MAX_ATTACHED default
+MAX_ATTACHED = 10
+SHARD_FORMATS = {"day": "%Y%m%d", "month": "%Y%m"}
+SHARD_FILE = re.compile(r"^events_(\d{6}|\d{8})\.db$")
+
+
+def get_events_table():
+    """
+    Events table definition, looked up to avoid importing log_processor
+    @rtype: sqlalchemy.Table
+    """
+    return BaseProcessor.metadata.tables["events"]
+
+
+def get_shard_period(file_name):
+    """
+    Period stored in a shard file
+    @param file_name: Shard file name
+    @type file_name: str
+    @return: Period start and end (exclusive), None if not a shard file
+    @rtype: (datetime, datetime) | None
+    """
+    match = SHARD_FILE.match(os.path.basename(file_name))
+    if not match:
+        return None
+    key = match.group(1)
+    if len(key) == 8:
+        start = datetime.strptime(key, SHARD_FORMATS["day"])
+        return start, start + timedelta(days=1)
+    start = datetime.strptime(key, SHARD_FORMATS["month"])
+    return start, (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+class ShardRouter(object):
+    """
+    Routes events into per-day or per-month SQLite shard files.
+    Old data is dropped by deleting whole shard files instead of DELETEing rows.
+    """
+
+    def __init__(self, shard_dir, period="day"):
+        """
+        @param shard_dir: Directory holding shard files
+        @type shard_dir: str
+        @param period: "day" or "month"
+        @type period: str
+        """
+        if period not in SHARD_FORMATS:
+            raise ValueError(
+                "Unknown shard period '{}', expected one of {}".format(
+                    period, sorted(SHARD_FORMATS)
+                )
+            )
+        self.shard_dir = shard_dir
+        self.period = period
+        self.engines = dict()
+        os.makedirs(shard_dir, exist_ok=True)
+
+    def __repr__(self):
+        """
+        String representation
+        @rtype: str
+        """
+        return "<{} {} period={}>".format(
+            self.__class__.__name__, self.shard_dir, self.period
+        )
+
+    def get_shard_path(self, date_time):
+        """
+        Shard file holding events of a given datetime
+        @param date_time: Event datetime
+        @type date_time: datetime
+        @rtype: str
+        """
+        return os.path.join(
+            self.shard_dir,
+            "events_{}.db".format(date_time.strftime(SHARD_FORMATS[self.period])),
+        )
+
+    def get_engine(self, shard_path):
+        """
+        Engine for a shard, creating the file and table on first use
+        @param shard_path: Shard file
+        @type shard_path: str
+        @rtype: sqlalchemy.engine.Engine
+        """
+        engine = self.engines.get(shard_path)
+        if engine is None:
+            engine = create_sqlite_engine(shard_path)
+            get_events_table().create(bind=engine, checkfirst=True)
+            add_missing_columns(engine, [get_events_table()])
+            self.engines[shard_path] = engine
+        return engine
+
+    def save(self, events):
+        """
+        Insert events into their shards, one transaction per shard
+        @param events: Events to save
+        @type events: list[log_processor.Event]
+        @return: Number of saved events per shard file
+        @rtype: dict
+        """
+        table = get_events_table()
+        columns = [c.name for c in table.columns if not c.primary_key]
+        by_shard = dict()
+        for event in events:
+            row = {name: getattr(event, name) for name in columns}
+            by_shard.setdefault(self.get_shard_path(event.date_time), []).append(row)
+        for shard_path, rows in by_shard.items():
+            engine = self.get_engine(shard_path)
+
+            def insert():
+                with engine.begin() as connection:
+                    connection.execute(table.insert(), rows)
+
+            run_with_retry(insert)
+        return {shard_path: len(rows) for shard_path, rows in by_shard.items()}
+
+    def dispose(self):
+        """
+        Close all shard connections
+        """
+        for engine in self.engines.values():
+            engine.dispose()
+        self.engines.clear()
+
+
+_router = None
+
+
+def get_router():
+    """
+    Router events are saved through, configured by set_router() or
+    PROCESSOR_SHARD_DIR and PROCESSOR_SHARD_PERIOD
+    @rtype: ShardRouter | None
+    """
+    global _router
+    if _router is None and SHARD_DIR:
+        _router = ShardRouter(SHARD_DIR, SHARD_PERIOD)
+    return _router
+
+
+def set_router(router):
+    """
+    Route saved events through router, None saves to the processor DB
+    @param router: Shard router
+    @type router: ShardRouter | None
+    """
+    global _router
+    if _router is not None and _router is not router:
+        _router.dispose()
+    _router = router
+
+
+def list_shards(shard_dir, start=None, end=None):
+    """
+    Shard files whose period overlaps [start, end)
+    @param shard_dir: Directory holding shard files
+    @type shard_dir: str
+    @param start: Window start
+    @type start: datetime | None
+    @param end: Window end (exclusive)
+    @type end: datetime | None
+    @return: Shard paths, oldest first
+    @rtype: list[str]
+    """
+    shards = list()
+    if not os.path.isdir(shard_dir):
+        return shards
+    for file_name in sorted(os.listdir(shard_dir)):
+        period = get_shard_period(file_name)
+        if period is None:
+            continue
+        if start is not None and period[1] <= start:
+            continue
+        if end is not None and period[0] >= end:
+            continue
+        shards.append(os.path.join(shard_dir, file_name))
+    return shards
+
+
+def delete_shards_older_than(shard_dir, days, now=None):
+    """
+    Retention: delete shard files whose whole period is older than days
+    @param shard_dir: Directory holding shard files
+    @type shard_dir: str
+    @param days: Number of days to keep
+    @type days: int
+    @param now: Reference time, defaults to now
+    @type now: datetime | None
+    @return: Deleted shard paths
+    @rtype: list[str]
+    """
+    cutoff = (now or datetime.now()) - timedelta(days=days)
+    deleted = list()
+    for shard_path in list_shards(shard_dir):
+        if get_shard_period(shard_path)[1] <= cutoff:
+            os.remove(shard_path)
+            deleted.append(shard_path)
+    return deleted
+
+
+def query_shards(shard_paths, select, params=None):
+    """
+    Run a query over the events of many shards through ATTACH.
+    Shards are attached in groups of MAX_ATTACHED, select is run once per group.
+    @param shard_paths: Shard files
+    @type shard_paths: list[str]
+    @param select: SELECT statement reading from the "events" table
+    @type select: str
+    @param params: Bound parameters of select
+    @type params: dict | None
+    @return: Result rows of all groups
+    @rtype: list[tuple]
+    """
+    rows = list()
+    columns = [c.name for c in get_events_table().columns]
+    engine = create_engine("sqlite://")
+    try:
+        for offset in range(0, len(shard_paths), MAX_ATTACHED):
+            group = shard_paths[offset : offset + MAX_ATTACHED]
+            with engine.connect() as connection:
+                selects = list()
+                aliases = list()
+                for i, shard_path in enumerate(group):
+                    alias = "shard{}".format(i)
+                    connection.exec_driver_sql(
+                        "ATTACH DATABASE ? AS {}".format(alias), (shard_path,)
+                    )
+                    aliases.append(alias)
+                    # Shards written before a column was added don't have it
+                    existing = {
+                        row[1]
+                        for row in connection.exec_driver_sql(
+                            "PRAGMA {}.table_info(events)".format(alias)
+                        )
+                    }
+                    selects.append(
+                        "SELECT {} FROM {}.events".format(
+                            ", ".join(
+                                c if c in existing else "NULL AS {}".format(c)
+                                for c in columns
+                            ),
+                            alias,
+                        )
+                    )
+                union = " UNION ALL ".join(selects)
+                connection.exec_driver_sql(
+                    "CREATE TEMP VIEW events AS {}".format(union)
+                )
+                rows.extend(connection.execute(text(select), params or {}).fetchall())
+                connection.exec_driver_sql("DROP VIEW temp.events")
+                for alias in aliases:
+                    connection.exec_driver_sql("DETACH DATABASE {}".format(alias))
+    finally:
+        engine.dispose()
+    return rows
+
+
+def to_datetime(value):
+    """
+    Convert a DATETIME column value read through raw SQL
+    @param value: Stored value
+    @type value: str | None
+    @rtype: datetime | None
+    """
+    return datetime.fromisoformat(value) if value else None
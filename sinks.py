@@ -0,0 +1,167 @@
+import csv
+import json
+import sys
+from abc import ABC, abstractmethod
+
+# Record fields written by default, the raw log line is left out
+DEFAULT_FIELDS = [
+    "source_ip",
+    "event_type",
+    "status_code",
+    "user_agent",
+    "url",
+    "date_time",
+    "bytes_sent",
+    "duration_us",
+    "ua_class",
+    "route",
+]
+# Buffer size of sink output files
+BUFFER_SIZE = 1 << 16
+
+
+class Sink(ABC):
+    """
+    Streams parsed records to stdout or a file with buffered writes, without the ORM
+    """
+
+    def __init__(self, file_name="-", fields=None):
+        """
+        @param file_name: Output file, "-" for stdout
+        @type file_name: str
+        @param fields: Record fields to write, in order
+        @type fields: list[str] | None
+        """
+        self.file_name = file_name
+        self.fields = fields or DEFAULT_FIELDS
+        self.count = 0
+        if file_name == "-":
+            self.file = sys.stdout
+        else:
+            self.file = open(
+                file_name, "w", buffering=BUFFER_SIZE, encoding="utf-8", newline=""
+            )
+
+    def __repr__(self):
+        """
+        String representation
+        @rtype: str
+        """
+        return "<{} {} records={}>".format(
+            self.__class__.__name__, self.file_name, self.count
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, record):
+        """
+        Write a single record
+        @param record: Record from log_processor.parse_record()
+        @type record: dict
+        """
+        self.write_all([record])
+
+    @abstractmethod
+    def write_all(self, records):
+        """
+        Write records
+        @param records: Records from log_processor.parse_record()
+        @type records: list[dict]
+        """
+
+    def close(self):
+        """
+        Flush buffered records and close the output file
+        """
+        self.file.flush()
+        if self.file_name != "-":
+            self.file.close()
+
+
+class JsonLinesSink(Sink):
+    """
+    One JSON object per line
+    """
+
+    # Created once, json.dumps() with arguments builds a new encoder per call
+    encode = json.JSONEncoder(default=str).encode
+
+    def write_all(self, records):
+        """
+        Write records
+        @param records: Records from log_processor.parse_record()
+        @type records: list[dict]
+        """
+        fields = self.fields
+        encode = self.encode
+        self.file.writelines(
+            encode({field: record[field] for field in fields}) + "\n"
+            for record in records
+        )
+        self.count += len(records)
+
+
+class CsvSink(Sink):
+    """
+    Delimiter-separated values with a header row
+    """
+
+    delimiter = ","
+
+    def __init__(self, file_name="-", fields=None):
+        """
+        @param file_name: Output file, "-" for stdout
+        @type file_name: str
+        @param fields: Record fields to write, in order
+        @type fields: list[str] | None
+        """
+        super(CsvSink, self).__init__(file_name, fields)
+        self.writer = csv.writer(
+            self.file, delimiter=self.delimiter, lineterminator="\n"
+        )
+        self.writer.writerow(self.fields)
+
+    def write_all(self, records):
+        """
+        Write records
+        @param records: Records from log_processor.parse_record()
+        @type records: list[dict]
+        """
+        fields = self.fields
+        self.writer.writerows([record[field] for field in fields] for record in records)
+        self.count += len(records)
+
+
+class TsvSink(CsvSink):
+    """
+    Tab-separated values with a header row
+    """
+
+    delimiter = "\t"
+
+
+SINKS = {"jsonl": JsonLinesSink, "csv": CsvSink, "tsv": TsvSink}
+
+
+def get_sink(output_format, file_name="-", fields=None):
+    """
+    Create a sink by format name
+    @param output_format: One of SINKS
+    @type output_format: str
+    @param file_name: Output file, "-" for stdout
+    @type file_name: str
+    @param fields: Record fields to write, in order
+    @type fields: list[str] | None
+    @rtype: Sink
+    """
+    if output_format not in SINKS:
+        raise ValueError(
+            "Unknown output format '{}', expected one of {}".format(
+                output_format, sorted(SINKS)
+            )
+        )
+    return SINKS[output_format](file_name, fields)
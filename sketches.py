@@ -0,0 +1,281 @@
+import hashlib
+import math
+import zlib
+
+from sqlalchemy import Column, Integer, String, DateTime, LargeBinary, UniqueConstraint
+from database import BaseProcessor, processor_db_session
+
+# 2^12 registers, standard error of ~1.6%
+DEFAULT_PRECISION = 12
+# Event attributes we keep distinct-count sketches for
+SKETCH_DIMENSIONS = ("source_ip", "url", "user_agent")
+
+
+class HyperLogLog(object):
+    """
+    Mergeable HyperLogLog cardinality estimator
+    """
+
+    def __init__(self, precision=DEFAULT_PRECISION, registers=None):
+        """
+        @param precision: Number of index bits, sketch has 2^precision registers
+        @type precision: int
+        @param registers: Existing register values
+        @type registers: bytes | bytearray | None
+        """
+        if not 4 <= precision <= 18:
+            raise ValueError(
+                "Precision must be between 4 and 18, got {}".format(precision)
+            )
+        self.precision = precision
+        self.size = 1 << precision
+        if registers is None:
+            self.registers = bytearray(self.size)
+        elif len(registers) != self.size:
+            raise ValueError(
+                "Expected {} registers, got {}".format(self.size, len(registers))
+            )
+        else:
+            self.registers = bytearray(registers)
+
+    def __repr__(self):
+        """
+        String representation
+        @rtype: str
+        """
+        return "<{} precision={} estimate={}>".format(
+            self.__class__.__name__, self.precision, self.count()
+        )
+
+    def add(self, value):
+        """
+        Add a value to the sketch
+        @param value: Value to add
+        @type value: str
+        """
+        digest = hashlib.blake2b(
+            value.encode("utf-8", "replace"), digest_size=8
+        ).digest()
+        hashed = int.from_bytes(digest, "big")
+        remaining_bits = 64 - self.precision
+        index = hashed >> remaining_bits
+        rest = hashed & ((1 << remaining_bits) - 1)
+        rank = remaining_bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """
+        Merge another sketch into this one, result estimates the union
+        @param other: Sketch to merge
+        @type other: HyperLogLog
+        @rtype: HyperLogLog
+        """
+        if other.precision != self.precision:
+            raise ValueError(
+                "Cannot merge sketches with precision {} and {}".format(
+                    self.precision, other.precision
+                )
+            )
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        """
+        Estimate number of distinct values added
+        @rtype: int
+        """
+        size = self.size
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / math.fsum(2.0**-r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            # Small range correction (linear counting)
+            estimate = size * math.log(size / zeros)
+        return int(round(estimate))
+
+    @property
+    def std_error(self):
+        """
+        Relative standard error of the estimate
+        @rtype: float
+        """
+        return 1.04 / math.sqrt(self.size)
+
+    def to_bytes(self):
+        """
+        Compact binary representation: precision byte followed by compressed registers
+        @rtype: bytes
+        """
+        return bytes([self.precision]) + zlib.compress(bytes(self.registers))
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Restore sketch from to_bytes() output
+        @param data: Serialized sketch
+        @type data: bytes
+        @rtype: HyperLogLog
+        """
+        return cls(data[0], zlib.decompress(data[1:]))
+
+
+class Sketch(BaseProcessor):
+    """
+    Persisted HyperLogLog sketch for one time bucket, EventType and dimension
+    """
+
+    __tablename__ = "sketches"
+    __table_args__ = (UniqueConstraint("bucket", "event_type", "dimension"),)
+    id = Column(Integer, primary_key=True)
+    bucket = Column(DateTime, index=True)
+    event_type = Column(String(100))
+    dimension = Column(String(100))
+    registers = Column(LargeBinary)
+
+    def __init__(self, bucket, event_type, dimension, registers):
+        """
+        @param bucket: Start of the time bucket
+        @type bucket: datetime
+        @param event_type: EventType name or "" for unclassified events
+        @type event_type: str
+        @param dimension: Event attribute the sketch counts
+        @type dimension: str
+        @param registers: Serialized HyperLogLog
+        @type registers: bytes
+        """
+        self.bucket = bucket
+        self.event_type = event_type
+        self.dimension = dimension
+        self.registers = registers
+
+    def __repr__(self):
+        """
+        String representation
+        @rtype: str
+        """
+        return "<{} {}>".format(self.__class__.__name__, self.__dict__)
+
+
+def get_bucket(date_time):
+    """
+    Truncate datetime to the start of its hourly bucket
+    @param date_time: Datetime value
+    @type date_time: datetime
+    @rtype: datetime
+    """
+    return date_time.replace(minute=0, second=0, microsecond=0, tzinfo=None)
+
+
+def build_sketches(events, precision=DEFAULT_PRECISION):
+    """
+    Build in-memory sketches for events
+    @param events: Events to sketch
+    @type events: list[log_processor.Event]
+    @param precision: HyperLogLog precision
+    @type precision: int
+    @return: Dict with (bucket, event_type, dimension) as key and HyperLogLog as value
+    @rtype: dict
+    """
+    sketches = dict()
+    for event in events:
+        bucket = get_bucket(event.date_time)
+        event_type = event.event_type or ""
+        for dimension in SKETCH_DIMENSIONS:
+            key = (bucket, event_type, dimension)
+            sketch = sketches.get(key)
+            if sketch is None:
+                sketch = sketches[key] = HyperLogLog(precision)
+            sketch.add(getattr(event, dimension) or "")
+    return sketches
+
+
+def update_sketches(events, precision=DEFAULT_PRECISION):
+    """
+    Merge sketches of events into persisted sketches
+    @param events: Events to sketch
+    @type events: list[log_processor.Event]
+    @param precision: HyperLogLog precision
+    @type precision: int
+    @return: Number of sketches written
+    @rtype: int
+    """
+    return save_sketches(build_sketches(events, precision))
+
+
+def save_sketches(sketches):
+    """
+    Merge in-memory sketches into persisted sketches
+    @param sketches: Output of build_sketches()
+    @type sketches: dict
+    @return: Number of sketches written
+    @rtype: int
+    """
+    if not sketches:
+        return 0
+    buckets = set(key[0] for key in sketches)
+    existing = dict()
+    for row in Sketch.query.filter(Sketch.bucket.in_(buckets)).all():
+        existing[(row.bucket, row.event_type, row.dimension)] = row
+    for key, sketch in sketches.items():
+        row = existing.get(key)
+        if row is None:
+            processor_db_session.add(Sketch(key[0], key[1], key[2], sketch.to_bytes()))
+        else:
+            merged = HyperLogLog.from_bytes(row.registers).merge(sketch)
+            row.registers = merged.to_bytes()
+    processor_db_session.commit()
+    return len(sketches)
+
+
+def merge_sketches(dimension, start=None, end=None, event_types=None):
+    """
+    Merge persisted sketches matching the filters
+    @param dimension: One of SKETCH_DIMENSIONS
+    @type dimension: str
+    @param start: Include buckets starting at or after this datetime
+    @type start: datetime | None
+    @param end: Include buckets starting before this datetime
+    @type end: datetime | None
+    @param event_types: EventTypes to include, all if None
+    @type event_types: list[log_processor.EventType] | None
+    @rtype: HyperLogLog | None
+    """
+    if dimension not in SKETCH_DIMENSIONS:
+        raise ValueError(
+            "Unknown dimension '{}', expected one of {}".format(
+                dimension, SKETCH_DIMENSIONS
+            )
+        )
+    query = Sketch.query.filter(Sketch.dimension == dimension)
+    if start is not None:
+        query = query.filter(Sketch.bucket >= get_bucket(start))
+    if end is not None:
+        query = query.filter(Sketch.bucket < end.replace(tzinfo=None))
+    if event_types is not None:
+        query = query.filter(Sketch.event_type.in_([e.name for e in event_types]))
+    merged = None
+    for row in query.all():
+        sketch = HyperLogLog.from_bytes(row.registers)
+        merged = sketch if merged is None else merged.merge(sketch)
+    return merged
+
+
+def distinct_count(dimension, start=None, end=None, event_types=None):
+    """
+    Estimate number of distinct values of dimension in a time window
+    @param dimension: One of SKETCH_DIMENSIONS
+    @type dimension: str
+    @param start: Window start
+    @type start: datetime | None
+    @param end: Window end (exclusive)
+    @type end: datetime | None
+    @param event_types: EventTypes to include, all if None
+    @type event_types: list[log_processor.EventType] | None
+    @return: Estimate and its relative standard error
+    @rtype: (int, float)
+    """
+    merged = merge_sketches(dimension, start, end, event_types)
+    if merged is None:
+        return 0, 0.0
+    return merged.count(), merged.std_error
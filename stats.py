@@ -0,0 +1,196 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Stats(object):
+    """
+    Throughput instrumentation of an ingest run: time per stage, counters and DB commit latency
+    """
+
+    def __init__(self):
+        self.seconds = dict()
+        self.counters = dict()
+        self.commit_latencies = list()
+        self.caches = dict()
+        self.sections = dict()
+        self.started = time.perf_counter()
+        self.finished = None
+        self._cache_baselines = dict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        """
+        String representation
+        @rtype: str
+        """
+        return "<{} {}>".format(self.__class__.__name__, self.to_dict())
+
+    def add_time(self, stage, seconds):
+        """
+        Add time spent in a stage
+        @param stage: Stage name
+        @type stage: str
+        @param seconds: Elapsed seconds
+        @type seconds: float
+        """
+        with self._lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def incr(self, counter, value=1):
+        """
+        Increment a counter
+        @param counter: Counter name
+        @type counter: str
+        @param value: Increment
+        @type value: int
+        """
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    @contextmanager
+    def timer(self, stage):
+        """
+        Time a block of code as a stage
+        @param stage: Stage name
+        @type stage: str
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - started)
+
+    def add_commit(self, seconds):
+        """
+        Record latency of a DB commit
+        @param seconds: Elapsed seconds
+        @type seconds: float
+        """
+        with self._lock:
+            self.commit_latencies.append(seconds)
+
+    def watch_cache(self, name, cached_function):
+        """
+        Report hit rate of an lru_cache decorated function for this run
+        @param name: Cache name
+        @type name: str
+        @param cached_function: Function decorated with functools.lru_cache
+        @type cached_function: callable
+        """
+        if name in self.caches:
+            # Already watched by an earlier file of this run
+            return
+        self.caches[name] = cached_function
+        info = cached_function.cache_info()
+        self._cache_baselines[name] = (info.hits, info.misses)
+
+    def finish(self):
+        """
+        Stop the wall clock
+        @rtype: Stats
+        """
+        self.finished = time.perf_counter()
+        return self
+
+    def to_dict(self):
+        """
+        All measurements as a JSON-serialisable dict
+        @rtype: dict
+        """
+        wall = (self.finished or time.perf_counter()) - self.started
+        lines = self.counters.get("lines", 0)
+        read_bytes = self.counters.get("bytes", 0)
+        caches = dict()
+        for name, cached_function in self.caches.items():
+            info = cached_function.cache_info()
+            base_hits, base_misses = self._cache_baselines[name]
+            hits = info.hits - base_hits
+            misses = info.misses - base_misses
+            caches[name] = {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+                "size": info.currsize,
+            }
+        latencies = sorted(self.commit_latencies)
+        commits = {"count": len(latencies)}
+        if latencies:
+            commits.update(
+                {
+                    "total_seconds": sum(latencies),
+                    "mean_seconds": sum(latencies) / len(latencies),
+                    "max_seconds": latencies[-1],
+                    "p50_seconds": latencies[len(latencies) // 2],
+                }
+            )
+        result = {
+            "wall_seconds": wall,
+            "lines_per_second": lines / wall if wall else 0.0,
+            "bytes_per_second": read_bytes / wall if wall else 0.0,
+            "stage_seconds": dict(self.seconds),
+            "counters": dict(self.counters),
+            "caches": caches,
+            "commits": commits,
+        }
+        result.update(self.sections)
+        return result
+
+    def to_json(self):
+        """
+        Measurements as JSON, for monitoring to scrape
+        @rtype: str
+        """
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+    def to_text(self):
+        """
+        Human readable summary
+        @rtype: str
+        """
+        data = self.to_dict()
+        wall = data["wall_seconds"]
+        text = [
+            "Wall time: {:.3f}s".format(wall),
+            "Throughput: {:.0f} lines/s, {:.0f} bytes/s".format(
+                data["lines_per_second"], data["bytes_per_second"]
+            ),
+            "Stages:",
+        ]
+        for stage, seconds in sorted(data["stage_seconds"].items()):
+            text.append(
+                "  {:<12} {:>10.3f}s {:>6.1%}".format(
+                    stage, seconds, seconds / wall if wall else 0.0
+                )
+            )
+        text.append("Counters:")
+        for counter, value in sorted(data["counters"].items()):
+            text.append("  {:<20} {:>10}".format(counter, value))
+        for name, cache in sorted(data["caches"].items()):
+            text.append(
+                "Cache {}: {:.1%} hit rate ({} hits, {} misses)".format(
+                    name, cache["hit_rate"], cache["hits"], cache["misses"]
+                )
+            )
+        commits = data["commits"]
+        if commits["count"]:
+            text.append(
+                "DB commits: {}, mean {:.3f}s, max {:.3f}s".format(
+                    commits["count"], commits["mean_seconds"], commits["max_seconds"]
+                )
+            )
+        memory = data.get("memory")
+        if memory:
+            text.append(
+                "Memory: peak RSS {:.1f} MiB of {:.1f} MiB budget, {} batches of "
+                "{}-{} events, ~{} bytes per event".format(
+                    memory["peak_rss_bytes"] / (1 << 20),
+                    memory["limit_bytes"] / (1 << 20),
+                    memory["batches"],
+                    memory["min_batch_size"],
+                    memory["max_batch_size"],
+                    memory["record_size_bytes"],
+                )
+            )
+        return "\n".join(text)
@@ -0,0 +1,107 @@
+import os
+
+
+class LogFollower(object):
+    """
+    Follows a growing log file like `tail -F`, surviving rotation and truncation
+    """
+
+    def __init__(self, file_name, from_start=False):
+        """
+        @param file_name: Path of the live log file
+        @type file_name: str
+        @param from_start: Read existing content first instead of starting at the end
+        @type from_start: bool
+        """
+        self.file_name = file_name
+        self.file = None
+        self.inode = None
+        self.partial = b""
+        self.rotations = 0
+        self.truncations = 0
+        self._open(from_start)
+
+    def __repr__(self):
+        """
+        String representation
+        @rtype: str
+        """
+        return "<{} {} rotations={} truncations={}>".format(
+            self.__class__.__name__, self.file_name, self.rotations, self.truncations
+        )
+
+    def _open(self, from_start=True):
+        """
+        Open the file at its current path
+        @param from_start: Start at the beginning instead of the end
+        @type from_start: bool
+        @return: True if opened
+        @rtype: bool
+        """
+        try:
+            new_file = open(self.file_name, "rb")
+        except FileNotFoundError:
+            return False
+        if self.file is not None:
+            self.file.close()
+        self.file = new_file
+        self.inode = os.fstat(new_file.fileno()).st_ino
+        if not from_start:
+            self.file.seek(0, os.SEEK_END)
+        return True
+
+    def _read_available(self):
+        """
+        Read complete lines currently available in the open file
+        @rtype: list[bytes]
+        """
+        lines = list()
+        if self.file is None:
+            return lines
+        for line in self.file:
+            if self.partial:
+                line = self.partial + line
+                self.partial = b""
+            if line.endswith(b"\n"):
+                lines.append(line)
+            else:
+                # Writer is mid-line, keep it for the next call
+                self.partial = line
+        return lines
+
+    def read_lines(self):
+        """
+        Return complete undecoded lines appended since the previous call
+        @rtype: list[bytes]
+        """
+        if self.file is None:
+            self._open()
+        lines = self._read_available()
+        try:
+            stat = os.stat(self.file_name)
+        except FileNotFoundError:
+            # Rotated away and not re-created yet, keep the old handle
+            return lines
+        if self.file is None:
+            return lines
+        if stat.st_ino != self.inode:
+            # Rotated: old file was drained above, continue with the new one
+            self.rotations += 1
+            self.partial = b""
+            if self._open():
+                lines.extend(self._read_available())
+        elif stat.st_size < self.file.tell():
+            # Truncated in place (copytruncate)
+            self.truncations += 1
+            self.partial = b""
+            self.file.seek(0)
+            lines.extend(self._read_available())
+        return lines
+
+    def close(self):
+        """
+        Close the followed file
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
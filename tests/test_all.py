@@ -1,7 +1,18 @@
+import csv
+import json
+import os
 import pytest
 import random
-from datetime import datetime
+import subprocess
+import sys
+import threading
+import time
+from functools import partial
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from datetime import datetime, timedelta, timezone
 from os.path import isfile
+from pathlib import Path
 
 
 from log_processor import (
@@ -14,19 +25,79 @@ from log_processor import (
     get_user_agent,
     get_datetime,
     parse_line,
+    parse_raw_line,
+    parse_record,
+    parse_file,
+    ingest_file,
+    stream_file,
+    print_sorted,
+    get_ip_sort_key,
+    follow_file,
     Event,
     EventType,
+    PROFILED_FUNCTIONS,
 )
 from report import (
     Report,
+    finish_reports,
     get_base_reports,
     get_counts_by_event_type,
     generate_reports,
     delete_all_reports,
+    load_partial_reports,
+    merge_partial_reports,
+    get_prefix_reports,
+    get_ua_class_counts,
+    get_route_reports,
+    PrefixReport,
+    RouteReport,
+    COUNT_FIELDS,
+    UA_COUNT_FIELDS,
+    report_cache,
 )
-from database import init_db, PROCESSOR_DB_FILE, REPORT_DB_FILE
+from archive import (
+    compact_events,
+    get_auto_vacuum,
+    incremental_vacuum,
+    list_archives,
+    read_archive,
+    read_archived_events,
+)
+from benchmarks.generator import generate_lines
+from database import (
+    add_missing_columns,
+    init_db,
+    processor_db_session,
+    run_with_retry,
+)
+from detector import BruteForceDetector
+from external_sort import ExternalSorter, group_sorted
+from leases import FileLease, FileLeases
+from log_format import LogFormat
+from memory import MemoryBudget, parse_size
+from ip_trie import PrefixTrie, get_prefix, load_prefix_trie
+from pipeline import Pipeline
+from profiling import Profiler
+from query_cache import QueryCache, bump_generation
+from sampling import Sampler
+from routes import get_route, load_route_templates, route_table, set_route_templates
+from report_index import ReportIndex, write_report_index
+from shards import (
+    ShardRouter,
+    delete_shards_older_than,
+    list_shards,
+    query_shards,
+    set_router,
+)
+from sinks import get_sink
+from stats import Stats
+from tail import LogFollower
+from user_agents import UserAgentClass, classify_user_agent
+from sketches import HyperLogLog, Sketch, update_sketches, distinct_count
 from .test_utils import get_in_memory_db_path
 
+REPO_DIR = Path(__file__).resolve().parent.parent
+
 
 @pytest.fixture(autouse=True)
 def setup():
@@ -47,6 +118,27 @@ def setup():
         init_db()
 
 
+def run_cli(tmp_path, script, *args):
+    """
+    Run an entry point of the repo against DBs in tmp_path
+    @return: Completed process, stdout and stderr as text
+    @rtype: subprocess.CompletedProcess
+    """
+    env = dict(
+        os.environ,
+        PROCESSOR_DB_FILE=str(tmp_path / "cli_processor.db"),
+        REPORT_DB_FILE=str(tmp_path / "cli_report.db"),
+        REPORT_INDEX_FILE=str(tmp_path / "cli_report.idx"),
+    )
+    return subprocess.run(
+        [sys.executable, str(REPO_DIR / script)] + list(args),
+        cwd=str(REPO_DIR),
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+
+
 def test_get_source_ip():
     line = (
         '150.95.105.63 - - [01/Oct/2019:07:26:52 +0300] "GET /wp-login.php HTTP/1.1" 200 5128 "-" '
@@ -77,6 +169,20 @@ def test_get_source_ip():
     result = get_source_ip(line)
     assert "" == result
 
+    line = (
+        '2001:db8:85a3::8a2e:370:7334 - - [01/Oct/2019:07:26:52 +0300] "GET /wp-login.php HTTP/1.1" '
+        '200 5128 "-" "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:62.0) Gecko/20100101 Firefox/62.0"'
+    )
+    result = get_source_ip(line)
+    assert "2001:db8:85a3::8a2e:370:7334" == result
+
+    line = (
+        '::ffff:150.95.105.63 - - [01/Oct/2019:07:26:52 +0300] "GET /wp-login.php HTTP/1.1" 200 5128 '
+        '"-" "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:62.0) Gecko/20100101 Firefox/62.0"'
+    )
+    result = get_source_ip(line)
+    assert "::ffff:150.95.105.63" == result
+
 
 def test_get_method():
     line = (
@@ -271,8 +377,9 @@ def test_get_datetime():
 
 
 def test_init_db():
-    assert isfile(PROCESSOR_DB_FILE)
-    assert isfile(REPORT_DB_FILE)
+    # The files the setup fixture bound the engines to
+    assert isfile(os.environ["PROCESSOR_DB_FILE"])
+    assert isfile(os.environ["REPORT_DB_FILE"])
     assert Event.query.first()
 
 
@@ -429,3 +536,1238 @@ def test_get_comment_for_ip():
     reports_with_comments = Report.query.filter(Report.comment != "").all()
     for r in reports_with_comments:
         assert r.comment == Report.get_by_ip(r.source_ip).comment
+
+
+def test_hyperloglog():
+    sketch = HyperLogLog()
+    for i in range(20000):
+        sketch.add("10.0.{}.{}".format(i // 256, i % 256))
+    assert abs(sketch.count() - 20000) < 20000 * 4 * sketch.std_error
+
+    small = HyperLogLog()
+    for i in range(100):
+        small.add(str(i))
+        small.add(str(i))
+    assert abs(small.count() - 100) <= 5
+
+    restored = HyperLogLog.from_bytes(sketch.to_bytes())
+    assert restored.registers == sketch.registers
+
+    other = HyperLogLog()
+    for i in range(10000, 30000):
+        other.add("10.0.{}.{}".format(i // 256, i % 256))
+    union = HyperLogLog.from_bytes(sketch.to_bytes()).merge(other)
+    assert abs(union.count() - 30000) < 30000 * 4 * union.std_error
+
+    with pytest.raises(ValueError):
+        sketch.merge(HyperLogLog(10))
+
+
+def test_update_sketches():
+    lines = [
+        '10.1.0.{} - - [02/Oct/2030:10:{:02d}:00 +0300] "POST /wp-login.php HTTP/1.1" 200 5536 "-" '
+        '"Agent {}"'.format(i % 50, i % 60, i % 7)
+        for i in range(300)
+    ]
+    events = [parse_line(line) for line in lines]
+    assert update_sketches(events)
+    # Merging the same events again must not change the estimate
+    update_sketches(events)
+    start = datetime(2030, 10, 2)
+    end = datetime(2030, 10, 3)
+    count, error = distinct_count("source_ip", start, end, [EventType.post_login])
+    assert abs(count - 50) <= 3
+    assert 0 < error < 0.05
+    count, _ = distinct_count("user_agent", start, end)
+    assert 7 == count
+    assert (0, 0.0) == distinct_count("url", start, end, [EventType.get_login])
+
+    Sketch.query.filter(Sketch.bucket >= start, Sketch.bucket < end).delete()
+    processor_db_session.commit()
+
+
+def test_brute_force_detector():
+    alerts = []
+    detector = BruteForceDetector(
+        threshold=5, window=10, max_ips=3, on_alert=alerts.append
+    )
+    # Slow client never crosses the threshold
+    for i in range(20):
+        assert detector.observe("10.0.0.1", i * 5.0) is None
+    # Fast client alerts exactly once per burst
+    for i in range(10):
+        detector.observe("10.0.0.2", 100 + i)
+    assert 1 == len(alerts)
+    assert "10.0.0.2" == alerts[0].source_ip
+    assert 5 == alerts[0].count
+    assert 4 == alerts[0].last_seen - alerts[0].first_seen
+
+    # Idle IPs are evicted, memory stays bounded
+    assert "10.0.0.1" not in detector.tracked
+    for i in range(10):
+        detector.observe("10.1.0.{}".format(i), 200)
+    assert 3 == len(detector.tracked)
+
+    line = (
+        '150.95.105.63 - - [01/Oct/2019:07:26:54 +0300] "POST /wp-login.php HTTP/1.1" 200 5536 "-" '
+        '"Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:62.0) Gecko/20100101 Firefox/62.0"'
+    )
+    detector = BruteForceDetector(threshold=2, window=1, on_alert=alerts.append)
+    assert detector.observe_event(parse_line(line)) is None
+    assert detector.observe_event(parse_line(line)) is not None
+    assert detector.observe_event(parse_line(line.replace("POST", "GET"))) is None
+
+    # Out of order timestamps, e.g. from parser workers or several files
+    alerts = []
+    detector = BruteForceDetector(threshold=2, window=10, on_alert=alerts.append)
+    assert detector.observe("10.0.0.3", 1000) is None
+    assert detector.observe("10.0.0.3", 0) is None
+    assert detector.observe("10.0.0.3", 5) is not None
+    assert (0, 5) == (alerts[0].first_seen, alerts[0].last_seen)
+    assert detector.observe("10.0.0.3", 2) is None
+    # Unparsable dates fall back to the current time, far from the logged ones
+    assert detector.observe("10.0.0.4", time.time()) is None
+    assert detector.observe("10.0.0.4", 1569900000) is None
+    assert all(a.first_seen <= a.last_seen for a in alerts)
+    # and don't evict the IPs tracked with logged times
+    alerts = []
+    detector = BruteForceDetector(threshold=3, window=60, on_alert=alerts.append)
+    detector.observe("1.1.1.1", 1569900000)
+    detector.observe("1.1.1.1", 1569900001)
+    detector.observe("2.2.2.2", time.time())
+    assert {"1.1.1.1", "2.2.2.2"} == set(detector.tracked)
+    assert detector.observe("1.1.1.1", 1569900002) is not None
+    # A gap in the log confirmed by another IP moves the clock on
+    detector.observe("3.3.3.3", 1569990000)
+    detector.observe("4.4.4.4", 1569990001)
+    assert "1.1.1.1" not in detector.tracked
+
+
+def _follow_test_line(i):
+    return (
+        '10.9.9.{} - - [01/Oct/2019:07:26:54 +0300] "POST /wp-login.php HTTP/1.1" 200 5536 "-" '
+        '"follow-test"\n'.format(i)
+    )
+
+
+def test_log_follower(tmp_path):
+    log_file = tmp_path / "access.log"
+    log_file.write_text(_follow_test_line(0))
+    follower = LogFollower(str(log_file))
+    # Starts at the end
+    assert [] == follower.read_lines()
+
+    with open(log_file, "a") as f:
+        f.write(_follow_test_line(1))
+        f.write(_follow_test_line(2)[:20])
+        f.flush()
+        assert [_follow_test_line(1).encode()] == follower.read_lines()
+        f.write(_follow_test_line(2)[20:])
+    assert [_follow_test_line(2).encode()] == follower.read_lines()
+
+    # Truncation
+    log_file.write_text(_follow_test_line(3))
+    assert [_follow_test_line(3).encode()] == follower.read_lines()
+    assert 1 == follower.truncations
+
+    # Rotation: lines written to the old file before the switch are not lost
+    with open(log_file, "a") as f:
+        f.write(_follow_test_line(4))
+    os.rename(log_file, tmp_path / "access.log.1")
+    log_file.write_text(_follow_test_line(5))
+    assert [
+        _follow_test_line(4).encode(),
+        _follow_test_line(5).encode(),
+    ] == follower.read_lines()
+    assert 1 == follower.rotations
+    follower.close()
+
+
+def test_follow_file(tmp_path):
+    log_file = tmp_path / "access.log"
+    log_file.write_text("")
+    stop = threading.Event()
+    batches = []
+
+    def write_lines():
+        for i in range(30):
+            with open(log_file, "a") as f:
+                f.write(_follow_test_line(i))
+            if i == 15:
+                os.rename(log_file, tmp_path / "access.log.1")
+                log_file.write_text("")
+            time.sleep(0.005)
+        time.sleep(0.2)
+        stop.set()
+
+    writer = threading.Thread(target=write_lines)
+    writer.start()
+    stats = Stats()
+    processed = follow_file(
+        str(log_file),
+        batch_size=8,
+        batch_interval=0.05,
+        poll_interval=0.01,
+        from_start=True,
+        stop=stop,
+        on_batch=lambda records: batches.append(records),
+        stats=stats,
+    )
+    writer.join()
+    assert 30 == processed
+    assert 30 == stats.counters["lines"] == stats.counters["events"]
+    assert stats.commit_latencies
+    assert "timestamp" in stats.to_dict()["caches"]
+    assert 30 == sum(len(b) for b in batches)
+    assert max(len(b) for b in batches) <= 8
+    # Records are read before the commit expires the saved events
+    assert {"follow-test"} == {r["user_agent"] for b in batches for r in b}
+    saved = Event.query.filter(Event.user_agent == "follow-test").all()
+    assert 30 == len(saved)
+    for event in saved:
+        event.delete()
+
+
+def test_pipeline(tmp_path):
+    log_file = tmp_path / "access.log"
+    methods = ["GET", "POST", "HEAD"]
+    with open(log_file, "w") as f:
+        for i in range(2500):
+            f.write(
+                '10.7.{}.{} - - [01/Oct/2019:07:26:54 +0300] "{} /wp-login.php HTTP/1.1" 200 5536 "-" '
+                '"pipeline-test"\n'.format(i // 250, i % 250, methods[i % 3])
+            )
+    sequential = parse_file(str(log_file))
+    stats = Stats()
+    staged = parse_file(str(log_file), workers=3, queue_size=2, stats=stats)
+    metrics = stats.sections["pipeline"]
+    key = lambda e: (e.source_ip, e.event_type)
+    assert sorted(map(key, sequential)) == sorted(map(key, staged))
+    assert 2500 == metrics["lines"]
+    assert {"lines", "events"} == set(metrics["queues"])
+    assert metrics["queues"]["lines"]["max_depth"] <= 2
+    assert {"read", "parse", "write"} == set(metrics["stage_seconds"])
+
+    written = []
+    pipeline = Pipeline(
+        partial(parse_raw_line, event_type=EventType.post_login),
+        written.extend,
+        workers=2,
+        chunk_size=100,
+        write_batch_size=300,
+    )
+    results, count = pipeline.run([str(log_file)], keep_results=False)
+    assert [] == results
+    assert 833 == count == len(written)
+
+    def broken_parse(line):
+        raise RuntimeError("broken")
+
+    with pytest.raises(RuntimeError):
+        Pipeline(broken_parse, workers=2, chunk_size=10, queue_size=1).run(
+            [str(log_file)]
+        )
+
+
+def test_stats(tmp_path):
+    log_file = tmp_path / "access.log"
+    with open(log_file, "w") as f:
+        for i in range(500):
+            f.write(
+                '10.8.0.{} - - [01/Oct/2019:07:26:{:02d} +0300] "GET /index.php HTTP/1.1" 200 5536 "-" '
+                '"stats-test"\n'.format(i % 100, i // 100)
+            )
+        f.write(
+            '10.8.0.1 - - [bad date] "GET /index.php HTTP/1.1" 200 5536 "-" "stats-test"\n'
+        )
+    stats = Stats()
+    events = parse_file(str(log_file), save_to_db=True, stats=stats)
+    data = stats.finish().to_dict()
+    assert 501 == data["counters"]["lines"]
+    assert 501 == data["counters"]["events"]
+    assert 1 == data["counters"]["datetime_errors"]
+    assert os.path.getsize(log_file) == data["counters"]["bytes"]
+    assert {"read", "parse", "datetime", "classify", "persist", "sketch"} <= set(
+        data["stage_seconds"]
+    )
+    assert 1 == data["commits"]["count"]
+    assert data["caches"]["timestamp"]["hits"] >= 495
+    assert data["lines_per_second"] > 0
+    assert '"lines_per_second"' in stats.to_json()
+    assert "Throughput" in stats.to_text()
+    Event.query.filter(Event.user_agent == "stats-test").delete()
+    processor_db_session.commit()
+
+
+def test_generate_lines():
+    lines = list(
+        generate_lines(2000, seed=3, login_post_ratio=0.2, error_4xx_ratio=0.3)
+    )
+    assert lines == list(
+        generate_lines(2000, seed=3, login_post_ratio=0.2, error_4xx_ratio=0.3)
+    )
+    assert lines != list(generate_lines(2000, seed=4))
+    events = [parse_line(line) for line in lines]
+    login_posts = sum(1 for e in events if e.event_type == "post_login")
+    errors_4xx = sum(1 for e in events if 400 <= e.status_code < 500)
+    assert 300 < login_posts < 500
+    assert 500 < errors_4xx < 700
+    assert all(e.source_ip for e in events)
+    # Skewed: the busiest IP sends far more than its uniform share
+    ips = [e.source_ip for e in events]
+    assert max(ips.count(ip) for ip in set(ips)) > 10 * len(ips) / len(set(ips))
+
+
+def test_shards(tmp_path):
+    shard_dir = str(tmp_path / "shards")
+    lines = [
+        '10.5.0.{} - - [{:02d}/Oct/2019:07:26:54 +0300] "{} /wp-login.php HTTP/1.1" 200 5536 "-" '
+        '"shard-test"'.format(i % 4, 1 + i % 12, "POST" if i % 3 else "GET")
+        for i in range(120)
+    ]
+    events = [parse_line(line) for line in lines]
+    set_router(ShardRouter(shard_dir, "day"))
+    try:
+        assert Event.save_all(events)
+    finally:
+        set_router(None)
+    assert 0 == Event.query.filter(Event.user_agent == "shard-test").count()
+    # More shards than can be attached at once
+    assert 12 == len(list_shards(shard_dir))
+    assert 2 == len(
+        list_shards(shard_dir, datetime(2019, 10, 3), datetime(2019, 10, 5))
+    )
+
+    reports = generate_reports(shard_dir=shard_dir)
+    assert {"10.5.0.0", "10.5.0.1", "10.5.0.2", "10.5.0.3"} == set(reports)
+    for ip, report in reports.items():
+        own = [e for e in events if e.source_ip == ip]
+        assert len(own) == report.total_count
+        assert sum(1 for e in own if e.event_type == "post_login") == (
+            report.post_login_count
+        )
+        assert max(e.date_time for e in own).replace(tzinfo=None) == report.latest
+        assert report.total_count == report.other_ua_count
+
+    window = generate_reports(
+        shard_dir=shard_dir, start=datetime(2019, 10, 3), end=datetime(2019, 10, 5)
+    )
+    assert 20 == sum(r.total_count for r in window.values())
+
+    deleted = delete_shards_older_than(shard_dir, 5, now=datetime(2019, 10, 10))
+    assert 4 == len(deleted)
+    assert 8 == len(list_shards(shard_dir))
+
+
+def test_merge_partial_reports(tmp_path):
+    lines = list(generate_lines(900, seed=5, distinct_ips=60))
+    nodes = [lines[:300], lines[300:700], lines[700:]]
+    partial_files = []
+    for i, node_lines in enumerate(nodes):
+        set_router(ShardRouter(str(tmp_path / "node{}".format(i))))
+        Event.save_all([parse_line(line) for line in node_lines])
+        partial_file = str(tmp_path / "node{}.json.gz".format(i))
+        generate_reports(
+            shard_dir=str(tmp_path / "node{}".format(i)),
+            export_partial=partial_file,
+            with_sketches=True,
+        )
+        partial_files.append(partial_file)
+    set_router(ShardRouter(str(tmp_path / "central")))
+    Event.save_all([parse_line(line) for line in lines])
+    set_router(None)
+
+    central = generate_reports(shard_dir=str(tmp_path / "central"))
+    merged, sketches = merge_partial_reports(partial_files)
+    assert set(central) == set(merged)
+    for ip, report in central.items():
+        for field in ["latest"] + COUNT_FIELDS:
+            assert getattr(report, field) == getattr(merged[ip], field)
+    partial = load_partial_reports(partial_files[0])
+    assert partial["node"]
+    assert "source_ip/get" in partial["sketches"]
+    assert "source_ip/get" in sketches
+
+
+def test_report_index(tmp_path):
+    index_file = str(tmp_path / "reports.idx")
+    fields = ["total_count", "post_login_count"]
+    reports = [
+        Report(
+            "10.0.0.{}".format(i),
+            datetime(2019, 10, 1) + timedelta(minutes=i),
+            i * 2,
+            i,
+        )
+        for i in range(1, 200)
+    ]
+    reports.append(Report("2001:db8::1", datetime(2019, 10, 2), 5, 5))
+    reports.append(Report("xxx.xx.xxx.xx", datetime(2019, 10, 2), 1, 1))
+    assert 200 == write_report_index(reports, index_file, fields)
+
+    index = ReportIndex(index_file)
+    assert 200 == len(index)
+    assert {
+        "total_count": 20,
+        "post_login_count": 10,
+        "latest": datetime(2019, 10, 1, 0, 10),
+    } == index.lookup("10.0.0.10")
+    assert 5 == index.lookup("2001:db8::1")["post_login_count"]
+    assert index.lookup("10.0.0.200") is None
+    assert index.lookup("xxx.xx.xxx.xx") is None
+    assert not index.reload_if_changed()
+
+    # Snapshot is replaced, not modified: the old mapping stays readable until reload
+    write_report_index(reports[:1], index_file, fields)
+    assert 20 == index.lookup("10.0.0.10")["total_count"]
+    assert index.reload_if_changed()
+    assert index.lookup("10.0.0.10") is None
+    assert 2 == index.lookup("10.0.0.1")["total_count"]
+    index.close()
+
+
+def test_prefix_trie(tmp_path):
+    trie = PrefixTrie(["10.0.0.0/8", "10.1.0.0/16", "192.168.1.7", "2001:db8::/32"])
+    assert 4 == len(trie)
+    assert "10.1.0.0/16" == trie.lookup("10.1.2.3")
+    assert "10.0.0.0/8" == trie.lookup("10.2.2.3")
+    assert "192.168.1.7/32" == trie.lookup("192.168.1.7")
+    assert trie.lookup("192.168.1.8") is None
+    assert "2001:db8::/32" == trie.lookup("2001:db8:1::1")
+    assert "2001:db8::1" not in PrefixTrie(["10.0.0.0/8"])
+    assert "" not in trie
+    assert "xxx.xx.xxx.xx" not in trie
+    assert "0.0.0.0" in PrefixTrie(["0.0.0.0/0"])
+
+    assert "150.95.105.0/24" == get_prefix("150.95.105.63", 24, 64)
+    assert "150.95.0.0/16" == get_prefix("150.95.105.63", 16, 48)
+    assert "2001:db8:85a3::/48" == get_prefix("2001:db8:85a3:1::7334", 16, 48)
+    assert get_prefix("", 24, 64) is None
+
+    allowlist_file = tmp_path / "allowlist.txt"
+    allowlist_file.write_text("# monitoring\n150.95.105.0/24\n\n2001:db8::/32  # CDN\n")
+    allowlist = load_prefix_trie(str(allowlist_file))
+    assert 2 == len(allowlist)
+    line = (
+        '{} - - [01/Oct/2019:07:26:54 +0300] "POST /wp-login.php HTTP/1.1" 200 5536 "-" '
+        '"Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:62.0) Gecko/20100101 Firefox/62.0"'
+    )
+    stats = Stats()
+    assert (
+        parse_line(line.format("150.95.105.63"), allowlist=allowlist, stats=stats)
+        is None
+    )
+    assert (
+        parse_line(line.format("2001:db8::1"), allowlist=allowlist, stats=stats) is None
+    )
+    assert 2 == stats.counters["allowlisted"]
+    assert (
+        "150.95.106.1"
+        == parse_line(line.format("150.95.106.1"), allowlist=allowlist).source_ip
+    )
+    assert (
+        "2001:db9::1"
+        == parse_line(line.format("2001:db9::1"), allowlist=allowlist).source_ip
+    )
+
+    log_file = tmp_path / "access.log"
+    log_file.write_text(
+        "\n".join(
+            line.format(ip) for ip in ["150.95.105.1", "150.95.106.1", "2001:db8::2"]
+        )
+    )
+    events = parse_file(str(log_file), allowlist=allowlist)
+    assert ["150.95.106.1"] == [e.source_ip for e in events]
+
+
+def test_get_prefix_reports():
+    reports = [
+        Report(
+            "150.95.105.{}".format(i),
+            datetime(2019, 10, 1) + timedelta(minutes=i),
+            2,
+            1,
+        )
+        for i in range(1, 201)
+    ]
+    reports.append(Report("150.95.7.1", datetime(2019, 10, 2), 3, post_count=3))
+    reports.append(Report("2001:db8:85a3::1", datetime(2019, 10, 1), 4, 4))
+    reports.append(Report("2001:db8:85a3:1::1", datetime(2019, 10, 1), 1, 1))
+    reports.append(Report("xxx.xx.xxx.xx", datetime(2019, 10, 1), 1, 1))
+    prefix_reports = get_prefix_reports(reports)
+
+    network = prefix_reports["150.95.105.0/24"]
+    assert 24 == network.prefix_length
+    assert 200 == network.ip_count
+    assert 400 == network.total_count
+    assert 200 == network.post_login_count
+    assert datetime(2019, 10, 1, 3, 20) == network.latest
+
+    network = prefix_reports["150.95.0.0/16"]
+    assert 201 == network.ip_count
+    assert 403 == network.total_count
+    assert 3 == network.post_count
+    assert datetime(2019, 10, 2) == network.latest
+
+    assert 1 == prefix_reports["2001:db8:85a3::/64"].ip_count
+    assert 2 == prefix_reports["2001:db8:85a3::/48"].ip_count
+    assert 5 == prefix_reports["2001:db8:85a3::/48"].post_login_count
+    assert 6 == len(prefix_reports)
+
+    generate_reports(save=True)
+    saved = PrefixReport.query.all()
+    assert saved
+    assert all(r.prefix_length in (16, 24, 48, 64) for r in saved)
+    total = sum(r.total_count for r in saved if r.prefix_length in (16, 48))
+    assert total == sum(r.total_count for r in get_base_reports().values())
+
+
+def test_query_cache(tmp_path):
+    db_file = tmp_path / "data.db"
+    db_file.write_bytes(b"1")
+    calls = list()
+
+    def compute(value):
+        calls.append(value)
+        return value * 2
+
+    cache = QueryCache(maxsize=2)
+    paths = [str(db_file)]
+    assert 2 == cache.get(("a",), partial(compute, 1), paths)
+    assert 2 == cache.get(("a",), partial(compute, 1), paths)
+    assert [1] == calls
+    assert 4 == cache.get(("b",), partial(compute, 2), paths)
+    assert 6 == cache.get(("c",), partial(compute, 3), paths)
+    # Least recently used "a" was evicted
+    assert 2 == cache.get(("a",), partial(compute, 1), paths)
+    assert [1, 2, 3, 1] == calls
+
+    # Writes of this process and of other processes invalidate entries
+    bump_generation()
+    cache.get(("a",), partial(compute, 1), paths)
+    os.utime(str(db_file), ns=(0, 0))
+    cache.get(("a",), partial(compute, 1), paths)
+    assert [1, 2, 3, 1, 1, 1] == calls
+    assert {
+        "hits": 1,
+        "misses": 6,
+        "hit_rate": 1 / 7,
+        "stale": 2,
+        "evictions": 2,
+        "size": 2,
+        "maxsize": 2,
+    } == cache.stats()
+    assert (1, 6, 2, 2) == tuple(cache.cache_info())
+
+    # Report reads are served from memory until the next ingest or report write
+    generate_reports(save=True)
+    ip = next(iter(generate_reports()))
+    hits = report_cache.hits
+    first = Report.get_by_ip(ip)
+    assert first is Report.get_by_ip(ip)
+    assert generate_reports() == generate_reports()
+    assert hits + 3 == report_cache.hits
+    first.comment = "checked"
+    first.save()
+    misses = report_cache.misses
+    assert "checked" == Report.get_by_ip(ip).comment
+    assert misses + 1 == report_cache.misses
+
+
+def test_parse_file_invalid_utf8(tmp_path):
+    line = (
+        '150.95.105.63 - - [01/Oct/2019:07:26:54 +0300] "{} /wp-login.php HTTP/1.1" 200 5536 "-" '
+        '"{}"'
+    )
+    log_file = tmp_path / "access.log"
+    log_file.write_bytes(
+        line.format("POST", "Mozilla/5.0").encode()
+        + b"\r\n"
+        + line.format("POST", "evil").encode().replace(b"evil", b"ev\xffil\xc3")
+        + b"\n"
+        + line.format("GET", "Mozilla/5.0").encode()
+        + b"\n"
+    )
+    stats = Stats()
+    events = parse_file(str(log_file), stats=stats)
+    assert 3 == len(events)
+    assert 1 == stats.counters["invalid_utf8"]
+    assert events[0].log_line.endswith('Mozilla/5.0"\n')
+    assert "ev\ufffdil\ufffd" == events[1].user_agent
+    assert "post_login" == events[1].event_type
+
+    staged = parse_file(str(log_file), workers=2, stats=Stats())
+    assert sorted(e.user_agent for e in events) == sorted(e.user_agent for e in staged)
+
+    # Lines that cannot be login POSTs are skipped before decoding
+    assert (
+        parse_raw_line(b"\xff" + line.format("GET", "-").encode(), EventType.post_login)
+        is None
+    )
+    events = parse_file(str(log_file), EventType.post_login)
+    assert 2 == len(events)
+    # -e 0 is post_login, not "any event type"
+    result = run_cli(
+        tmp_path, "log_processor.py", "-f", str(log_file), "-e", "0", "-o", "jsonl"
+    )
+    assert 0 == result.returncode, result.stderr
+    assert ["post_login", "post_login"] == [
+        json.loads(l)["event_type"] for l in result.stdout.splitlines()
+    ]
+
+
+def test_log_format(tmp_path):
+    request = '[01/Oct/2019:07:26:54 +0300] "POST /wp-login.php HTTP/1.1" 200 5536'
+    agent = '"-" "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:62.0) Gecko/20100101"'
+    combined = "150.95.105.63 - - {} {}".format(request, agent)
+    expected = {
+        "source_ip": "150.95.105.63",
+        "method": "POST",
+        "url": "/wp-login.php",
+        "status_code": 200,
+        "timestamp": "01/Oct/2019:07:26:54 +0300",
+        "user_agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:62.0) Gecko/20100101",
+        "bytes_sent": 5536,
+        "duration_us": None,
+    }
+    assert expected == LogFormat("combined").parse(combined)
+    assert expected == LogFormat("nginx").parse(combined)
+    assert expected == LogFormat("vhost_combined").parse("example.com:443 " + combined)
+    common = LogFormat("common").parse("2001:db8::1 - bob {}".format(request))
+    assert "2001:db8::1" == common["source_ip"]
+    assert "user_agent" not in common
+    assert LogFormat("combined").parse("example.com:443 " + combined) is None
+
+    with_duration = LogFormat(
+        '%h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-Agent}i" %D'
+    ).parse(combined + " 1534")
+    assert 1534 == with_duration["duration_us"]
+    nginx_timed = LogFormat(
+        '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent '
+        '"$http_referer" "$http_user_agent" $request_time'
+    ).parse(combined + " 0.250")
+    assert 250000 == nginx_timed["duration_us"]
+    invalid = LogFormat("combined").parse(
+        '150.95.105.63 - - [01/Oct/2019:07:26:54 +0300] "-" 400 - "-" "a \\"quoted\\" agent"'
+    )
+    assert invalid["method"] is None and invalid["url"] is None
+    assert invalid["bytes_sent"] is None
+    assert 'a \\"quoted\\" agent' == invalid["user_agent"]
+    with pytest.raises(ValueError):
+        LogFormat("%t %>s")
+    # Fields parse_record() reads can't be left out
+    with pytest.raises(ValueError, match="time"):
+        LogFormat('%h "%r" %>s')
+    with pytest.raises(ValueError, match="status"):
+        LogFormat('$remote_addr [$time_local] "$request"')
+
+    # Same events as the combined format parser, plus the extras
+    lines = list(generate_lines(300))
+    compiled = LogFormat("combined")
+    key = lambda e: (e.source_ip, e.event_type, e.status_code, e.user_agent, e.url)
+    assert [key(parse_line(l)) for l in lines] == [
+        key(parse_line(l, log_format=compiled)) for l in lines
+    ]
+    log_file = tmp_path / "access.log"
+    log_file.write_text("\n".join([combined + " 1534", "garbage"]))
+    stats = Stats()
+    events = parse_file(
+        str(log_file),
+        log_format=LogFormat(
+            '%h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-Agent}i" %D'
+        ),
+        stats=stats,
+    )
+    assert [(5536, 1534)] == [(e.bytes_sent, e.duration_us) for e in events]
+    assert 1 == stats.counters["format_mismatches"]
+
+
+def test_add_missing_columns(tmp_path):
+    # Events table and shard as created before bytes_sent and duration_us existed
+    old_schema = (
+        "CREATE TABLE events (id INTEGER PRIMARY KEY, source_ip VARCHAR(100), "
+        "event_type VARCHAR(100), status_code INTEGER, user_agent VARCHAR(1000), "
+        "url VARCHAR(1000), date_time DATETIME, log_line VARCHAR(1000))"
+    )
+    old_row = (
+        "INSERT INTO events (source_ip, event_type, status_code, user_agent, url, "
+        "date_time, log_line) VALUES ('10.9.0.1', 'post_login', 200, 'old', "
+        "'/wp-login.php', '2019-10-01 07:26:54.000000', 'line')"
+    )
+    old_shard = str(tmp_path / "events_20191001.db")
+    engine = create_engine("sqlite:///{}".format(old_shard))
+    with engine.begin() as connection:
+        connection.exec_driver_sql(old_schema)
+        connection.exec_driver_sql(old_row)
+    new_shard = str(tmp_path / "events_20191002.db")
+    router = ShardRouter(str(tmp_path))
+    router.save(
+        [
+            parse_line(l)
+            for l in generate_lines(3, start=datetime(2019, 10, 2, tzinfo=timezone.utc))
+        ]
+    )
+    router.dispose()
+    rows = query_shards(
+        [old_shard, new_shard], "SELECT user_agent, bytes_sent FROM events"
+    )
+    assert ("old", None) in rows
+    assert 4 == len(rows)
+
+    add_missing_columns(engine, [Event.__table__])
+    with engine.connect() as connection:
+        columns = [
+            row[1] for row in connection.exec_driver_sql("PRAGMA table_info(events)")
+        ]
+        assert [c.name for c in Event.__table__.columns] == columns
+        assert 1 == connection.exec_driver_sql("SELECT count(*) FROM events").scalar()
+    engine.dispose()
+
+
+def test_stream_file(tmp_path):
+    log_file = tmp_path / "access.log"
+    lines = list(generate_lines(2500, seed=3))
+    log_file.write_text("".join(lines))
+    record = parse_record(lines[0])
+    event = parse_line(lines[0])
+    for field, value in record.items():
+        assert getattr(event, field) == value
+
+    expected = [parse_record(l) for l in lines]
+    jsonl_file = str(tmp_path / "events.jsonl")
+    alerts = []
+    detector = BruteForceDetector(threshold=3, window=3600, on_alert=alerts.append)
+    with get_sink("jsonl", jsonl_file) as sink:
+        assert 2500 == stream_file(str(log_file), sink, detector=detector)
+    with open(jsonl_file) as f:
+        written = [json.loads(line) for line in f]
+    assert [(r["source_ip"], r["event_type"], r["url"]) for r in expected] == [
+        (r["source_ip"], r["event_type"], r["url"]) for r in written
+    ]
+    assert str(expected[0]["date_time"]) == written[0]["date_time"]
+    assert "log_line" not in written[0]
+    assert alerts and alerts[0].count == 3
+
+    csv_file = str(tmp_path / "events.csv")
+    with get_sink("csv", csv_file, ["source_ip", "event_type", "status_code"]) as sink:
+        assert 2500 == stream_file(str(log_file), sink, workers=2, stats=Stats())
+    with open(csv_file) as f:
+        rows = list(csv.reader(f))
+    assert ["source_ip", "event_type", "status_code"] == rows[0]
+    assert sorted(
+        [r["source_ip"], r["event_type"], str(r["status_code"])] for r in expected
+    ) == sorted(rows[1:])
+
+    tsv_file = str(tmp_path / "events.tsv")
+    with get_sink("tsv", tsv_file) as sink:
+        stream_file(str(log_file), sink, EventType.post_login)
+    with open(tsv_file) as f:
+        rows = list(csv.reader(f, delimiter="\t"))
+    assert len(rows) - 1 == sum(1 for r in expected if r["event_type"] == "post_login")
+    with pytest.raises(ValueError):
+        get_sink("xml", tsv_file)
+
+    # Alerts and date parse errors don't end up among streamed records
+    lines.append(lines[0].replace("[01/", "[99/"))
+    log_file.write_text("".join(lines))
+    result = run_cli(
+        tmp_path,
+        "log_processor.py",
+        "-f",
+        str(log_file),
+        "-o",
+        "jsonl",
+        "--detect",
+        "3",
+    )
+    assert 0 == result.returncode, result.stderr
+    assert 2501 == len([json.loads(l) for l in result.stdout.splitlines()])
+    assert "ALERT" in result.stderr and "parsing string" in result.stderr
+    result = run_cli(
+        tmp_path,
+        "log_processor.py",
+        "-f",
+        str(log_file),
+        "-o",
+        "csv",
+        "--stats-json",
+        "-",
+    )
+    assert 0 != result.returncode
+
+
+def test_external_sort(tmp_path, capsys):
+    records = [parse_record(l) for l in generate_lines(1000, seed=5, distinct_ips=40)]
+    sorter = ExternalSorter(get_ip_sort_key, buffer_size=64, temp_dir=str(tmp_path))
+    merged = list(sorter.sort(iter(records)))
+    # Same order as sorted(), including input order within an IP
+    assert sorted(records, key=get_ip_sort_key) == merged
+    assert 16 == sorter.runs
+    assert [] == os.listdir(str(tmp_path))
+    # Runs are merged at most fan_in at a time: 16 -> 8 -> 4 -> 2
+    assert 2 == sorter.fan_in
+    assert 3 == sorter.merge_passes
+    wide = ExternalSorter(get_ip_sort_key, buffer_size=64, fan_in=16)
+    assert merged == list(wide.sort(records))
+    assert 0 == wide.merge_passes
+
+    in_memory = ExternalSorter(get_ip_sort_key, buffer_size=2000)
+    assert merged == list(in_memory.sort(records))
+    assert 0 == in_memory.runs
+
+    groups = [
+        (ip, len(list(group)))
+        for ip, group in group_sorted(merged, lambda r: r["source_ip"])
+    ]
+    assert len(groups) == len({r["source_ip"] for r in records})
+    assert 1000 == sum(count for _, count in groups)
+
+    assert 1000 == print_sorted(records, group_by_ip=True, buffer_size=100)
+    output = capsys.readouterr().out
+    ip, count = groups[0]
+    assert output.startswith("{}:\n".format(ip))
+    assert "{} events from {}\n".format(count, ip) in output
+
+
+def test_numpy_reports(tmp_path):
+    pytest.importorskip("numpy")
+    from numpy_reports import EventColumns, generate_reports as generate_numpy_reports
+    from numpy_reports import report_log_files
+
+    def as_rows(reports):
+        return {
+            ip: [r.latest] + [getattr(r, field) for field in COUNT_FIELDS]
+            for ip, r in reports.items()
+        }
+
+    columns = EventColumns()
+    events = Event.query.all()
+    for offset in range(0, len(events), 3000):
+        columns.add_events(events[offset : offset + 3000])
+    assert len(events) == len(columns)
+    assert as_rows(generate_reports()) == as_rows(
+        generate_numpy_reports(columns, Report, finish_reports)
+    )
+    assert {} == generate_numpy_reports(EventColumns(), Report, finish_reports)
+
+    # Parsed records, including unclassified events that only add to total_count
+    lines = list(generate_lines(2000, seed=7, distinct_ips=30))
+    lines.append(lines[0].replace('"GET ', '"PUT ').replace('"POST ', '"PUT '))
+    log_file = tmp_path / "access.log"
+    log_file.write_text("".join(lines))
+    records = [parse_record(l) for l in lines]
+    reports = report_log_files(str(log_file), Report, finish_reports)
+    ip = records[-1]["source_ip"]
+    own = [r for r in records if r["source_ip"] == ip]
+    assert len(own) == reports[ip].total_count
+    assert sum(1 for r in own if r["event_type"] == "get") == reports[ip].get_count
+    assert max(r["date_time"] for r in own).replace(tzinfo=None) == reports[ip].latest
+
+    # report.py runs as __main__, numpy_reports must not import a second copy of it
+    result = run_cli(tmp_path, "report.py", "--from-log", str(log_file))
+    assert 0 == result.returncode, result.stderr
+    assert "Saved {} reports".format(len(reports)) in result.stdout
+
+
+def test_classify_user_agent():
+    cases = {
+        "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:62.0) Gecko/20100101 Firefox/62.0": (
+            UserAgentClass.browser
+        ),
+        "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)": (
+            UserAgentClass.bot
+        ),
+        "Googlebot-Image/1.0": UserAgentClass.bot,
+        "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) "
+        "HeadlessChrome/79.0.3945.0 Safari/537.36": UserAgentClass.headless,
+        "curl/7.58.0": UserAgentClass.script,
+        "python-requests/2.22.0": UserAgentClass.script,
+        "Wget/1.20.3 (linux-gnu)": UserAgentClass.script,
+        "-": UserAgentClass.empty,
+        "NO USER AGENT": UserAgentClass.empty,
+        "": UserAgentClass.empty,
+        "shard-test": UserAgentClass.other,
+    }
+    for user_agent, ua_class in cases.items():
+        assert ua_class.value == classify_user_agent(user_agent), user_agent
+    hits = classify_user_agent.cache_info().hits
+    classify_user_agent("curl/7.58.0")
+    assert hits + 1 == classify_user_agent.cache_info().hits
+
+    # Every event counts towards exactly one class
+    reports = generate_reports()
+    for report in reports.values():
+        assert report.total_count == sum(
+            getattr(report, field) for field in UA_COUNT_FIELDS
+        )
+    ua_counts = get_ua_class_counts()
+    assert Event.query.count() == sum(ua_counts.values())
+    assert (
+        Event.query.filter(Event.user_agent.like("curl/%")).count()
+        <= ua_counts[UserAgentClass.script]
+    )
+    post_login = get_ua_class_counts([EventType.post_login])
+    assert Event.query.filter(Event.event_type == "post_login").count() == sum(
+        post_login.values()
+    )
+
+
+def test_routes(tmp_path):
+    assert "/wp-login.php" == get_route("/wp-login.php?action=lostpassword#top")
+    assert "/post/{id}/comments" == get_route("/post/123/comments?page=2")
+    assert "/blobs/{hex}" == get_route("/blobs/5f2b9c1e0a7d")
+    assert "/u/{uuid}" == get_route("/u/123e4567-e89b-12d3-a456-426614174000")
+    assert "/admin/deadbeef" == get_route("/admin/deadbeef")
+    assert get_route("NO URL FOUND") is None
+    templates_file = tmp_path / "routes.txt"
+    templates_file.write_text("# plugins\n/wp-content/plugins/*/**\n/user/*\n")
+    set_route_templates(load_route_templates(str(templates_file)))
+    try:
+        assert "/wp-content/plugins/*/**" == get_route(
+            "/wp-content/plugins/akismet/readme.txt?ver=1"
+        )
+        assert "/user/*" == get_route("/user/bob")
+        assert "/user/{id}/posts" == get_route("/user/7/posts")
+        assert "/wp-content/{id}" == get_route("/wp-content/42")
+    finally:
+        set_route_templates(None)
+
+    shard_dir = str(tmp_path / "shards")
+    lines = [
+        '10.6.0.{} - - [01/Oct/2019:07:26:{:02d} +0300] "GET /admin/{}?x={} HTTP/1.1" '
+        '{} 512 "-" "route-test"'.format(i % 5, i, i, i, 404 if i % 2 else 200)
+        for i in range(40)
+    ]
+    lines.append(
+        '10.6.0.9 - - [01/Oct/2019:07:27:00 +0300] "POST /wp-login.php HTTP/1.1" '
+        '200 512 "-" "route-test"'
+    )
+    events = [parse_line(line) for line in lines]
+    set_router(ShardRouter(shard_dir, "day"))
+    try:
+        assert Event.save_all(events)
+    finally:
+        set_router(None)
+    assert 2 == len({e.route_id for e in events})
+    # Interned ids survive a cold cache
+    route_table.ids.clear()
+    assert events[0].route_id == route_table.get_ids(["/admin/{id}"])["/admin/{id}"]
+
+    reports = get_route_reports(shard_dir=shard_dir)
+    assert {"/admin/{id}", "/wp-login.php"} == set(reports)
+    admin = reports["/admin/{id}"]
+    assert (40, 5, 20, 20) == (
+        admin.total_count,
+        admin.ip_count,
+        admin.get_4xx_count,
+        admin.error_count,
+    )
+    assert datetime(2019, 10, 1, 7, 26, 39) == admin.latest
+    assert 1 == reports["/wp-login.php"].post_login_count
+    RouteReport.save_all(list(reports.values()))
+    assert ["/admin/{id}"] == [r.route for r in RouteReport.get_most_errors(5)]
+    assert 1 == RouteReport.get_by_route("/wp-login.php").total_count
+
+
+def test_sampling(tmp_path):
+    lines = list(generate_lines(3000, seed=11, distinct_ips=60))
+    log_file = tmp_path / "access.log"
+    log_file.write_text("".join(lines))
+    everything = parse_file(str(log_file))
+
+    stats = Stats()
+    sampled = parse_file(str(log_file), sampler=Sampler(10), stats=stats)
+    assert 150 < len(sampled) < 450
+    assert {10} == {e.sample_rate for e in sampled}
+    assert 3000 - len(sampled) == stats.counters["sampled_out"]
+    # Deterministic across runs
+    again = parse_file(str(log_file), sampler=Sampler(10))
+    assert [e.log_line for e in sampled] == [e.log_line for e in again]
+
+    # Every event of a sampled IP is kept
+    by_ip = parse_file(str(log_file), sampler=Sampler(4, by_ip=True))
+    kept_ips = {e.source_ip for e in by_ip}
+    assert 0 < len(kept_ips) < 60
+    assert len(by_ip) == sum(1 for e in everything if e.source_ip in kept_ips)
+
+    # The client address isn't the first field of every format
+    vhost_file = tmp_path / "vhost.log"
+    vhost_file.write_text(
+        "".join(
+            "example.com:{} {}".format(80 + i % 2, line) for i, line in enumerate(lines)
+        )
+    )
+    vhost_format = LogFormat("vhost_combined")
+    assert 1 == vhost_format.ip_field
+    vhost = parse_file(
+        str(vhost_file),
+        log_format=vhost_format,
+        sampler=Sampler(4, by_ip=True, ip_field=vhost_format.ip_field),
+    )
+    assert kept_ips == {e.source_ip for e in vhost}
+    assert LogFormat('%t %h "%r" %>s').ip_field is None
+
+    shard_dir = str(tmp_path / "shards")
+    set_router(ShardRouter(shard_dir, "month"))
+    try:
+        assert Event.save_all(by_ip)
+    finally:
+        set_router(None)
+    assert {None} == {e.sample_rate for e in by_ip}
+    assert {4} == {e.ip_sample_rate for e in by_ip}
+    reports = generate_reports(shard_dir=shard_dir)
+    assert kept_ips >= set(reports)
+    for ip, report in reports.items():
+        own = [e for e in everything if e.source_ip == ip]
+        # Kept IPs have all their events, their counts are exact
+        assert report.sampled
+        assert 4 == report.ip_sample_rate
+        assert len(own) == report.total_count
+        assert sum(1 for e in own if e.event_type == "get") == report.get_count
+    # Totals over IPs are scaled up
+    for prefix_report in get_prefix_reports(reports.values()).values():
+        assert prefix_report.sampled
+        assert 0 == prefix_report.total_count % 4
+    assert 4 * sum(r.total_count for r in reports.values()) == sum(
+        get_ua_class_counts(shard_dir=shard_dir).values()
+    )
+    assert 4 * len(by_ip) == sum(
+        r.total_count for r in get_route_reports(shard_dir=shard_dir).values()
+    )
+
+    pytest.importorskip("numpy")
+    from numpy_reports import EventColumns, get_base_reports as get_numpy_reports
+
+    columns = EventColumns()
+    columns.add_events(parse_file(str(log_file), sampler=Sampler(4, by_ip=True)))
+    for ip, report in get_numpy_reports(columns, Report).items():
+        assert report.sampled
+        assert 4 == report.ip_sample_rate
+        assert sum(1 for e in everything if e.source_ip == ip) == report.total_count
+
+
+def test_ingest_file(tmp_path):
+    assert 512 << 20 == parse_size("512M")
+    assert 1536 << 20 == parse_size("1.5GiB")
+    assert 4096 == parse_size("4096")
+    with pytest.raises(ValueError):
+        parse_size("lots")
+
+    log_file = tmp_path / "access.log"
+    log_file.write_text("".join(generate_lines(2500, seed=5)))
+    expected = len(parse_file(str(log_file)))
+    set_router(ShardRouter(str(tmp_path / "shards"), "month"))
+    try:
+        # Budget below the current RSS, every chunk is flushed as soon as it's parsed
+        stats = Stats()
+        count, budget = ingest_file(str(log_file), 1, stats=stats)
+        assert expected == count == sum(budget.batch_sizes)
+        assert 3 == len(budget.batch_sizes)
+        assert 1 <= stats.sections["memory"]["peak_rss_bytes"]
+        assert "Memory: peak RSS" in stats.to_text()
+
+        count, budget = ingest_file(str(log_file), 1 << 40, workers=2)
+        assert expected == count
+        assert [expected] == budget.batch_sizes
+    finally:
+        set_router(None)
+
+    # The budget only bounds the plain save path, don't ignore it silently
+    for flags in (["-s", "1", "-p", "1"], ["-s", "1", "--follow"], ["-p", "1"]):
+        result = run_cli(
+            tmp_path,
+            "log_processor.py",
+            "-f",
+            str(log_file),
+            "--max-memory",
+            "256M",
+            *flags,
+        )
+        assert 0 != result.returncode
+        assert "--max-memory" in result.stderr
+
+    budget = MemoryBudget(1 << 30, record_size=1 << 20)
+    assert budget.get_batch_size() < 1000
+    assert not budget.should_flush(0)
+
+
+def test_file_leases(tmp_path):
+    file_names = [str(tmp_path / "access.log.{}".format(i)) for i in range(20)]
+    claimed = {"a": list(), "b": list()}
+
+    def run(name):
+        file_leases = FileLeases(60, owner=name)
+        try:
+            for file_name in file_leases.claim_files(file_names):
+                time.sleep(0.001)
+                claimed[name].append(file_name)
+                file_leases.finish(file_name)
+        finally:
+            file_leases.release()
+            processor_db_session.remove()
+
+    threads = [threading.Thread(target=run, args=(name,)) for name in claimed]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Every file parsed by exactly one of the overlapping runs
+    assert not set(claimed["a"]) & set(claimed["b"])
+    assert set(file_names) == set(claimed["a"]) | set(claimed["b"])
+    # Finished files stay claimed for the lease period
+    assert not FileLeases(60).claim(file_names[0])
+
+    # Leases of a run that died expire, unfinished leases are released
+    stale = FileLeases(0, owner="crashed")
+    assert stale.claim(str(tmp_path / "other.log"))
+    survivor = FileLeases(60, owner="survivor")
+    assert survivor.claim(str(tmp_path / "other.log"))
+    assert survivor.claim(str(tmp_path / "unfinished.log"))
+    survivor.release()
+    assert 0 == FileLease.query.filter(FileLease.owner == "survivor").count()
+
+    attempts = list()
+
+    def locked_once():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise OperationalError("INSERT", {}, Exception("database is locked"))
+        return "written"
+
+    assert "written" == run_with_retry(locked_once, delay=0.001)
+    assert 2 == len(attempts)
+
+    def missing_table():
+        attempts.append(1)
+        raise OperationalError("INSERT", {}, Exception("no such table: events"))
+
+    # Only lock errors are retried
+    with pytest.raises(OperationalError):
+        run_with_retry(missing_table, delay=0.001)
+    assert 3 == len(attempts)
+
+    # Leases are only taken by the plain save path, don't ignore them silently
+    for flags in (["-s", "1", "-p", "1"], ["-s", "1", "--follow"], []):
+        result = run_cli(
+            tmp_path, "log_processor.py", "-f", file_names[0], "--lease", *flags
+        )
+        assert 0 != result.returncode
+        assert "--lease" in result.stderr
+
+
+def test_compact_events(tmp_path):
+    test_db_path = os.environ["PROCESSOR_DB_FILE"]
+    # Compaction deletes events, use a DB of our own
+    os.environ["PROCESSOR_DB_FILE"] = str(tmp_path / "compact.db")
+    processor_db_session.remove()
+    init_db()
+    try:
+        assert 2 == get_auto_vacuum()
+        start = datetime(2019, 10, 1, tzinfo=timezone.utc)
+        events = [
+            Event(
+                "10.0.0.{}".format(i % 7),
+                "wordpress" if i % 3 else "ssh",
+                200,
+                "curl/7.58.0",
+                "/wp-login.php",
+                start + timedelta(hours=i),
+                "line {}".format(i) * 20,
+            )
+            for i in range(96)
+        ]
+        Event.save_all(events)
+        # The first two days
+        archived, size = compact_events(
+            datetime(2019, 10, 3), str(tmp_path / "archive"), batch_size=30
+        )
+        assert 48 == archived
+        assert 0 < size
+        assert 48 == Event.query.count()
+        assert 0 == Event.query.filter(Event.date_time < datetime(2019, 10, 3)).count()
+        # Batches are split per day, the second day spans both batches
+        archives = list_archives(str(tmp_path / "archive"))
+        assert 3 == len(archives)
+        assert archives[1:] == list_archives(
+            str(tmp_path / "archive"),
+            datetime(2019, 10, 2, 1),
+            datetime(2019, 10, 2, 2),
+        )
+        assert 0 == compact_events(datetime(2019, 10, 3), str(tmp_path / "archive"))[0]
+
+        archived_events = list(read_archived_events(str(tmp_path / "archive")))
+        assert 48 == len(archived_events)
+        assert start.replace(tzinfo=None) == archived_events[0]["date_time"]
+        assert "line 0" * 20 == archived_events[0]["log_line"]
+        assert archived_events[0]["route_id"] is not None
+        window = list(
+            read_archived_events(
+                str(tmp_path / "archive"),
+                datetime(2019, 10, 1, 22),
+                datetime(2019, 10, 2, 2),
+                columns=["source_ip", "event_type"],
+            )
+        )
+        assert 4 == len(window)
+        assert {"source_ip", "event_type"} == set(window[0])
+        assert {"10.0.0.1", "10.0.0.2", "10.0.0.3", "10.0.0.4"} == {
+            e["source_ip"] for e in window
+        }
+        with pytest.raises(ValueError):
+            read_archive(archives[0], ["no_such_column"])
+        assert 0 == incremental_vacuum()
+    finally:
+        processor_db_session.remove()
+        os.environ["PROCESSOR_DB_FILE"] = test_db_path
+        init_db()
+
+
+def test_profiler(tmp_path):
+    import log_processor
+
+    line = (
+        '150.95.105.63 - - [01/Oct/2019:07:26:52 +0300] "POST /wp-login.php HTTP/1.1" 200 5128 "-" '
+        '"Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:62.0) Gecko/20100101 Firefox/62.0"'
+    )
+    profiler = Profiler(str(tmp_path / "profile"))
+    profiler.install(log_processor, PROFILED_FUNCTIONS)
+    profiler.install(Event, ["save_all"])
+    try:
+        assert log_processor.parse_line is not parse_line
+        assert isinstance(Event.__dict__["save_all"], staticmethod)
+        threads = [
+            threading.Thread(
+                target=lambda: [log_processor.parse_line(line) for _ in range(20)]
+            )
+            for _ in range(2)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        event = log_processor.parse_line(line)
+        assert "post_login" == event.event_type
+    finally:
+        written = profiler.finish()
+    # Restored
+    assert log_processor.parse_line is parse_line
+    assert not hasattr(Event.save_all, "__wrapped__")
+
+    functions = {f[2] for f in profiler.get_stats("parse_line").stats}
+    # Nested stages are exclusive, parse_line doesn't include parse_record's work
+    assert "get_source_ip" not in functions
+    functions = {f[2] for f in profiler.get_stats("parse_record").stats}
+    assert "get_source_ip" in functions
+    assert "to_datetime" not in functions
+    assert None is profiler.get_stats("Event.save_all")
+    assert 3 == len(profiler.profiles["parse_line"])
+    assert {
+        str(tmp_path / "profile" / "{}.{}".format(stage, ext))
+        for stage in PROFILED_FUNCTIONS
+        for ext in ("prof", "txt")
+    } == set(written)
+    with open(str(tmp_path / "profile" / "parse_record.txt")) as f:
+        summary = f.read()
+    assert "Stage parse_record" in summary
+    # Calls 1, 2, 4, 8, 16 and 32 of 41
+    assert "Allocations in 6 sampled calls" in summary
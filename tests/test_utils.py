@@ -3,6 +3,9 @@ import random
 from pathlib import Path
 import os
 
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
 # Global variable to hold in-memory database path for the session
 _IN_MEMORY_DB_PATH = None
 
@@ -24,13 +27,14 @@ def create_test_database(num_records=10000):
     project_root = current_dir.parent
     main_db_path = project_root / "log_processor.db"
 
-    if not main_db_path.exists():
-        raise FileNotFoundError(f"Main database not found at {main_db_path}")
-
     # Make sure we're using the temporary directory
     temp_db_path = Path("/tmp") / f"test_db_{random.randint(10000, 99999)}.db"
     temp_db_path = str(temp_db_path)
 
+    if not main_db_path.exists():
+        # Clean checkout: fill the database from a generated log instead
+        return create_generated_database(temp_db_path, num_records)
+
     # Connect to original database
     main_conn = sqlite3.connect(main_db_path)
 
@@ -85,6 +89,31 @@ def create_test_database(num_records=10000):
     return temp_db_path
 
 
+def create_generated_database(db_path, num_records=10000, seed=0):
+    """
+    Create a test database with events parsed from a synthetic access log.
+
+    Args:
+        db_path (str): Path of the database file to create
+        num_records (int): Number of generated log lines
+        seed (int): Generator seed
+
+    Returns:
+        str: Path to the created database file
+    """
+    from benchmarks.generator import generate_lines
+    from database import BaseProcessor
+    from log_processor import parse_line
+
+    engine = create_engine(f"sqlite:///{db_path}")
+    BaseProcessor.metadata.create_all(bind=engine)
+    with Session(engine) as session:
+        session.add_all(parse_line(line) for line in generate_lines(num_records, seed))
+        session.commit()
+    engine.dispose()
+    return db_path
+
+
 def get_in_memory_db_path():
     """
     Get or create the in-memory database path for current pytest session.
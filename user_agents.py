@@ -0,0 +1,57 @@
+import re
+from enum import Enum
+from functools import lru_cache
+
+# Distinct user agents are few compared to lines, so nearly every lookup is a hit
+CACHE_SIZE = 10000
+EMPTY_USER_AGENTS = {"", "-", "NO USER AGENT"}
+HEADLESS = re.compile(r"Headless|PhantomJS|Puppeteer|Selenium|Playwright|Electron")
+BOT = re.compile(
+    r"bot\b|bot/|crawl|spider|slurp|scrapy|facebookexternalhit|mediapartners|"
+    r"bingpreview|feedfetcher|archiver|\+https?://",
+    re.IGNORECASE,
+)
+SCRIPT = re.compile(
+    r"^(?:curl|wget|python|go-http-client|java|libwww-perl|lwp|okhttp|"
+    r"apache-httpclient|php|ruby|perl|node|axios|aiohttp|httpx|guzzlehttp|"
+    r"winhttp|powershell|masscan|zgrab|nmap|nikto|sqlmap)",
+    re.IGNORECASE,
+)
+BROWSER = re.compile(r"^(?:Mozilla|Opera)/")
+
+
+class UserAgentClass(Enum):
+    # Regular browser
+    browser = 0
+    # Crawler or monitoring bot announcing itself
+    bot = 1
+    # Automated browser
+    headless = 2
+    # HTTP library or command line client
+    script = 3
+    # Missing user agent
+    empty = 4
+    # Anything else
+    other = 5
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def classify_user_agent(user_agent):
+    """
+    Classify a user agent string into a UserAgentClass
+    @param user_agent: User agent string
+    @type user_agent: str | None
+    @return: UserAgentClass value
+    @rtype: int
+    """
+    if user_agent is None or user_agent.strip() in EMPTY_USER_AGENTS:
+        return UserAgentClass.empty.value
+    if HEADLESS.search(user_agent):
+        return UserAgentClass.headless.value
+    if BOT.search(user_agent):
+        return UserAgentClass.bot.value
+    if SCRIPT.search(user_agent):
+        return UserAgentClass.script.value
+    if BROWSER.search(user_agent):
+        return UserAgentClass.browser.value
+    return UserAgentClass.other.value